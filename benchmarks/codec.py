@@ -0,0 +1,50 @@
+"""
+Compares the per-class DocumentCodec with boto3's generic TypeSerializer and
+TypeDeserializer (what the Table resource runs on every attribute).
+
+PYTHONPATH=. python benchmarks/codec.py
+"""
+import decimal
+import timeit
+
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+
+from docb.codec import DocumentCodec
+from docb.testcase import TestDocument
+
+DOC = {
+    '_id': 'ec640abfd6:id:dynamodb:TestDocument',
+    '_doc_type': 'TestDocument',
+    'name': 'Kevin',
+    'last_updated': '2019-01-01T12:00:00Z',
+    'date_created': '2019-01-01',
+    'is_active': True,
+    'no_subscriptions': 3,
+    'gpa': 3.25,
+}
+
+
+def main(number=20000):
+    codec = DocumentCodec(TestDocument)
+    serializer = TypeSerializer()
+    deserializer = TypeDeserializer()
+    item = codec.encode(DOC)
+
+    def generic_encode():
+        return {k: serializer.serialize(decimal.Decimal(str(v)) if type(v) == float else v) for k, v in DOC.items()}
+
+    def generic_decode():
+        return {k: deserializer.deserialize(v) for k, v in item.items()}
+
+    results = [
+        ('encode (TypeSerializer)', timeit.timeit(generic_encode, number=number)),
+        ('encode (DocumentCodec)', timeit.timeit(lambda: codec.encode(DOC), number=number)),
+        ('decode (TypeDeserializer)', timeit.timeit(generic_decode, number=number)),
+        ('decode (DocumentCodec)', timeit.timeit(lambda: codec.decode(item), number=number)),
+    ]
+    for name, seconds in results:
+        print('{:<28} {:8.2f} us/doc'.format(name, seconds / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
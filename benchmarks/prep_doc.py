@@ -0,0 +1,54 @@
+"""
+Compares the compiled per-class prep_doc (see docb.compiler) with the generic
+loop over _base_properties it replaces.
+
+PYTHONPATH=. python benchmarks/prep_doc.py
+"""
+import datetime
+import timeit
+
+import docb.utils
+from docb.document import Document
+from docb.properties import (CharProperty, IntegerProperty, FloatProperty, BooleanProperty, DateProperty,
+                             EmailProperty)
+
+
+class Subscriber(Document):
+    name = CharProperty(required=True, min_length=2, max_length=50)
+    email = EmailProperty(required=True)
+    city = CharProperty(global_index=True)
+    signed_up = DateProperty()
+    is_active = BooleanProperty(default_value=True)
+    no_subscriptions = IntegerProperty(default_value=1, min_value=1, max_value=20)
+    gpa = FloatProperty()
+
+
+def generic_prep_doc(self, create_pk=False):
+    doc = self._data.copy()
+    for key, prop in list(self._base_properties.items()):
+        prop.validate(doc.get(key), key)
+        v = doc.get(key)
+        raw_value = prop.get_python_value(doc.get(key))
+        if prop.unique:
+            self.check_unique(key, raw_value)
+        if v or v is False:
+            doc[key] = prop.get_db_value(raw_value)
+        else:
+            doc.pop(key, None)
+    doc['_doc_type'] = docb.utils.get_doc_type(self.__class__)
+    return doc
+
+
+def main(number=20000):
+    doc = Subscriber(name='Kevin', email='kevin@docb.com', city='Durham', signed_up=datetime.date(2019, 1, 1),
+                     no_subscriptions=3, gpa=3.25)
+    assert doc.prep_doc() == generic_prep_doc(doc)
+    generic = timeit.timeit(lambda: generic_prep_doc(doc), number=number)
+    compiled = timeit.timeit(lambda: doc.prep_doc(), number=number)
+    print('{:<22} {:8.2f} us/doc'.format('generic prep_doc', generic / number * 1e6))
+    print('{:<22} {:8.2f} us/doc'.format('compiled prep_doc', compiled / number * 1e6))
+    print('speedup                {:8.2f}x'.format(generic / compiled))
+
+
+if __name__ == '__main__':
+    main()
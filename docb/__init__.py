@@ -1,3 +1,4 @@
 from .document import Document, BaseDocument
 from .properties import *
 from .loading import DocbHandler
+from .expressions import F, REMOVE
@@ -0,0 +1,186 @@
+"""
+Aggregates that writes keep up to date with atomic ADD updates, so count,
+sum and mean of the queries they match are a single GetItem.
+
+A class declares them in its Meta:
+
+    class Meta:
+        aggregates = {'fields': ['gpa'], 'group_by': ['state']}
+
+Every aggregate is an item of the '<doc_type>#agg' _doc_type. The total of
+the class has the _id 'all' and each group '<property>=<value>'. They hold
+the number of documents (_count) and, for each field, the sum of its values
+and the number of documents that have one.
+"""
+import decimal
+import statistics
+
+from docb.expressions import ExpressionBuilder, add_numbers
+
+AGGREGATE_SUFFIX = '#agg'
+TOTAL_ID = 'all'
+COUNT_ATTR = '_count'
+
+
+def get_config(doc_class):
+    """
+    :param doc_class: Document class
+    :return: (fields, group_by) tuples or None if the class has no aggregates
+    """
+    aggregates = getattr(doc_class.Meta, 'aggregates', None)
+    if not aggregates:
+        return None
+    return tuple(aggregates.get('fields', ())), tuple(aggregates.get('group_by', ()))
+
+
+def sum_attr(field):
+    return '_sum_{}'.format(field)
+
+
+def count_attr(field):
+    return '_count_{}'.format(field)
+
+
+def group_id(name, value):
+    return '{}={}'.format(name, value)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float, decimal.Decimal)) and not isinstance(value, bool)
+
+
+def contributions(doc_class, doc):
+    """
+    What a stored document adds to each aggregate.
+    :param doc_class: Document class
+    :param doc: Item dict or None
+    :return: dict of aggregate _id to dict of attribute to number
+    """
+    if not doc:
+        return dict()
+    fields, group_by = get_config(doc_class)
+    values = {COUNT_ATTR: 1}
+    for field in fields:
+        value = doc.get(field)
+        if _is_number(value):
+            values[sum_attr(field)] = value
+            values[count_attr(field)] = 1
+    result = {TOTAL_ID: values}
+    for name in group_by:
+        value = doc.get(name)
+        if value is not None and value != '':
+            result[group_id(name, value)] = values
+    return result
+
+
+def merge(target, deltas, sign=1):
+    """
+    Adds deltas (see contributions) to target in place.
+    :return: target
+    """
+    for agg_id, values in deltas.items():
+        totals = target.setdefault(agg_id, dict())
+        for attr, value in values.items():
+            totals[attr] = add_numbers(totals.get(attr, 0), value if sign > 0 else -value)
+    return target
+
+
+def get_deltas(doc_class, old, new):
+    """
+    The changes to the aggregates when old is replaced by new.
+    :param doc_class: Document class
+    :param old: Item dict before the write (None if it didn't exist)
+    :param new: Item dict after the write (None if it was deleted)
+    :return: dict of aggregate _id to dict of attribute to number (without zeros)
+    """
+    deltas = merge(merge(dict(), contributions(doc_class, new)), contributions(doc_class, old), sign=-1)
+    deltas = {agg_id: {attr: v for attr, v in values.items() if v != 0} for agg_id, values in deltas.items()}
+    return {agg_id: values for agg_id, values in deltas.items() if values}
+
+
+def update_params(values):
+    """
+    UpdateItem parameters that ADD values to an aggregate item.
+    :param values: dict of attribute to number
+    :return: dict
+    """
+    builder = ExpressionBuilder()
+    adds = ['{} {}'.format(builder.name(attr), builder.value(value)) for attr, value in values.items()]
+    params = {'UpdateExpression': 'ADD ' + ', '.join(adds)}
+    params.update(builder.params())
+    return params
+
+
+class Aggregate(object):
+    """
+    The values of one aggregate item.
+    """
+
+    def __init__(self, doc_class, values):
+        self.doc_class = doc_class
+        self.values = values
+
+    @property
+    def fields(self):
+        return get_config(self.doc_class)[0]
+
+    @property
+    def count(self):
+        return int(self.values.get(COUNT_ATTR, 0))
+
+    def _check(self, attr):
+        if attr not in self.fields:
+            raise KeyError('{} is not an aggregate field of {}'.format(attr, self.doc_class.__name__))
+
+    def sum(self, attr):
+        self._check(attr)
+        value = self.values.get(sum_attr(attr))
+        if not value:
+            return 0
+        return self.doc_class._base_properties[attr].get_python_value(value)
+
+    def mean(self, attr):
+        """
+        Mean of the documents that have a value for attr.
+        """
+        self._check(attr)
+        count = self.values.get(count_attr(attr), 0)
+        if not count:
+            raise statistics.StatisticsError('mean requires at least one data point')
+        return float(self.values[sum_attr(attr)]) / int(count)
+
+    def __repr__(self):
+        return '<Aggregate: {} {}>'.format(self.doc_class.__name__, self.values)
+
+
+class AggregatingWriter(object):
+    """
+    Wraps a docb.bulk.BatchWriter so bulk writes keep the aggregates of a
+    class up to date. BatchWriteItem doesn't return the items it replaced so
+    they are read with BatchGetItem first: a concurrent write of the same
+    item between the read and the write can make the aggregates drift (see
+    Document.rebuild_aggregates).
+    """
+
+    def __init__(self, writer, doc):
+        self.writer = writer
+        self.doc = doc
+
+    def write(self, entries):
+        codec = self.doc.get_codec()
+        keys = list({(item['_doc_type']['S'], item['_id']['S']): {k: item[k] for k in codec.key_attrs}
+                     for ref, item in entries}.values())
+        old = dict()
+        if keys:
+            getter = self.doc.get_batch_getter()
+            for item in getter.get(keys):
+                old[(item['_doc_type']['S'], item['_id']['S'])] = codec.decode(item)
+        results = self.writer.write(entries)
+        items = {id(ref): item for ref, item in entries}
+        deltas = dict()
+        for ref, error in results:
+            if error is None:
+                new = codec.decode(items[id(ref)])
+                merge(deltas, get_deltas(self.doc.__class__, old.get((new['_doc_type'], new['_id'])), new))
+        self.doc.apply_aggregate_deltas(deltas)
+        return results
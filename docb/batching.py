@@ -0,0 +1,160 @@
+"""
+Dataloader-style coalescing of Document.get. Gets that arrive within a
+short window are deduplicated and read with one BatchGetItem, and each
+caller builds its own document from the item.
+
+GetBatcher is for threads: the first caller of a window waits for the
+window to pass and then reads every key that arrived meanwhile, while the
+other callers wait for their result. AsyncGetBatcher does the same for
+coroutines on an event loop and runs the read in the loop's default executor.
+"""
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from docb.bulk import BATCH_GET_SIZE
+from docb.utils import bind_context
+
+DEFAULT_WINDOW = 0.002
+
+
+def get_options(get_batching):
+    """
+    :param get_batching: A label's 'get_batching' setting: True or dict with window and max_batch keys
+    :return: dict of keyword arguments or None if batching is off
+    """
+    if not get_batching:
+        return None
+    if get_batching is True:
+        return dict()
+    return dict(get_batching)
+
+
+class GetBatcher(object):
+    """
+    Example:
+    batcher = GetBatcher(TestDocument.get_items)
+    item = batcher.load(TestDocument.get_key('ec640abfd6')['_id'])
+    """
+
+    def __init__(self, load_items, window=DEFAULT_WINDOW, max_batch=BATCH_GET_SIZE):
+        """
+        :param load_items: Callable that takes a list of long _ids and returns a dict of _id to item dict
+        :param window: Seconds the first get of a batch waits for others
+        :param max_batch: Number of keys that sends a batch right away
+        """
+        self.load_items = load_items
+        self.window = window
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        self.pending = OrderedDict()
+
+    @classmethod
+    def from_config(cls, load_items, get_batching):
+        options = get_options(get_batching)
+        if options is None:
+            return None
+        return cls(load_items, **options)
+
+    def _take(self):
+        batch, self.pending = self.pending, OrderedDict()
+        return batch
+
+    def _dispatch(self, batch):
+        try:
+            items = self.load_items(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                future.set_exception(e)
+        else:
+            for doc_id, future in batch.items():
+                future.set_result(items.get(doc_id))
+
+    def load(self, doc_id):
+        """
+        :param doc_id: Long _id
+        :return: Item dict or None if it doesn't exist
+        """
+        batch = None
+        with self.lock:
+            future = self.pending.get(doc_id)
+            leader = future is None and not self.pending
+            if future is None:
+                future = self.pending[doc_id] = Future()
+                if len(self.pending) >= self.max_batch:
+                    batch = self._take()
+        if batch is None and leader:
+            time.sleep(self.window)
+            with self.lock:
+                batch = self._take()
+        if batch:
+            self._dispatch(batch)
+        return future.result()
+
+
+class AsyncGetBatcher(object):
+    """
+    Batches the gets of one event loop. With the default window of 0 the
+    gets made in the same iteration of the loop (e.g. by coroutines started
+    with asyncio.gather) are read together.
+    """
+
+    def __init__(self, load_items, loop, window=0, max_batch=BATCH_GET_SIZE):
+        """
+        :param load_items: Callable that takes a list of long _ids and returns a dict of _id to item dict
+        :param loop: Event loop
+        :param window: Seconds the first get of a batch waits for others
+        :param max_batch: Number of keys that sends a batch right away
+        """
+        self.load_items = load_items
+        self.loop = loop
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = OrderedDict()
+        self.handle = None
+        self.tasks = set()
+
+    @classmethod
+    def from_config(cls, load_items, loop, get_batching):
+        return cls(load_items, loop, **(get_options(get_batching) or {}))
+
+    def _flush(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        batch, self.pending = self.pending, OrderedDict()
+        if batch:
+            # The loop only keeps weak references to tasks
+            task = self.loop.create_task(self._dispatch(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _dispatch(self, batch):
+        try:
+            # The read keeps the priority and session of the get that started the batch
+            items = await self.loop.run_in_executor(None, bind_context(self.load_items), list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for doc_id, future in batch.items():
+                if not future.done():
+                    future.set_result(items.get(doc_id))
+
+    async def load(self, doc_id):
+        """
+        :param doc_id: Long _id
+        :return: Item dict or None if it doesn't exist
+        """
+        import asyncio
+        future = self.pending.get(doc_id)
+        if future is None:
+            future = self.pending[doc_id] = self.loop.create_future()
+            if len(self.pending) >= self.max_batch:
+                self._flush()
+            elif self.handle is None:
+                self.handle = self.loop.call_later(self.window, self._flush)
+        # Other callers wait for the same future so one of them being cancelled mustn't cancel it
+        return await asyncio.shield(future)
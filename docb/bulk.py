@@ -0,0 +1,367 @@
+"""
+Concurrent BatchWriteItem pipeline used by BaseDocument.bulk_save, the
+process pool bulk loader used by BaseDocument.bulk_load and the concurrent
+BatchGetItem reader used for key lookups.
+"""
+import collections
+import concurrent.futures
+import itertools
+import os
+import queue
+import random
+import threading
+import time
+from collections import namedtuple
+
+from botocore.exceptions import ClientError
+
+from docb.codec import decode_value
+from docb.exceptions import DocSaveError, QueryError
+from docb.throttle import THROTTLE_ERRORS
+from docb.utils import bind_context
+
+BATCH_WRITE_SIZE = 25
+BATCH_GET_SIZE = 100
+
+BulkResult = namedtuple('BulkResult', ['doc', 'success', 'error'])
+
+_STOP = object()
+
+
+def backoff_delay(attempt, base_delay, max_delay):
+    """
+    Exponential backoff with full jitter.
+    :param attempt: Number of the retry (starting at 0)
+    :param base_delay: Delay of the first retry in seconds
+    :param max_delay: Cap on the delay in seconds
+    :return: float
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def item_key(item):
+    return item['_doc_type']['S'], item['_id']['S']
+
+
+class BatchWriter(object):
+    """
+    Writes up to 25 wire format items with BatchWriteItem. UnprocessedItems
+    and throttling errors are retried with exponential backoff and jitter.
+    """
+
+    def __init__(self, client, table_name, max_retries=8, base_delay=0.05, max_delay=5.0):
+        self.client = client
+        self.table_name = table_name
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def _send(self, items):
+        request_items = {self.table_name: [{'PutRequest': {'Item': item}} for item in items]}
+        return self.client.batch_write_item(RequestItems=request_items)
+
+    def write(self, entries):
+        """
+        :param entries: List of (ref, item) tuples
+        :return: List of (ref, error) tuples. error is None if the item was written.
+        """
+        pending = dict()
+        results = []
+        for ref, item in entries:
+            key = item_key(item)
+            if key in pending:
+                # BatchWriteItem rejects the whole batch if a key is repeated
+                results.append((ref, DocSaveError('Duplicate key {} in the same batch'.format(key))))
+            else:
+                pending[key] = (ref, item)
+        attempt = 0
+        while pending:
+            try:
+                response = self._send([item for ref, item in pending.values()])
+            except ClientError as e:
+                if e.response['Error']['Code'] not in THROTTLE_ERRORS or attempt >= self.max_retries:
+                    return results + [(ref, e) for ref, item in pending.values()]
+            else:
+                unprocessed = {item_key(r['PutRequest']['Item'])
+                               for r in response.get('UnprocessedItems', {}).get(self.table_name, [])}
+                for key in list(pending.keys()):
+                    if key not in unprocessed:
+                        results.append((pending.pop(key)[0], None))
+                if pending and attempt >= self.max_retries:
+                    error = DocSaveError('Item was still unprocessed after {} retries'.format(self.max_retries))
+                    return results + [(ref, error) for ref, item in pending.values()]
+            if pending:
+                time.sleep(backoff_delay(attempt, self.base_delay, self.max_delay))
+                attempt += 1
+        return results
+
+
+def write_batches(entries, writer, workers=4, queue_size=None):
+    """
+    Groups entries into batches and writes them with concurrent writer
+    threads. Only queue_size batches are waiting at any time so entries can be
+    a generator of any length. Results are yielded as batches finish; if the
+    generator is closed early the writer threads are stopped.
+    :param entries: Iterable of (ref, item) tuples. item may be an Exception
+    for entries that failed before they could be written.
+    :param writer: BatchWriter
+    :param workers: Number of writer threads
+    :param queue_size: Max number of batches waiting for a writer (default: 2 * workers)
+    :return: Generator of BulkResult
+    """
+    batches = queue.Queue(maxsize=queue_size or 2 * workers)
+    results = queue.Queue()
+    stopped = threading.Event()
+
+    def work():
+        while True:
+            batch = batches.get()
+            if batch is _STOP:
+                return
+            if stopped.is_set():
+                continue
+            try:
+                results.put(writer.write(batch))
+            except Exception as e:
+                results.put([(ref, e) for ref, item in batch])
+
+    def drain():
+        while True:
+            try:
+                batch_results = results.get_nowait()
+            except queue.Empty:
+                return
+            for ref, error in batch_results:
+                yield BulkResult(ref, error is None, error)
+
+    threads = [threading.Thread(target=bind_context(work), daemon=True) for i in range(workers)]
+    for t in threads:
+        t.start()
+    try:
+        batch = []
+        for ref, item in entries:
+            if isinstance(item, Exception):
+                yield BulkResult(ref, False, item)
+                continue
+            batch.append((ref, item))
+            if len(batch) == BATCH_WRITE_SIZE:
+                batches.put(batch)
+                batch = []
+                yield from drain()
+        if batch:
+            batches.put(batch)
+        for t in threads:
+            batches.put(_STOP)
+        for t in threads:
+            t.join()
+        yield from drain()
+    finally:
+        if any(t.is_alive() for t in threads):
+            stopped.set()
+            for t in threads:
+                batches.put(_STOP)
+            for t in threads:
+                t.join()
+
+
+class BatchGetter(object):
+    """
+    Reads up to 100 wire format keys with BatchGetItem. UnprocessedKeys and
+    throttling errors are retried with exponential backoff and jitter.
+    """
+
+    def __init__(self, client, table_name, max_retries=8, base_delay=0.05, max_delay=5.0):
+        self.client = client
+        self.table_name = table_name
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def get(self, keys, responses=None):
+        """
+        :param keys: List of wire format keys
+        :param responses: Optional list the raw responses are appended to
+        :return: List of wire format items (in no particular order)
+        """
+        items = []
+        pending = keys
+        attempt = 0
+        while pending:
+            try:
+                params = {'RequestItems': {self.table_name: {'Keys': pending}}}
+                if responses is not None:
+                    params['ReturnConsumedCapacity'] = 'TOTAL'
+                response = self.client.batch_get_item(**params)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in THROTTLE_ERRORS or attempt >= self.max_retries:
+                    raise
+            else:
+                if responses is not None:
+                    responses.append(response)
+                items.extend(response['Responses'].get(self.table_name, []))
+                pending = response.get('UnprocessedKeys', {}).get(self.table_name, {}).get('Keys', [])
+                if pending and attempt >= self.max_retries:
+                    raise QueryError('Keys were still unprocessed after {} retries'.format(self.max_retries))
+            if pending:
+                time.sleep(backoff_delay(attempt, self.base_delay, self.max_delay))
+                attempt += 1
+        return items
+
+
+def get_batches(keys, getter, workers=4, responses=None):
+    """
+    Splits keys into batches of 100 and reads them with concurrent threads.
+    :param keys: List of wire format keys
+    :param getter: BatchGetter
+    :param workers: Max number of concurrent BatchGetItem requests
+    :param responses: Optional list the raw responses are appended to
+    :return: List of wire format items (in no particular order)
+    """
+    batches = [keys[i:i + BATCH_GET_SIZE] for i in range(0, len(keys), BATCH_GET_SIZE)]
+    if len(batches) <= 1 or workers <= 1:
+        return [item for batch in batches for item in getter.get(batch, responses)]
+    with concurrent.futures.ThreadPoolExecutor(min(workers, len(batches))) as executor:
+        results = executor.map(bind_context(lambda batch: getter.get(batch, responses)), batches)
+        return [item for items in results for item in items]
+
+
+BulkError = namedtuple('BulkError', ['index', 'error'])
+
+
+class BulkLoadReport(object):
+    """
+    Outcome of a bulk load. errors is a list of BulkError(index, error)
+    ordered by the index of the row in the input.
+    """
+
+    def __init__(self, saved, errors):
+        self.saved = saved
+        self.errors = errors
+
+    @property
+    def failed(self):
+        return len(self.errors)
+
+    def __repr__(self):
+        return '<BulkLoadReport: saved={} failed={}>'.format(self.saved, self.failed)
+
+
+def prep_chunk(doc_class, start, rows, check_unique=True):
+    """
+    Validates and encodes a chunk of raw dicts. This runs in the worker
+    processes of bulk_load so it only takes and returns picklable values.
+    :param doc_class: Document class
+    :param start: Index of the first row in the input
+    :param rows: List of dicts
+    :param check_unique: Query the table to check unique properties
+    :return: List of (index, item, error) tuples
+    """
+    codec = doc_class.get_codec()
+    results = []
+    for index, row in enumerate(rows, start):
+        try:
+            doc = doc_class(**row).prep_doc(create_pk=True, check_unique=check_unique)
+            results.append((index, codec.encode(doc), None))
+        except Exception as e:
+            results.append((index, None, '{}: {}'.format(e.__class__.__name__, e)))
+    return results
+
+
+def iter_chunks(rows, chunk_size):
+    rows = iter(rows)
+    start = 0
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield start, chunk
+        start += len(chunk)
+
+
+class UniqueTracker(object):
+    """
+    Remembers the unique property values of the rows of a load so a value
+    that is repeated in the input is only written once. The table check in
+    the worker processes can't see rows that aren't saved yet.
+    """
+
+    def __init__(self, keys):
+        """
+        :param keys: Names of the unique properties
+        """
+        self.seen = {key: dict() for key in keys}
+
+    def check(self, index, item):
+        """
+        Records the unique values of a wire format item.
+        :param index: Index of the row in the input
+        :param item: Wire format item
+        :return: Error string if an earlier row has one of the values, else None
+        """
+        values = dict()
+        for key, seen in self.seen.items():
+            if key not in item:
+                continue
+            value = decode_value(item[key])
+            if value is None:
+                continue
+            if value in seen:
+                return 'ValidationException: There is already a {key} with the value of {value} in row {index}'\
+                    .format(key=key, value=value, index=seen[value])
+            values[key] = value
+        for key, value in values.items():
+            self.seen[key][value] = index
+        return None
+
+
+def iter_prepped(executor, doc_class, rows, chunk_size, max_pending, check_unique):
+    """
+    Submits chunks to the process pool (at most max_pending at a time) and
+    yields (index, item) entries in input order. Rows that failed validation
+    or repeat a unique value of an earlier row are yielded with a
+    DocSaveError instead of an item.
+    """
+    tracker = UniqueTracker([key for key, prop in doc_class._base_properties.items() if prop.unique]
+                            if check_unique else [])
+    pending = collections.deque()
+    chunks = iter_chunks(rows, chunk_size)
+    for start, chunk in itertools.islice(chunks, max_pending):
+        pending.append(executor.submit(prep_chunk, doc_class, start, chunk, check_unique))
+    while pending:
+        results = pending.popleft().result()
+        for start, chunk in itertools.islice(chunks, 1):
+            pending.append(executor.submit(prep_chunk, doc_class, start, chunk, check_unique))
+        for index, item, error in results:
+            if error is None:
+                error = tracker.check(index, item)
+            yield index, item if error is None else DocSaveError(error)
+
+
+def bulk_load(doc_class, rows, writer, processes=None, chunk_size=500, workers=4, queue_size=None,
+              check_unique=True, mp_context=None):
+    """
+    Pipelined bulk loader. Raw dicts are validated and encoded to wire format
+    in a process pool and the items are written by concurrent batch writers.
+    :param doc_class: Document class
+    :param rows: Iterable of dicts
+    :param writer: BatchWriter
+    :param processes: Number of worker processes (default: number of CPUs)
+    :param chunk_size: Number of rows sent to a worker process at a time
+    :param workers: Number of writer threads
+    :param queue_size: Max number of batches waiting for a writer
+    :param check_unique: Query the table to check unique properties
+    :param mp_context: multiprocessing context for the process pool
+    :return: BulkLoadReport
+    """
+    saved = 0
+    errors = []
+    processes = processes or os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(processes, mp_context=mp_context) as executor:
+        entries = iter_prepped(executor, doc_class, rows, chunk_size, 2 * processes, check_unique)
+        for result in write_batches(entries, writer, workers=workers, queue_size=queue_size):
+            if result.success:
+                saved += 1
+            else:
+                errors.append(BulkError(result.doc, str(result.error)))
+    errors.sort(key=lambda e: e.index)
+    return BulkLoadReport(saved, errors)
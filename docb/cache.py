@@ -0,0 +1,119 @@
+"""
+In-process query result cache. Entries are invalidated with a generation
+counter per _doc_type that writes bump, so invalidation never has to find
+the entries a write affects. Queries that aren't limited to one _doc_type
+(e.g. gfilter) use the ANY generation, which every write bumps.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+
+ANY = '*'
+
+
+def item_size(value):
+    """
+    Rough size of a cached value in bytes.
+    """
+    return len(json.dumps(value, default=str))
+
+
+class QueryCache(object):
+    """
+    LRU cache of query results with a TTL and a memory budget.
+    """
+
+    def __init__(self, ttl=60, max_bytes=16 * 1024 * 1024, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.generations = dict()
+        # Added to every generation so invalidate_all doesn't have to know every doc type
+        self.epoch = 0
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_config(cls, query_cache):
+        """
+        Builds a QueryCache from a label's 'query_cache' setting.
+        :param query_cache: True or dict with ttl and max_bytes keys
+        :return: QueryCache or None
+        """
+        if not query_cache:
+            return None
+        if query_cache is True:
+            return cls()
+        return cls(**query_cache)
+
+    def generation(self, doc_type):
+        return self.epoch + self.generations.get(doc_type, 0)
+
+    def invalidate(self, doc_type):
+        """
+        Makes every cached result for doc_type (and every query across doc
+        types) stale.
+        :param doc_type: _doc_type that was written
+        :return: None
+        """
+        with self.lock:
+            self.generations[doc_type] = self.generations.get(doc_type, 0) + 1
+            self.generations[ANY] = self.generations.get(ANY, 0) + 1
+
+    def invalidate_all(self):
+        with self.lock:
+            self.epoch += 1
+            self.entries.clear()
+            self.size = 0
+
+    def get(self, key, doc_type):
+        """
+        :param key: Cache key
+        :param doc_type: _doc_type the query reads or ANY
+        :return: The cached value or None
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                generation, expires, size, value = entry
+                if generation == self.generation(doc_type) and expires > self.clock():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def set(self, key, doc_type, generation, value):
+        """
+        Caches value unless doc_type was written since generation was read.
+        :param key: Cache key
+        :param doc_type: _doc_type the query reads or ANY
+        :param generation: generation(doc_type) from before the query ran
+        :param value: Query result
+        :return: None
+        """
+        size = item_size(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if generation != self.generation(doc_type):
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (generation, self.clock() + self.ttl, size, value)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        self.size -= self.entries.pop(key)[2]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
@@ -0,0 +1,179 @@
+"""
+Encodes documents straight to the DynamoDB wire format (and decodes items
+back) for the low-level client. Each Document class gets a codec built from
+its properties so known attributes skip boto3's generic type dispatch.
+"""
+import decimal
+import math
+
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+from valley.mixins import (CharVariableMixin, IntegerVariableMixin, FloatVariableMixin, BooleanMixin, DateMixin,
+                           DateTimeMixin)
+
+from docb.properties import ReferenceProperty
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+
+def property_kind(prop):
+    """
+    Returns the kind of value a property stores ('str', 'int', 'float', 'bool',
+    'date' or 'datetime') or None if it isn't one of the built in types.
+    :param prop: Property instance
+    :return: str or None
+    """
+    if isinstance(prop, BooleanMixin):
+        return 'bool'
+    if isinstance(prop, IntegerVariableMixin):
+        return 'int'
+    if isinstance(prop, FloatVariableMixin):
+        return 'float'
+    if isinstance(prop, DateTimeMixin):
+        return 'datetime'
+    if isinstance(prop, DateMixin):
+        return 'date'
+    if isinstance(prop, (CharVariableMixin, ReferenceProperty)):
+        return 'str'
+    return None
+
+
+def encode_value(value):
+    """
+    Encodes a single Python value to a DynamoDB attribute value. Floats are
+    converted to Decimals like Document.save always has.
+    :param value: Python value
+    :return: dict
+    """
+    value_type = type(value)
+    if value_type is str:
+        return {'S': value}
+    if value_type is bool:
+        return {'BOOL': value}
+    if value_type is int:
+        return {'N': str(value)}
+    if value_type is float:
+        value = decimal.Decimal(str(value))
+    return _serializer.serialize(value)
+
+
+def decode_value(attribute_value):
+    return _deserializer.deserialize(attribute_value)
+
+
+def _encode_str(value):
+    if type(value) is str:
+        return {'S': value}
+    return encode_value(value)
+
+
+def _encode_int(value):
+    if type(value) is int:
+        return {'N': str(value)}
+    return encode_value(value)
+
+
+def _encode_float(value):
+    if type(value) is float and math.isfinite(value):
+        return {'N': repr(value)}
+    return encode_value(value)
+
+
+def _encode_bool(value):
+    if type(value) is bool:
+        return {'BOOL': value}
+    return encode_value(value)
+
+
+def _decode_str(attribute_value):
+    try:
+        return attribute_value['S']
+    except KeyError:
+        return decode_value(attribute_value)
+
+
+def _decode_int(attribute_value):
+    try:
+        number = attribute_value['N']
+    except KeyError:
+        return decode_value(attribute_value)
+    try:
+        return int(number)
+    except ValueError:
+        return decimal.Decimal(number)
+
+
+def _decode_float(attribute_value):
+    try:
+        return float(attribute_value['N'])
+    except KeyError:
+        return decode_value(attribute_value)
+
+
+def _decode_bool(attribute_value):
+    try:
+        return attribute_value['BOOL']
+    except KeyError:
+        return decode_value(attribute_value)
+
+
+ENCODERS = {
+    'str': _encode_str,
+    'date': _encode_str,
+    'datetime': _encode_str,
+    'int': _encode_int,
+    'float': _encode_float,
+    'bool': _encode_bool,
+}
+
+DECODERS = {
+    'str': _decode_str,
+    'date': _decode_str,
+    'datetime': _decode_str,
+    'int': _decode_int,
+    'float': _decode_float,
+    'bool': _decode_bool,
+}
+
+
+class DocumentCodec(object):
+    """
+    Type-specialized encoder/decoder for one Document class. Attributes that
+    aren't declared properties fall back to boto3's TypeSerializer and
+    TypeDeserializer.
+    """
+    key_attrs = ('_doc_type', '_id')
+
+    def __init__(self, doc_class):
+        self.doc_class = doc_class
+        self.encoders = {'_id': _encode_str, '_doc_type': _encode_str, '_version': _encode_int}
+        self.decoders = {'_id': _decode_str, '_doc_type': _decode_str, '_version': _decode_int}
+        for key, prop in doc_class._base_properties.items():
+            kind = property_kind(prop)
+            if kind is not None:
+                self.encoders[key] = ENCODERS[kind]
+                self.decoders[key] = DECODERS[kind]
+
+    def encode(self, doc):
+        """
+        Encodes a prepared doc (see BaseDocument.prep_doc) to a wire format item.
+        :param doc: dict
+        :return: dict
+        """
+        encoders = self.encoders
+        return {key: encoders.get(key, encode_value)(value) for key, value in doc.items()}
+
+    def decode(self, item):
+        """
+        Decodes a wire format item to a dict that can be passed to the Document class.
+        :param item: dict
+        :return: dict
+        """
+        decoders = self.decoders
+        return {key: decoders.get(key, decode_value)(value) for key, value in item.items()}
+
+    def encode_key(self, key):
+        return {k: encode_value(v) for k, v in key.items()}
+
+    def decode_key(self, key):
+        return {k: decode_value(v) for k, v in key.items()}
@@ -0,0 +1,305 @@
+"""
+Columnar query results. QuerySet.to_columns streams the pages of a query
+into one typed NumPy array per field instead of building a Document per
+item, so aggregates over large results run vectorized.
+
+Missing values are masked (numpy.ma) and left out of every aggregate.
+NumPy is optional: pip install docb[numpy]
+"""
+import statistics
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+from docb.codec import property_kind
+from docb.exceptions import ImproperlyConfigured
+
+DTYPES = {
+    'int': 'int64',
+    'float': 'float64',
+    'bool': 'bool',
+    'date': 'datetime64[D]',
+    'datetime': 'datetime64[s]',
+}
+INITIAL_CAPACITY = 1024
+
+
+def require_numpy():
+    if np is None:
+        raise ImproperlyConfigured('Columnar results require NumPy. Install it with pip install numpy.')
+
+
+def get_dtype(doc_class, field):
+    """
+    :param doc_class: Document class
+    :param field: Attribute name
+    :return: NumPy dtype of the field's column (object for strings and other types)
+    """
+    prop = doc_class._base_properties.get(field)
+    kind = property_kind(prop) if prop is not None else None
+    return np.dtype(DTYPES.get(kind, object))
+
+
+def _scalar(value):
+    # NumPy scalars to the Python types (datetime64 becomes datetime/date)
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _column_values(values, dtype):
+    """
+    Converts a page of values to an array of dtype. None becomes a fill value that the mask hides.
+    """
+    if dtype == object:
+        return np.fromiter(values, dtype=object, count=len(values))
+    if dtype.kind == 'M':
+        # Stored as ISO 8601 strings with a trailing Z
+        return np.array(['NaT' if v is None else v.rstrip('Z') if isinstance(v, str) else v for v in values],
+                        dtype=dtype)
+    fill = False if dtype.kind == 'b' else 0
+    return np.array([fill if v is None else v for v in values], dtype=dtype)
+
+
+class ColumnBuilder(object):
+    """
+    Appends pages of items to preallocated arrays that double in size when
+    they are full, so a result is copied O(log n) times instead of once per page.
+    """
+
+    def __init__(self, dtypes, capacity=INITIAL_CAPACITY):
+        """
+        :param dtypes: OrderedDict of field to NumPy dtype
+        :param capacity: Initial number of rows
+        """
+        require_numpy()
+        self.dtypes = dtypes
+        self.capacity = max(capacity, 1)
+        self.size = 0
+        self.data = {field: np.empty(self.capacity, dtype=dtype) for field, dtype in dtypes.items()}
+        self.mask = {field: np.empty(self.capacity, dtype=bool) for field in dtypes}
+
+    def _grow(self, rows):
+        capacity = self.capacity
+        while capacity < rows:
+            capacity *= 2
+        if capacity == self.capacity:
+            return
+        for arrays in (self.data, self.mask):
+            for field, array in arrays.items():
+                grown = np.empty(capacity, dtype=array.dtype)
+                grown[:self.size] = array[:self.size]
+                arrays[field] = grown
+        self.capacity = capacity
+
+    def append(self, items):
+        """
+        :param items: List of decoded item dicts
+        :return: None
+        """
+        if not items:
+            return
+        end = self.size + len(items)
+        self._grow(end)
+        for field, dtype in self.dtypes.items():
+            values = [item.get(field) for item in items]
+            self.mask[field][self.size:end] = [v is None for v in values]
+            self.data[field][self.size:end] = _column_values(values, dtype)
+        self.size = end
+
+    def build(self):
+        """
+        :return: Columns of the rows appended so far
+        """
+        return Columns(OrderedDict(
+            (field, np.ma.MaskedArray(self.data[field][:self.size], mask=self.mask[field][:self.size]))
+            for field in self.dtypes))
+
+
+def from_pages(doc_class, pages, fields=None):
+    """
+    :param doc_class: Document class
+    :param pages: Iterable of lists of decoded item dicts (see Document.iter_pages)
+    :param fields: Names of the columns (default: every property of doc_class)
+    :return: Columns
+    """
+    require_numpy()
+    fields = list(fields or doc_class._base_properties.keys())
+    builder = ColumnBuilder(OrderedDict((field, get_dtype(doc_class, field)) for field in fields))
+    for items in pages:
+        builder.append(items)
+    return builder.build()
+
+
+class Columns(object):
+    """
+    A query result as a masked array per field. Aggregates skip missing
+    values and return Python values.
+
+    Example:
+    columns = TestDocument.objects().all().to_columns(['gpa', 'state'])
+    columns.mean('gpa'), columns.percentile('gpa', 90)
+    columns.group_by('state').mean('gpa')
+    """
+
+    def __init__(self, arrays):
+        """
+        :param arrays: OrderedDict of field to numpy.ma.MaskedArray
+        """
+        self.arrays = arrays
+
+    @property
+    def fields(self):
+        return list(self.arrays.keys())
+
+    def __len__(self):
+        for array in self.arrays.values():
+            return len(array)
+        return 0
+
+    def __contains__(self, field):
+        return field in self.arrays
+
+    def __getitem__(self, field):
+        try:
+            return self.arrays[field]
+        except KeyError:
+            raise KeyError('{} is not a column. The columns are {}'.format(field, self.fields))
+
+    def _values(self, field):
+        # The values that aren't missing
+        return self[field].compressed()
+
+    def count(self, field=None):
+        """
+        :param field: Count the rows that have a value for field (default: every row)
+        :return: int
+        """
+        if field is None:
+            return len(self)
+        return int(self[field].count())
+
+    def sum(self, field):
+        values = self._values(field)
+        return _scalar(values.sum()) if len(values) else 0
+
+    def mean(self, field):
+        values = self._values(field)
+        if not len(values):
+            raise statistics.StatisticsError('mean requires at least one data point')
+        return _scalar(values.mean())
+
+    def min(self, field):
+        values = self._values(field)
+        if not len(values):
+            raise ValueError('min() of {} with no values'.format(field))
+        return _scalar(values.min())
+
+    def max(self, field):
+        values = self._values(field)
+        if not len(values):
+            raise ValueError('max() of {} with no values'.format(field))
+        return _scalar(values.max())
+
+    def percentile(self, field, q):
+        """
+        :param field: Numeric field
+        :param q: Percentile (0-100) or a list of them
+        :return: float or list of floats
+        """
+        values = self._values(field)
+        if not len(values):
+            raise ValueError('percentile() of {} with no values'.format(field))
+        result = np.percentile(values, q)
+        return result.tolist() if isinstance(result, np.ndarray) else _scalar(result)
+
+    def group_by(self, field):
+        """
+        :param field: Field whose values are the groups. Rows without a value are left out.
+        :return: GroupBy
+        """
+        return GroupBy(self, field)
+
+    def __repr__(self):
+        return '<Columns: {} rows {}>'.format(len(self), self.fields)
+
+
+class GroupBy(object):
+    """
+    Aggregates of Columns per value of a field. Every method returns an
+    OrderedDict of group value (sorted) to the aggregate. Groups without any
+    value of the aggregated field get None.
+    """
+
+    def __init__(self, columns, field):
+        self.columns = columns
+        self.field = field
+        column = columns[field]
+        self.rows = ~np.ma.getmaskarray(column)
+        keys, self.inverse = np.unique(column.data[self.rows], return_inverse=True)
+        self.keys = [_scalar(key) for key in keys]
+
+    def _present(self, field):
+        # Group indexes and values of the grouped rows that have a value for field
+        column = self.columns[field][self.rows]
+        present = ~np.ma.getmaskarray(column)
+        return self.inverse[present], column.data[present]
+
+    def _sorted(self, field):
+        # Values sorted by group and value with the start and end of each group
+        groups, values = self._present(field)
+        order = np.lexsort((values, groups))
+        groups, values = groups[order], values[order]
+        indexes = np.arange(len(self.keys))
+        return values, np.searchsorted(groups, indexes, 'left'), np.searchsorted(groups, indexes, 'right')
+
+    def _result(self, values, valid=None):
+        return OrderedDict((key, _scalar(value) if valid is None or valid[i] else None)
+                           for i, (key, value) in enumerate(zip(self.keys, values)))
+
+    def count(self, field=None):
+        """
+        :param field: Count the rows that have a value for field (default: every row of the group)
+        """
+        groups = self.inverse if field is None else self._present(field)[0]
+        return self._result(np.bincount(groups, minlength=len(self.keys)))
+
+    def sum(self, field):
+        groups, values = self._present(field)
+        sums = np.zeros(len(self.keys), dtype='int64' if values.dtype.kind in 'bi' else values.dtype)
+        np.add.at(sums, groups, values)
+        return self._result(sums)
+
+    def mean(self, field):
+        groups, values = self._present(field)
+        counts = np.bincount(groups, minlength=len(self.keys))
+        sums = np.bincount(groups, weights=values.astype('float64'), minlength=len(self.keys))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self._result(sums / counts, valid=counts > 0)
+
+    def min(self, field):
+        values, starts, ends = self._sorted(field)
+        valid = ends > starts
+        return self._result(values[np.where(valid, starts, 0)] if len(values) else starts, valid=valid)
+
+    def max(self, field):
+        values, starts, ends = self._sorted(field)
+        valid = ends > starts
+        return self._result(values[np.where(valid, ends - 1, 0)] if len(values) else ends, valid=valid)
+
+    def percentile(self, field, q):
+        values, starts, ends = self._sorted(field)
+        result = OrderedDict()
+        for key, start, end in zip(self.keys, starts, ends):
+            if end > start:
+                value = np.percentile(values[start:end], q)
+                result[key] = value.tolist() if isinstance(value, np.ndarray) else _scalar(value)
+            else:
+                result[key] = None
+        return result
+
+    def __repr__(self):
+        return '<GroupBy: {} {} groups>'.format(self.field, len(self.keys))
@@ -0,0 +1,159 @@
+"""
+Generates a specialized prep_doc function for each Document class. The
+generated code unrolls the loop over _base_properties, inlines the happy path
+of valley's common validators and the value conversions of the built in
+property types. Whenever a check could fail the original validator is called
+so errors are exactly the same as the generic prep_doc.
+"""
+from collections.abc import Callable
+
+from valley.mixins import (VariableMixin, CharVariableMixin, IntegerVariableMixin, FloatVariableMixin,
+                           BooleanMixin)
+from valley.validators import (RequiredValidator, StringValidator, IntegerValidator, FloatValidator,
+                               BooleanValidator, MaxValueValidator, MinValueValidator, MaxLengthValidator,
+                               MinLengthValidator)
+
+import docb.utils
+from docb.codec import property_kind
+
+# Conditions under which a validator *might* raise. Everything else skips the call.
+VALIDATOR_GUARDS = {
+    RequiredValidator: 'not value',
+    StringValidator: 'value and not isinstance(value, str)',
+    IntegerValidator: 'value and not isinstance(value, int)',
+    FloatValidator: 'value and not isinstance(value, float)',
+    BooleanValidator: 'value is not None and not isinstance(value, bool)',
+    MaxValueValidator: 'value and isinstance(value, (float, int)) and value > {arg}',
+    MinValueValidator: 'value and isinstance(value, (float, int)) and value < {arg}',
+    MaxLengthValidator: 'value and (type(value) is not str or len(value) > {arg})',
+    MinLengthValidator: 'value and (type(value) is not str or len(value) < {arg})',
+}
+
+VALIDATOR_ARGS = {
+    MaxValueValidator: 'compare_value',
+    MinValueValidator: 'compare_value',
+    MaxLengthValidator: 'length',
+    MinLengthValidator: 'length',
+}
+
+# (python value, db value) expressions for properties that use the mixin's conversions
+CONVERSIONS = {
+    'str': (CharVariableMixin, 'str(v) if v else None', 'raw if raw else None'),
+    'int': (IntegerVariableMixin, 'int(v) if v else None', 'raw if raw else None'),
+    'float': (FloatVariableMixin, 'float(v) if v else None', 'raw if raw else None'),
+}
+
+
+def _uses(prop, mixin, method):
+    return getattr(type(prop), method) is getattr(mixin, method)
+
+
+def _validate_lines(prop, key, n, namespace):
+    if not _uses(prop, VariableMixin, 'validate'):
+        namespace['validate_{}'.format(n)] = prop.validate
+        return ['validate_{n}(v, {key!r})'.format(n=n, key=key)]
+
+    lines = ['value = v']
+    if _uses(prop, VariableMixin, 'get_default_value'):
+        default = prop.default_value
+        if isinstance(default, Callable):
+            namespace['default_{}'.format(n)] = default
+            lines += ['if not value:',
+                      '    default = default_{}()'.format(n),
+                      '    if default is not None:',
+                      '        value = default']
+        elif default is not None:
+            namespace['default_{}'.format(n)] = default
+            lines += ['if not value:',
+                      '    value = default_{}'.format(n)]
+    else:
+        namespace['default_{}'.format(n)] = prop.get_default_value
+        lines += ['if not value:',
+                  '    default = default_{}()'.format(n),
+                  '    if default is not None:',
+                  '        value = default']
+
+    for i, validator in enumerate(prop.validators):
+        name = 'validator_{}_{}'.format(n, i)
+        namespace[name] = validator.validate
+        guard = VALIDATOR_GUARDS.get(type(validator))
+        if guard is None:
+            lines.append('{}(value, {!r})'.format(name, key))
+            continue
+        if type(validator) in VALIDATOR_ARGS:
+            arg_name = '{}_arg'.format(name)
+            namespace[arg_name] = getattr(validator, VALIDATOR_ARGS[type(validator)])
+            guard = guard.format(arg=arg_name)
+        lines += ['if {}:'.format(guard),
+                  '    {}(value, {!r})'.format(name, key)]
+    return lines
+
+
+def _conversion_lines(prop, key, n, namespace):
+    kind = property_kind(prop)
+    if kind in CONVERSIONS:
+        mixin, python_expr, db_expr = CONVERSIONS[kind]
+        if not (_uses(prop, mixin, 'get_python_value') and _uses(prop, mixin, 'get_db_value')):
+            python_expr = db_expr = None
+    elif kind == 'bool' and _uses(prop, BooleanMixin, 'get_db_value'):
+        # BooleanMixin.get_python_value only returns True or False
+        namespace['python_{}'.format(n)] = prop.get_python_value
+        python_expr, db_expr = 'python_{}(v)'.format(n), 'raw'
+    else:
+        python_expr = db_expr = None
+
+    if python_expr is None:
+        namespace['python_{}'.format(n)] = prop.get_python_value
+        namespace['db_{}'.format(n)] = prop.get_db_value
+        python_expr, db_expr = 'python_{}(v)'.format(n), 'db_{}(raw)'.format(n)
+
+    lines = ['raw = {}'.format(python_expr)]
+    if prop.unique:
+        lines += ['if check_unique:',
+                  '    self.check_unique({!r}, raw)'.format(key)]
+    lines += ['if v or v is False:',
+              '    doc[{!r}] = {}'.format(key, db_expr),
+              'else:',
+              '    doc.pop({!r}, None)'.format(key)]
+    return lines
+
+
+def get_prep_doc_source(doc_class, namespace):
+    """
+    Returns the source of the prep_doc function for doc_class and fills
+    namespace with the objects it references.
+    :param doc_class: Document class
+    :param namespace: dict
+    :return: str
+    """
+    namespace['DOC_TYPE'] = docb.utils.get_doc_type(doc_class)
+    body = ['doc = self._data.copy()',
+            'get = doc.get']
+    for n, (key, prop) in enumerate(doc_class._base_properties.items()):
+        body.append('# {}'.format(key))
+        body.append('v = get({!r})'.format(key))
+        body += _validate_lines(prop, key, n, namespace)
+        body += _conversion_lines(prop, key, n, namespace)
+    body += ["doc['_doc_type'] = DOC_TYPE",
+             'if create_pk:',
+             "    doc['_id'] = self.create_pk(doc, return_pk=True)",
+             'return doc']
+    header = 'def prep_doc(self, create_pk=False, check_unique=True):\n'
+    return header + '\n'.join('    ' + line for line in body) + '\n'
+
+
+def compile_prep_doc(doc_class):
+    """
+    Compiles the prep_doc function for doc_class. The output is identical to
+    the generic loop over _base_properties it replaces.
+    :param doc_class: Document class
+    :return: function
+    """
+    namespace = dict()
+    source = get_prep_doc_source(doc_class, namespace)
+    code = compile(source, '<docb prep_doc {}>'.format(doc_class.__name__), 'exec')
+    exec(code, namespace)
+    prep_doc = namespace['prep_doc']
+    prep_doc.__qualname__ = '{}.prep_doc'.format(doc_class.__name__)
+    prep_doc.source = source
+    return prep_doc
@@ -0,0 +1,39 @@
+import valley
+import valley.contrib
+
+
+BILLING_MODE_CHOICES = {
+    'PROVISIONED':'PROVISIONED',
+    'PAY_PER_REQUEST':'PAY_PER_REQUEST'
+}
+
+STREAM_VIEW_TYPE = {
+    'KEYS_ONLY': 'KEYS_ONLY',
+    'NEW_IMAGE': 'NEW_IMAGE',
+    'OLD_IMAGE': 'OLD_IMAGE',
+    'NEW_AND_OLD_IMAGES': 'NEW_AND_OLD_IMAGES'
+}
+
+SSE_TYPE_CHOICES = {
+    'AES256': 'AES256',
+    'KMS': 'KMS'
+}
+
+
+class TableConfig(valley.contrib.Schema):
+    billing_mode = valley.CharProperty(required=True, default_value='PROVISIONED', choices=BILLING_MODE_CHOICES)
+    write_capacity = valley.IntegerProperty()
+    read_capacity = valley.IntegerProperty()
+    secondary_write_capacity = valley.IntegerProperty()
+    secondary_read_capacity = valley.IntegerProperty()
+    autoscaling = valley.BooleanProperty()
+    stream_enabled = valley.BooleanProperty()
+    stream_view_type = valley.CharProperty(default_value='NEW_AND_OLD_IMAGES', choices=STREAM_VIEW_TYPE)
+    sse_enabled = valley.BooleanProperty()
+    sse_type = valley.CharProperty(default_value='KMS', choices=SSE_TYPE_CHOICES)
+    kms_master_key_id = valley.CharProperty()
+
+
+class TableConnection(valley.contrib.Schema):
+    table = valley.CharProperty(required=True)
+    endpoint_url = valley.CharProperty()
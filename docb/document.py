@@ -1,8 +1,12 @@
+import copy
 import datetime
-import decimal
+import collections
 import hashlib
 import json
+import math
+import os
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from operator import itemgetter
 
 import boto3
@@ -10,17 +14,26 @@ from urllib.parse import urlparse
 
 from boto3.dynamodb.conditions import (Attr, And, Key, Equals, GreaterThan, LessThan, NotEquals, LessThanEquals,
                                        GreaterThanEquals, In, Between, BeginsWith, Contains, Size, AttributeType,
-                                       AttributeExists, AttributeNotExists)
+                                       AttributeExists, AttributeNotExists, ConditionBase,
+                                       ConditionExpressionBuilder)
 from botocore.exceptions import ClientError
 from valley.declarative import DeclaredVars as DV, \
     DeclarativeVariablesMetaclass as DVM
 from valley.exceptions import ValidationException
 from valley.schema import BaseSchema
 
+import docb.aggregates
+import docb.bulk
+import docb.cache
+import docb.pagination
 import docb.properties
 import docb.utils
-from docb.exceptions import ResourceError, QueryError, DocSaveError
-from .query import QueryManager
+from docb.compiler import compile_prep_doc
+from docb.codec import DocumentCodec, encode_value
+from docb.exceptions import ResourceError, QueryError, DocSaveError, VersionConflictError, BulkSaveError
+from docb.expressions import and_conditions, apply_update, condition_params, update_params
+from docb.throttle import BACKGROUND
+from .query import QueryManager, QuerySet, QueryPlan, FanOut
 
 CONDITIONS = {
     'eq': Equals,
@@ -59,16 +72,23 @@ class DeclaredVars(DV):
 class DeclarativeVariablesMetaclass(DVM):
     declared_vars_class = DeclaredVars
 
+    def __new__(cls, name, bases, attrs):
+        new_class = super(DeclarativeVariablesMetaclass, cls).__new__(cls, name, bases, attrs)
+        new_class._compiled_prep_doc = compile_prep_doc(new_class)
+        return new_class
+
 
 class BaseDocument(BaseSchema):
     """
     Base class for all Docb Documents classes.
     """
-    BUILTIN_DOC_ATTRS = ('_id', '_doc_type')
+    BUILTIN_DOC_ATTRS = ('_id', '_doc_type', '_version')
     query_manager = QueryManager
     default_index_name = '{0}-index'
     doc_id_string = '{doc_id}:id:dynamodb:{class_name}'
     index_id_string = ''
+    fan_out_workers = 8
+    max_page_read = 1000
 
     def __init__(self, **kwargs):
         self._data = self.process_schema_kwargs(kwargs)
@@ -84,6 +104,12 @@ class BaseDocument(BaseSchema):
             class_name=self.__class__.__name__, uni=self.__unicode__(),
             id=self.pk)
 
+    def __getattr__(self, name):
+        prop = self._base_properties.get(name)
+        if isinstance(prop, docb.properties.ReferenceProperty):
+            return self.get_reference(name)
+        return super(BaseDocument, self).__getattr__(name)
+
     def __setattr__(self, name, value):
         if name in list(self._base_properties.keys()):
             self._data[name] = value
@@ -100,9 +126,30 @@ class BaseDocument(BaseSchema):
         Gets the Boto3 Dynamodb Table resource
         :return:
         """
-        if self._dynamodb_cache is None:
-            self._dynamodb_cache = self.Meta.handler._tables[self.Meta.use_db]
-        return self._dynamodb_cache
+        return self.Meta.handler.get_table(self.Meta.use_db)
+
+    @property
+    def _client(self):
+        """
+        Gets a client for the label whose calls go through the handler's rate limiter
+        :return:
+        """
+        return self.Meta.handler.get_docb_client(self.Meta.use_db, doc_class=self.__class__)
+
+    @property
+    def _table_name(self):
+        return self.Meta.handler.get_table_name(self.Meta.use_db)
+
+    @classmethod
+    def get_codec(cls):
+        """
+        Returns the DocumentCodec used to talk to the low-level client. It is
+        built once per class.
+        :return: docb.codec.DocumentCodec
+        """
+        if '_codec' not in cls.__dict__:
+            cls._codec = DocumentCodec(cls)
+        return cls._codec
 
     @property
     def _connection(self):
@@ -110,9 +157,7 @@ class BaseDocument(BaseSchema):
         Gets the Boto3 Dynamodb Resource. Only used in unit tests
         :return:
         """
-        if self._connection_cache is None:
-            self._connection_cache = self.Meta.handler._connections[self.Meta.use_db]
-        return self._connection_cache
+        return self.Meta.handler.get_connection(self.Meta.use_db)
 
     @property
     def _s3(self):
@@ -133,7 +178,9 @@ class BaseDocument(BaseSchema):
             config = self.Meta.config
         except AttributeError:
             config = self.Meta.handler.config[self.Meta.use_db]['table_config']
-        table_config = docb.utils.TableConfig(**config)
+        # The table schemas need valley.contrib which is only used for deployment
+        import docb.config
+        table_config = docb.config.TableConfig(**config)
         table_config.validate()
         global_indexes = self._get_indexed_props_dict().items()
         return docb.utils.build_cf_resource(
@@ -193,36 +240,400 @@ class BaseDocument(BaseSchema):
     def evaluate(self, filters_list):
         docs_list = self.get_doc_list(filters_list)
         for doc in docs_list:
-            yield self.__class__(**doc)
+            yield self.from_item(doc)
 
     def flush_db(self):
-        kwargs = {}
+        # Only the keys are needed to delete and they are already in wire format
+        kwargs = {'TableName': self._table_name,
+                  'ProjectionExpression': '#doc_type, #id',
+                  'ExpressionAttributeNames': {'#doc_type': '_doc_type', '#id': '_id'}}
+        client = self.Meta.handler.get_docb_client(self.Meta.use_db, priority=BACKGROUND, doc_class=self.__class__)
         while True:
-            response = self._dynamodb.scan(**kwargs)
-            for doc in response['Items']:
-                self._dynamodb.delete_item(Key={'_id': doc['_id'],
-                                                '_doc_type': doc['_doc_type']})
+            response = client.scan(**kwargs)
+            for key in response['Items']:
+                client.delete_item(TableName=self._table_name, Key=key)
             if 'LastEvaluatedKey' not in response:
                 break
             else:
                 kwargs.update({'ExclusiveStartKey': response['LastEvaluatedKey']})
+        # Every doc type in the table was deleted
+        self.Meta.handler.invalidate_query_cache(self.Meta.use_db)
 
     def delete(self):
-        self._dynamodb.delete_item(Key={'_id': self._data['_id'],
-                                        '_doc_type': self._data['_doc_type']})
+        params = {'Key': self.get_codec().encode_key({'_id': self._data['_id'], '_doc_type': self._data['_doc_type']})}
+        if self.is_aggregated():
+            params['ReturnValues'] = 'ALL_OLD'
+        response = self._conditional_write('delete_item', self.get_version_condition(), **params)
+        self.invalidate_query_cache()
+        identity_map = self.Meta.handler.get_identity_map()
+        if identity_map is not None:
+            identity_map.remove(self.__class__, self._data['_id'])
+        if self.is_aggregated():
+            self._update_aggregates(response, None)
+
+    @classmethod
+    def is_versioned(cls):
+        return bool(getattr(cls.Meta, 'versioned', False))
+
+    def get_version_condition(self):
+        """
+        Returns the condition a write of a versioned document has to meet: the
+        stored _version is still the one the document was read with.
+        :return: boto3.dynamodb.conditions.ConditionBase or None if the class isn't versioned
+        """
+        if not self.is_versioned():
+            return None
+        version = self._data.get('_version')
+        if version is None:
+            return Attr('_version').not_exists()
+        return Attr('_version').eq(version)
+
+    def set_version(self, doc):
+        """
+        Increments the _version of a prepared doc of a versioned class.
+        :param doc: Prepared doc dict (see prep_doc)
+        :return: The condition the stored item has to meet or None if the class isn't versioned
+        """
+        condition = self.get_version_condition()
+        if condition is not None:
+            doc['_version'] = (self._data.get('_version') or 0) + 1
+        return condition
+
+    def _conditional_write(self, operation, condition, **params):
+        params['TableName'] = self._table_name
+        params.update(condition_params(condition))
+        try:
+            return getattr(self._client, operation)(**params)
+        except ClientError as e:
+            if condition is not None and e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                raise VersionConflictError('{} {} was changed since it was read.'.format(
+                    self.__class__.__name__, self._data.get('_id'))) from e
+            raise
+
+    @classmethod
+    def invalidate_query_cache(cls):
+        """
+        Makes the cached query results of the class' _doc_type stale.
+        :return: None
+        """
+        cls.Meta.handler.invalidate_query_cache(cls.Meta.use_db, *{docb.utils.get_doc_type(cls), cls.__name__})
+
+    @classmethod
+    def get_key(cls, pk):
+        """
+        Returns the table key of a document of the class.
+        :param pk: Short or long _id
+        :return: dict
+        """
+        if not str(pk).endswith(cls.get_doc_id('')):
+            pk = cls.get_doc_id(pk)
+        return {'_doc_type': docb.utils.get_doc_type(cls), '_id': pk}
 
     @classmethod
     def get(cls, pk):
         c = cls()
+        doc_id = cls.get_key(pk)['_id']
+        identity_map = cls.Meta.handler.get_identity_map()
+        if identity_map is not None and identity_map.get(cls, doc_id) is not None:
+            return identity_map.get(cls, doc_id)
+        batcher = cls.Meta.handler.get_batcher(cls.Meta.use_db, cls)
+        if batcher is not None:
+            item = batcher.load(doc_id)
+        else:
+            item = c._get_item({'_id': doc_id, '_doc_type': cls.__name__})
+        if item is None and doc_id != pk:
+            item = c._get_item({'_id': pk, '_doc_type': cls.__name__})
+        if item is None:
+            raise QueryError('No {} with the pk of {} found.'.format(cls.__name__, pk))
+        return cls.from_item(item)
+
+    @classmethod
+    async def aget(cls, pk):
+        """
+        Coroutine version of get. The gets of the running event loop that are
+        made at the same time are read with one BatchGetItem (see docb.batching).
+        :param pk: Short or long _id
+        :return: Document
+        """
+        import asyncio
+        doc_id = cls.get_key(pk)['_id']
+        identity_map = cls.Meta.handler.get_identity_map()
+        if identity_map is not None and identity_map.get(cls, doc_id) is not None:
+            return identity_map.get(cls, doc_id)
+        item = await cls.Meta.handler.get_async_batcher(cls.Meta.use_db, cls).load(doc_id)
+        if item is None and doc_id != pk:
+            item = await asyncio.get_running_loop().run_in_executor(
+                None, docb.utils.bind_context(cls()._get_item), {'_id': pk, '_doc_type': cls.__name__})
+        if item is None:
+            raise QueryError('No {} with the pk of {} found.'.format(cls.__name__, pk))
+        return cls.from_item(item)
+
+    @classmethod
+    def get_many(cls, pks, workers=None):
+        """
+        Reads documents by pk with concurrent BatchGetItem requests of up to
+        100 keys each. Duplicate pks are only read once.
+        :param pks: Short or long _ids
+        :param workers: Number of concurrent requests (default: fan_out_workers)
+        :return: List of documents in the order of pks (None for the ones that don't exist)
+        """
+        ids = [cls.get_key(pk)['_id'] for pk in pks]
+        docs = dict()
+        identity_map = cls.Meta.handler.get_identity_map()
+        if identity_map is not None:
+            docs = {i: identity_map.get(cls, i) for i in ids if identity_map.get(cls, i) is not None}
+        for doc_id, item in cls.get_items([i for i in ids if i not in docs], workers=workers).items():
+            docs[doc_id] = cls.from_item(item)
+        return [docs.get(i) for i in ids]
+
+    @classmethod
+    def from_item(cls, item):
+        """
+        Builds a document from a decoded item. Inside a handler.session()
+        block the instance already loaded for its key is returned instead.
+        :param item: Item dict
+        :return: Document
+        """
+        doc = cls(**item)
+        identity_map = cls.Meta.handler.get_identity_map()
+        if identity_map is None or '_id' not in item:
+            return doc
+        return identity_map.add(doc)
+
+    @classmethod
+    def get_items(cls, pks, workers=None):
+        """
+        Reads the items of pks with concurrent BatchGetItem requests (see get_many).
+        :param pks: Short or long _ids
+        :param workers: Number of concurrent requests (default: fan_out_workers)
+        :return: dict of long _id to item dict
+        """
+        c = cls()
+        codec = cls.get_codec()
+        ids = collections.OrderedDict.fromkeys(cls.get_key(pk)['_id'] for pk in pks)
+        keys = [codec.encode_key({'_doc_type': docb.utils.get_doc_type(cls), '_id': i}) for i in ids]
+        if not keys:
+            return dict()
+        getter = docb.bulk.BatchGetter(c._client, c._table_name)
+        items = docb.bulk.get_batches(keys, getter, workers=workers or cls.fan_out_workers)
+        return {item['_id']: item for item in (codec.decode(i) for i in items)}
+
+    def get_reference_id(self, name):
+        """
+        Returns the long _id a ReferenceProperty points to without reading the document.
+        :param name: Name of the ReferenceProperty
+        :return: str or None
+        """
+        return self._base_properties[name].get_id(self._data.get(name))
+
+    def get_reference(self, name):
+        """
+        Returns the document a ReferenceProperty points to. It is read with a
+        get the first time and kept on the document.
+        :param name: Name of the ReferenceProperty
+        :return: Document or None
+        """
+        value = self._data.get(name)
+        if isinstance(value, str) and value:
+            value = self._base_properties[name].get_doc_class().get(value)
+            self._data[name] = value
+        return value or None
+
+    @classmethod
+    def prefetch_references(cls, docs, fields, workers=None):
+        """
+        Loads the documents the ReferenceProperty fields of docs point to with
+        one get_many per field instead of a get per document. References to
+        documents that don't exist are left as _ids.
+        :param docs: List of documents of the class
+        :param fields: Names of ReferenceProperty fields
+        :param workers: Number of concurrent BatchGetItem requests (default: fan_out_workers)
+        :return: docs
+        """
+        for field in fields:
+            prop = cls._base_properties.get(field)
+            if not isinstance(prop, docb.properties.ReferenceProperty):
+                raise QueryError('{} is not a ReferenceProperty of {}.'.format(field, cls.__name__))
+            pending = [doc for doc in docs if isinstance(doc._data.get(field), str) and doc._data[field]]
+            if not pending:
+                continue
+            ids = [prop.get_id(doc._data[field]) for doc in pending]
+            loaded = {i: ref for i, ref in zip(ids, prop.get_doc_class().get_many(ids, workers=workers))
+                      if ref is not None}
+            for doc, i in zip(pending, ids):
+                if i in loaded:
+                    doc._data[field] = loaded[i]
+        return docs
+
+    def _get_item(self, key):
+        codec = self.get_codec()
+        response = self._client.get_item(TableName=self._table_name, Key=codec.encode_key(key))
         try:
-            obj = c.__class__(**c._dynamodb.get_item(Key={'_id':c.get_doc_id(pk),'_doc_type': cls.__name__})['Item'])
+            return codec.decode(response['Item'])
         except KeyError:
-            try:
-                obj = c.__class__(
-                    **c._dynamodb.get_item(Key={'_id': pk, '_doc_type': cls.__name__})['Item'])
-            except KeyError:
-                raise QueryError('No {} with the pk of {} found.'.format(cls.__name__, pk))
-        return obj
+            return None
+
+    def get_update_params(self, changes):
+        """
+        Returns the UpdateItem parameters (without Key) for changes. The item
+        has to exist so an update never creates a partial document.
+        :param changes: dict of values or docb.expressions.F expressions
+        :return: dict
+        """
+        params = update_params(self.__class__, changes, Attr('_id').exists(),
+                               increment_version=self.is_versioned())
+        params['TableName'] = self._table_name
+        return params
+
+    def update_item(self, key, changes, return_values='ALL_NEW'):
+        """
+        Updates a stored item with one UpdateItem call, without reading it first.
+        :param key: Key dict (see get_key)
+        :param changes: dict of values or docb.expressions.F expressions
+        :param return_values: ReturnValues of the request
+        :return: The returned attributes (decoded) or None if the item doesn't exist
+        """
+        try:
+            return self._update_item(key, self.get_update_params(changes), changes, return_values)
+        finally:
+            self.invalidate_query_cache()
+
+    def _update_item(self, key, params, changes, return_values='NONE'):
+        codec = self.get_codec()
+        aggregated = self.is_aggregated()
+        # The aggregates need the item before the update. The new item is computed from it
+        params = dict(params, Key=codec.encode_key(key), ReturnValues='ALL_OLD' if aggregated else return_values)
+        try:
+            response = self._client.update_item(**params)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return None
+            raise
+        if not aggregated:
+            return codec.decode(response.get('Attributes', {}))
+        old = codec.decode(response['Attributes'])
+        new = apply_update(self.__class__, old, changes, increment_version=self.is_versioned())
+        self.apply_aggregate_deltas(docb.aggregates.get_deltas(self.__class__, old, new))
+        return new
+
+    def bulk_update(self, filters, changes, workers=None):
+        """
+        Applies changes to every document a QuerySet matches. Keys are streamed
+        page by page and updated concurrently without reading the documents again.
+        :param filters: QuerySet object
+        :param changes: dict of values or docb.expressions.F expressions
+        :param workers: Number of concurrent UpdateItem calls (default: fan_out_workers)
+        :return: Number of documents updated
+        """
+        workers = workers or self.fan_out_workers
+        params = self.get_update_params(changes)
+        count = 0
+        pending = collections.deque()
+        identity_map = self.Meta.handler.get_identity_map()
+        update_item = docb.utils.bind_context(self._update_item)
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for items in self.iter_pages(filters):
+                    for item in items:
+                        if identity_map is not None:
+                            # Loaded instances would be stale
+                            identity_map.remove(self.__class__, item['_id'])
+                        key = {'_doc_type': item['_doc_type'], '_id': item['_id']}
+                        pending.append(executor.submit(update_item, key, params, changes))
+                        # Keep the number of keys waiting for a worker bounded
+                        while len(pending) > workers * 2:
+                            count += pending.popleft().result() is not None
+                while pending:
+                    count += pending.popleft().result() is not None
+        finally:
+            self.invalidate_query_cache()
+        return count
+
+    @classmethod
+    def is_aggregated(cls):
+        return docb.aggregates.get_config(cls) is not None
+
+    @classmethod
+    def get_aggregate_doc_type(cls):
+        return docb.utils.get_doc_type(cls) + docb.aggregates.AGGREGATE_SUFFIX
+
+    def _update_aggregates(self, response, new):
+        old = response.get('Attributes')
+        if old is not None:
+            old = self.get_codec().decode(old)
+        self.apply_aggregate_deltas(docb.aggregates.get_deltas(self.__class__, old, new))
+
+    def apply_aggregate_deltas(self, deltas):
+        """
+        Adds deltas to the aggregate items with atomic ADD updates.
+        :param deltas: dict of aggregate _id to dict of attribute to number (see docb.aggregates.get_deltas)
+        :return: None
+        """
+        doc_type = self.get_aggregate_doc_type()
+        for agg_id, values in deltas.items():
+            values = {attr: value for attr, value in values.items() if value != 0}
+            if not values:
+                continue
+            params = docb.aggregates.update_params(values)
+            self._client.update_item(TableName=self._table_name, Key=self.get_codec().encode_key(
+                {'_doc_type': doc_type, '_id': agg_id}), **params)
+
+    def get_aggregate(self, filters):
+        """
+        Returns the aggregate that matches a QuerySet: all() or a filter on
+        one group_by property. Queries with a limit, start key or pagination
+        don't match.
+        :param filters: QuerySet object
+        :return: docb.aggregates.Aggregate or None
+        """
+        config = docb.aggregates.get_config(self.__class__)
+        if config is None or filters.global_index or filters.limit or filters.start_key or filters.paginated:
+            return None
+        q = dict(filters.q or {})
+        if q.pop('_doc_type', None) != self.__class__.__name__ or len(q) > 1:
+            return None
+        agg_id = docb.aggregates.TOTAL_ID
+        if q:
+            name, value = q.popitem()
+            if name not in config[1] or isinstance(value, (list, set, tuple)):
+                return None
+            prop = self._base_properties[name]
+            agg_id = docb.aggregates.group_id(name, prop.get_db_value(prop.get_python_value(value)))
+        item = self._get_item({'_doc_type': self.get_aggregate_doc_type(), '_id': agg_id})
+        return docb.aggregates.Aggregate(self.__class__, item or dict())
+
+    def rebuild_aggregates(self):
+        """
+        Recomputes the aggregates from every document of the class and
+        replaces the aggregate items. Use it after declaring aggregates on a
+        class with existing documents or if they drifted (e.g. a write failed
+        after the document was saved). Writes made while it runs can be lost.
+        :return: Number of aggregate items written
+        """
+        totals = dict()
+        with self.Meta.handler.background():
+            for items in self.iter_pages(self.objects().all()):
+                for item in items:
+                    docb.aggregates.merge(totals, docb.aggregates.contributions(self.__class__, item))
+            client = self._client
+            doc_type = self.get_aggregate_doc_type()
+            kwargs = {'TableName': self._table_name,
+                      'KeyConditionExpression': '#doc_type = :doc_type',
+                      'ProjectionExpression': '#doc_type, #id',
+                      'ExpressionAttributeNames': {'#doc_type': '_doc_type', '#id': '_id'},
+                      'ExpressionAttributeValues': {':doc_type': {'S': doc_type}}}
+            while True:
+                response = client.query(**kwargs)
+                for key in response['Items']:
+                    if key['_id']['S'] not in totals:
+                        client.delete_item(TableName=self._table_name, Key=key)
+                if 'LastEvaluatedKey' not in response:
+                    break
+                kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+            for agg_id, values in totals.items():
+                item = dict(values, _doc_type=doc_type, _id=agg_id)
+                client.put_item(TableName=self._table_name, Item=self.get_codec().encode(item))
+        return len(totals)
 
     # CRUD Operations
     def save(self):
@@ -232,50 +643,251 @@ class BaseDocument(BaseSchema):
             self.create_pk(doc)
             doc['_id'] = self._id
 
-        for key, value in doc.items():
-            if type(value) == float:
-                doc[key] = decimal.Decimal(str(value))
-
-        self._dynamodb.put_item(Item=doc)
+        condition = self.set_version(doc)
+        params = {'Item': self.get_codec().encode(doc)}
+        if self.is_aggregated():
+            params['ReturnValues'] = 'ALL_OLD'
+        response = self._conditional_write('put_item', condition, **params)
+        self.invalidate_query_cache()
+        if self.is_aggregated():
+            self._update_aggregates(response, doc)
 
         self._data = doc
+        identity_map = self.Meta.handler.get_identity_map()
+        if identity_map is not None:
+            identity_map.put(self)
 
-    def bulk_save(self, doc_list):
+    def bulk_save(self, doc_list, workers=None, queue_size=None, max_retries=8):
+        """
+        Saves documents with BatchWriteItem. Unprocessed items are retried
+        with exponential backoff and jitter. Every doc is written before it returns.
+        :param doc_list: Documents to save. Can be any iterable (or generator) if workers is set.
+        :param workers: Number of concurrent batch writers (see iter_bulk_save). If set, docs that fail don't stop
+        the others and a docb.exceptions.BulkSaveError with every failure is raised once all of them are written.
+        :param queue_size: Max number of 25 item batches waiting for a writer (default: 2 * workers)
+        :param max_retries: Number of times unprocessed or throttled items are retried
+        :return: List of the saved documents
+        """
+        if workers:
+            saved = []
+            failed = []
+            for result in self.iter_bulk_save(doc_list, workers=workers, queue_size=queue_size,
+                                              max_retries=max_retries):
+                (saved if result.success else failed).append(result)
+            if failed:
+                raise BulkSaveError('{} of {} documents were not saved'.format(len(failed), len(saved) + len(failed)),
+                                    failed)
+            return [result.doc for result in saved]
+        writer = self.get_batch_writer(max_retries=max_retries)
         prep_doc_obj_list = []
-        with self._dynamodb.batch_writer() as batch:
-            for i in doc_list:
+        batch = []
+        for i in doc_list:
+            with self.Meta.handler.background():
                 doc = i.prep_doc(create_pk=True)
-                prep_doc_obj_list.append(i)
-                batch.put_item(Item=doc)
+            i._set_pk(doc['_id'])
+            prep_doc_obj_list.append(i)
+            batch.append((i, i.get_codec().encode(doc)))
+            if len(batch) == docb.bulk.BATCH_WRITE_SIZE:
+                self._write_batch(writer, batch)
+                batch = []
+        if batch:
+            self._write_batch(writer, batch)
         return prep_doc_obj_list
 
+    def iter_bulk_save(self, doc_list, workers=4, queue_size=None, max_retries=8):
+        """
+        Streams docs through bounded queues to concurrent batch writers and
+        yields the result of each doc as its batch is written. Docs are only
+        read and written as the generator is consumed.
+        :param doc_list: Any iterable (or generator) of documents
+        :param workers: Number of concurrent batch writers
+        :param queue_size: Max number of 25 item batches waiting for a writer (default: 2 * workers)
+        :param max_retries: Number of times unprocessed or throttled items are retried
+        :return: Generator of docb.bulk.BulkResult(doc, success, error)
+        """
+        writer = self.get_batch_writer(max_retries=max_retries)
+        return self._invalidating(docb.bulk.write_batches(self._iter_bulk_items(doc_list), writer,
+                                                          workers=workers, queue_size=queue_size))
+
+    def _invalidating(self, results):
+        identity_map = self.Meta.handler.get_identity_map()
+        for result in results:
+            if result.success:
+                self.invalidate_query_cache()
+                if identity_map is not None:
+                    identity_map.put(result.doc)
+            yield result
+
+    def bulk_load(self, rows, processes=None, chunk_size=500, workers=4, queue_size=None, check_unique=True,
+                  max_retries=8, mp_context=None):
+        """
+        Loads raw dicts with a pipeline that validates and serializes them in a
+        process pool (so the CPU work scales with cores) and writes them with
+        concurrent batch writers.
+        :param rows: Iterable of dicts
+        :param processes: Number of worker processes (default: number of CPUs)
+        :param chunk_size: Number of rows sent to a worker process at a time
+        :param workers: Number of concurrent batch writers
+        :param queue_size: Max number of 25 item batches waiting for a writer
+        :param check_unique: Query the table to check unique properties
+        :param max_retries: Number of times unprocessed or throttled items are retried
+        :param mp_context: multiprocessing context for the process pool. The document class must be importable
+        and have its handler set in the worker processes if it isn't a fork context.
+        :return: docb.bulk.BulkLoadReport
+        """
+        try:
+            return docb.bulk.bulk_load(self.__class__, rows, self.get_batch_writer(max_retries=max_retries),
+                                       processes=processes, chunk_size=chunk_size, workers=workers,
+                                       queue_size=queue_size, check_unique=check_unique, mp_context=mp_context)
+        finally:
+            self.invalidate_query_cache()
+
+    def get_batch_writer(self, **kwargs):
+        client = self.Meta.handler.get_docb_client(self.Meta.use_db, priority=BACKGROUND, doc_class=self.__class__)
+        writer = docb.bulk.BatchWriter(client, self._table_name, **kwargs)
+        if self.is_aggregated():
+            return docb.aggregates.AggregatingWriter(writer, self)
+        return writer
+
+    def get_batch_getter(self, **kwargs):
+        client = self.Meta.handler.get_docb_client(self.Meta.use_db, priority=BACKGROUND, doc_class=self.__class__)
+        return docb.bulk.BatchGetter(client, self._table_name, **kwargs)
+
+    def _write_batch(self, writer, batch):
+        results = writer.write(batch)
+        self.invalidate_query_cache()
+        identity_map = self.Meta.handler.get_identity_map()
+        for doc, error in results:
+            if error is not None:
+                raise error
+            if identity_map is not None:
+                identity_map.put(doc)
+
+    def _iter_bulk_items(self, doc_list):
+        for doc in doc_list:
+            try:
+                with self.Meta.handler.background():
+                    prepped = doc.prep_doc(create_pk=True)
+            except (ValidationException, ValueError) as e:
+                yield doc, e
+                continue
+            doc._set_pk(prepped['_id'])
+            yield doc, doc.get_codec().encode(prepped)
+
     @classmethod
     def objects(cls):
         return cls.query_manager(cls)
 
     # Indexing Methods
-    def get_more_docs(self, response, query_params, result):
+    def get_more_docs(self, response, query_params, result, page=None):
         query_params.update(
             {'ExclusiveStartKey': response['LastEvaluatedKey']})
-        return self._query(query_params)
+        return self._query(query_params, page=page)
 
-    def _query(self, query_params):
-        return self._dynamodb.query(**query_params)
+    def _query(self, query_params, page=1):
+        codec = self.get_codec()
+        response = self.Meta.handler.call(self.Meta.use_db, 'query', self.compile_query_params(query_params),
+                                          doc_class=self.__class__, page=page)
+        response['Items'] = [codec.decode(i) for i in response['Items']]
+        if 'LastEvaluatedKey' in response:
+            response['LastEvaluatedKey'] = codec.decode_key(response['LastEvaluatedKey'])
+        return response
 
-    def get_doc_list(self, filters):
+    def compile_query_params(self, query_params):
+        """
+        Compiles query params built with boto3 conditions (see build_query_params) to the expression strings,
+        placeholders and wire format values the low-level client expects.
+        :param query_params: Dict containing query parameters
+        :return: dict
+        """
+        builder = ConditionExpressionBuilder()
+        params = {'TableName': self._table_name}
+        names = dict()
+        values = dict()
+        for key, value in query_params.items():
+            if key in ('KeyConditionExpression', 'FilterExpression') and isinstance(value, ConditionBase):
+                built = builder.build_expression(value, is_key_condition=key == 'KeyConditionExpression')
+                params[key] = built.condition_expression
+                names.update(built.attribute_name_placeholders)
+                values.update(built.attribute_value_placeholders)
+            elif key == 'ExclusiveStartKey':
+                params[key] = self.get_codec().encode_key(value)
+            else:
+                params[key] = value
+        if names:
+            params['ExpressionAttributeNames'] = names
+        if values:
+            params['ExpressionAttributeValues'] = {k: encode_value(v) for k, v in values.items()}
+        return params
+
+    def get_doc_list(self, filters, responses=None):
+        """
+        Runs the query for a QuerySet and returns the items of every page.
+        Results come from the label's query cache if it has one.
+        :param filters: QuerySet object
+        :param responses: Optional list the raw response of each page is appended to
+        :return: List of dicts
+        """
+        cache = self.Meta.handler.get_query_cache(self.Meta.use_db) if responses is None else None
+        if cache is None:
+            return self._get_doc_list(filters, responses)
+        key = self.get_query_cache_key(filters)
+        doc_type = filters.q.get('_doc_type') if filters.q else None
+        if not isinstance(doc_type, str) or filters.global_index:
+            doc_type = docb.cache.ANY
+        generation = cache.generation(doc_type)
+        cached = cache.get(key, doc_type)
+        if cached is None:
+            cached = (self._get_doc_list(filters), filters.last_evaluated_key)
+            cache.set(key, doc_type, generation, cached)
+        items, filters.last_evaluated_key = cached
+        # Lists and maps in the items mustn't be shared with the cache
+        return copy.deepcopy(items)
+
+    def get_query_cache_key(self, filters):
+        """
+        Query cache key made of the label and document class, the compiled
+        query parameters (or those of the lookups of a fan-out) and the
+        settings applied after the query. Classes sharing a table get their
+        own entries since the items are decoded with the class' codec.
+        :param filters: QuerySet object
+        :return: str
+        """
+        fan_out = self.plan_fan_out(filters)
+        if fan_out is None:
+            params = self.compile_query_params(self.build_query(filters))
+        elif fan_out.keys is not None:
+            params = fan_out.keys
+        else:
+            params = [self.compile_query_params(self.build_query(qs)) for qs in fan_out.querysets]
+        return json.dumps([self.Meta.use_db, self.__class__.__name__, params, filters.limit, filters.paginated,
+                           filters.sort_attr, filters.sort_reverse], sort_keys=True, default=str)
+
+    def _get_doc_list(self, filters, responses=None):
+        fan_out = self.plan_fan_out(filters)
+        if fan_out is not None:
+            return self.get_fan_out_doc_list(filters, fan_out, responses=responses)
         query_params = self.build_query(filters)
+        if responses is not None:
+            query_params['ReturnConsumedCapacity'] = 'TOTAL'
         response = self._query(query_params)
+        if responses is not None:
+            responses.append(response)
         result = response['Items']
         if 'LastEvaluatedKey' in response:
             filters.last_evaluated_key = response['LastEvaluatedKey']
         # Query with paginated = True and set limit
         if not filters.paginated:
+            page = 1
             while 'LastEvaluatedKey' in response:
                 current_count = len(result)
                 if filters.limit and current_count >= filters.limit:
                     break
                 query_params = self.get_limit(filters, query_params, current_count=current_count)
-                response = self.get_more_docs(response, query_params, response)
+                page += 1
+                response = self.get_more_docs(response, query_params, response, page=page)
+                if responses is not None:
+                    responses.append(response)
                 result.extend(response['Items'])
                 try:
                     filters.last_evaluated_key = response['LastEvaluatedKey']
@@ -285,6 +897,278 @@ class BaseDocument(BaseSchema):
             return sorted(result, key=itemgetter(filters.sort_attr), reverse=filters.sort_reverse)
         return result
 
+    def explain(self, filters, analyze=False):
+        """
+        Returns the plan of a QuerySet: the compiled query request and the
+        filters that run as a post-read FilterExpression.
+        :param filters: QuerySet object
+        :param analyze: Run the query and add the scanned and returned counts, pages and consumed capacity
+        :return: docb.query.QueryPlan
+        """
+        fan_out = self.plan_fan_out(filters)
+        if fan_out is None:
+            plan = self._explain_query(filters)
+        elif fan_out.keys is not None:
+            plan = QueryPlan(self.__class__.__name__, {'TableName': self._table_name}, max_results=filters.limit,
+                             sort_attr=filters.sort_attr, sort_reverse=filters.sort_reverse)
+        else:
+            plan = self._explain_query(fan_out.querysets[0])
+            plan.max_results, plan.sort_attr, plan.sort_reverse = filters.limit, filters.sort_attr, filters.sort_reverse
+        if fan_out is not None:
+            plan.set_fan_out(fan_out)
+        if analyze:
+            responses = []
+            self.get_doc_list(filters, responses=responses)
+            plan.set_analysis(responses)
+        return plan
+
+    def _explain_query(self, filters):
+        index_name, key_condition_expressions, post_filters = self.plan_query(filters)
+        params = self.compile_query_params(self.build_query(filters))
+        index_prop = self._get_indexed_props_dict().get(index_name, {}).get('name')
+        return QueryPlan(self.__class__.__name__, params, post_filters=list(post_filters.keys()),
+                         paginate_by=filters.paginate_by, paginated=filters.paginated,
+                         max_results=filters.limit, sort_attr=filters.sort_attr, sort_reverse=filters.sort_reverse,
+                         estimated_read_units=self.estimate_index_cost(index_prop) if index_prop else None)
+
+    def plan_fan_out(self, filters):
+        """
+        Splits an __in filter on _id, pk or an indexed property into one key
+        lookup per value. Lookups by key without other filters use
+        BatchGetItem, everything else runs one key query per value.
+        DynamoDB only allows 100 operands in an IN FilterExpression and
+        evaluates it after reading the whole partition.
+        :param filters: QuerySet object
+        :return: docb.query.FanOut or None if the query can't be split
+        """
+        if filters.paginated or filters.start_key:
+            return None
+        indexes = self.get_indexes()
+        indexed_props = self._get_indexed_props_dict()
+        for key, values in filters.q.items():
+            prop, cond = self.get_condition(key)
+            if not issubclass(cond, In):
+                continue
+            if prop in ('_id', 'pk'):
+                break
+            if prop in indexes and prop != '_doc_type' and (
+                    not filters.index_name or indexed_props[filters.index_name]['name'] == prop):
+                break
+        else:
+            return None
+
+        values = list(dict.fromkeys(values if isinstance(values, (list, tuple, set)) else [values]))
+        rest = {k: v for k, v in filters.q.items() if k != key}
+        if prop in ('_id', 'pk'):
+            rest.setdefault('_doc_type', self.__class__.__name__)
+            doc_type = rest['_doc_type']
+            if list(rest.keys()) == ['_doc_type'] and isinstance(doc_type, str):
+                codec = self.get_codec()
+                keys = [codec.encode_key({'_doc_type': doc_type, '_id': self.get_doc_id(v) if prop == 'pk' else v})
+                        for v in values]
+                return FanOut(prop, values, keys, None)
+            querysets = [QuerySet(self.__class__, dict(rest, **{prop: v}), limit=filters.limit,
+                                  paginate_by=filters.paginate_by) for v in values]
+        else:
+            index_name = filters.index_name or next(k for k, v in indexed_props.items() if v['name'] == prop)
+            querysets = [QuerySet(self.__class__, dict(rest, **{prop: v}), global_index=True, index_name=index_name,
+                                  limit=filters.limit, paginate_by=filters.paginate_by) for v in values]
+        return FanOut(prop, values, None, querysets)
+
+    def get_fan_out_doc_list(self, filters, fan_out, responses=None):
+        """
+        Runs the lookups of a FanOut concurrently and merges the items.
+        :param filters: QuerySet object
+        :param fan_out: docb.query.FanOut
+        :param responses: Optional list the raw response of each request is appended to
+        :return: List of dicts without duplicates
+        """
+        workers = max(1, min(self.fan_out_workers, len(fan_out.values)))
+        if fan_out.keys is not None:
+            codec = self.get_codec()
+            getter = docb.bulk.BatchGetter(self._client, self._table_name)
+            items = [codec.decode(i) for i in docb.bulk.get_batches(fan_out.keys, getter, workers=workers,
+                                                                     responses=responses)]
+            order = {codec.decode_key(k)['_id']: i for i, k in enumerate(fan_out.keys)}
+            result = sorted(items, key=lambda i: order.get(i['_id'], 0))
+        else:
+            get_doc_list = docb.utils.bind_context(lambda qs: self._get_doc_list(qs, responses=responses))
+            with ThreadPoolExecutor(workers) as executor:
+                pages = list(executor.map(get_doc_list, fan_out.querysets))
+            seen = set()
+            result = []
+            for items in pages:
+                for item in items:
+                    key = (item['_doc_type'], item['_id'])
+                    if key not in seen:
+                        seen.add(key)
+                        result.append(item)
+        if filters.limit:
+            result = result[:filters.limit]
+        if filters.sort_attr:
+            return sorted(result, key=itemgetter(filters.sort_attr), reverse=filters.sort_reverse)
+        return result
+
+    def iter_pages(self, filters, prefetch=0):
+        """
+        Yields the items of a QuerySet one page at a time instead of reading
+        every page first. Sorted and fan-out queries are yielded as one page.
+        :param filters: QuerySet object
+        :param prefetch: Number of pages fetched ahead of the consumer on a background thread
+        :return: Generator of lists of dicts
+        """
+        if filters.sort_attr or self.plan_fan_out(filters) is not None:
+            yield self.get_doc_list(filters)
+            return
+        pages = self._fetch_pages(filters)
+        if prefetch:
+            pages = docb.pagination.prefetch(pages, prefetch)
+        try:
+            yield from pages
+        finally:
+            pages.close()
+
+    def iter_scan_pages(self, filters, segment, total_segments):
+        """
+        Yields the items of one segment of a parallel Scan with the filters
+        of a QuerySet. The key conditions of the query become part of the
+        FilterExpression, so every item of the table (or index) is read.
+        :param filters: QuerySet object
+        :param segment: Segment number (0 to total_segments - 1)
+        :param total_segments: Number of segments the table is split into
+        :return: Generator of lists of dicts
+        """
+        # Checked before the first page is read so export fails before it opens any file
+        if filters.sort_attr or filters.limit or filters.paginated or filters.start_key:
+            raise QueryError('Parallel scans can not be used with sort_attr, limit, paginated or start_key.')
+        if self.plan_fan_out(filters) is not None:
+            raise QueryError('Parallel scans can not be used with __in lookups.')
+        return self._scan_pages(filters, segment, total_segments)
+
+    def _scan_pages(self, filters, segment, total_segments):
+        query_params = self.build_query(filters)
+        scan_params = {'Segment': segment, 'TotalSegments': total_segments}
+        scan_params.update({k: v for k, v in query_params.items() if k in ('IndexName', 'Limit')})
+        scan_params['FilterExpression'] = and_conditions(query_params.get('KeyConditionExpression'),
+                                                         query_params.get('FilterExpression'))
+        codec = self.get_codec()
+        page = 1
+        while True:
+            response = self.Meta.handler.call(self.Meta.use_db, 'scan', self.compile_query_params(scan_params),
+                                              doc_class=self.__class__, page=page)
+            yield [codec.decode(i) for i in response['Items']]
+            if 'LastEvaluatedKey' not in response:
+                return
+            scan_params['ExclusiveStartKey'] = codec.decode_key(response['LastEvaluatedKey'])
+            page += 1
+
+    def iter_cursor_pages(self, filters, page_size):
+        """
+        Yields docb.pagination.Page objects of page_size documents with a
+        signed cursor for the next page. Pages that a FilterExpression made
+        shorter are topped up, reading more items per request when the filter
+        is selective.
+        :param filters: QuerySet object
+        :param page_size: Number of documents per page
+        :return: Generator of Page
+        """
+        if filters.sort_attr:
+            raise QueryError('Cursor pagination can not be used with sort_attr.')
+        if self.plan_fan_out(filters) is not None:
+            raise QueryError('Cursor pagination can not be used with __in lookups.')
+        index_name, key_condition_expressions, post_filters = self.plan_query(filters)
+        index_prop = self._get_indexed_props_dict().get(index_name, {}).get('name')
+        query_params = self.build_query(filters)
+        buffer = []
+        exhausted = False
+        scanned = returned = total = 0
+        page = 0
+        first = True
+        while True:
+            size = page_size
+            if filters.limit:
+                size = min(size, filters.limit - total)
+            while len(buffer) < size and not exhausted:
+                needed = size - len(buffer)
+                # Read enough items to fill the page at the selectivity of the filter so far
+                selectivity = returned / scanned if scanned and returned else (1.0 if not scanned else 0.1)
+                query_params['Limit'] = min(max(needed, math.ceil(needed / selectivity)), self.max_page_read)
+                page += 1
+                response = self._query(query_params, page=page)
+                buffer.extend(response['Items'])
+                scanned += response.get('ScannedCount', len(response['Items']))
+                returned += len(response['Items'])
+                if 'LastEvaluatedKey' in response:
+                    query_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+                else:
+                    exhausted = True
+            items, buffer = buffer[:size], buffer[size:]
+            total += len(items)
+            if filters.limit and total >= filters.limit:
+                cursor = None
+            elif buffer:
+                cursor = self.get_cursor_key(items[-1], index_prop)
+            elif not exhausted:
+                cursor = query_params['ExclusiveStartKey']
+            else:
+                cursor = None
+            if cursor is not None:
+                cursor = self.encode_cursor(filters, cursor)
+            # The last LastEvaluatedKey can point past the final item, so skip the empty page it leads to
+            if items or first:
+                docs = self.prefetch_references([self.from_item(i) for i in items], filters.prefetch_fields)
+                yield docb.pagination.Page(docs, cursor)
+            first = False
+            if cursor is None:
+                return
+
+    def get_cursor_key(self, item, index_prop=None):
+        key = {'_doc_type': item['_doc_type'], '_id': item['_id']}
+        if index_prop:
+            key[index_prop] = item[index_prop]
+        return key
+
+    def get_cursor_scope(self, filters):
+        return json.dumps([self.__class__.__name__, filters.q, filters.global_index, filters.index_name],
+                          sort_keys=True, default=str)
+
+    def encode_cursor(self, filters, key):
+        """
+        :param filters: QuerySet object the cursor is for
+        :param key: ExclusiveStartKey
+        :return: Signed, URL-safe cursor
+        """
+        return docb.pagination.encode_cursor(self.get_codec().encode_key(key),
+                                             self.Meta.handler.get_cursor_secret(self.Meta.use_db),
+                                             self.get_cursor_scope(filters))
+
+    def decode_cursor(self, filters, cursor):
+        """
+        :param filters: QuerySet object the cursor is for
+        :param cursor: Cursor made by encode_cursor
+        :return: ExclusiveStartKey
+        """
+        return self.get_codec().decode_key(docb.pagination.decode_cursor(
+            cursor, self.Meta.handler.get_cursor_secret(self.Meta.use_db), self.get_cursor_scope(filters)))
+
+    def _fetch_pages(self, filters):
+        query_params = self.build_query(filters)
+        count = 0
+        page = 1
+        while True:
+            response = self._query(query_params, page=page)
+            items = response['Items']
+            if filters.limit:
+                items = items[:filters.limit - count]
+            count += len(items)
+            filters.last_evaluated_key = response.get('LastEvaluatedKey')
+            yield items
+            if 'LastEvaluatedKey' not in response or filters.paginated or (filters.limit and count >= filters.limit):
+                return
+            query_params = self.get_limit(filters, query_params, current_count=count)
+            query_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+            page += 1
+
     def get_limit(self, filters, query_params, current_count=None):
         """
         Sets the Limit key in the query_params
@@ -339,8 +1223,26 @@ class BaseDocument(BaseSchema):
         :param filters: QuerySet object
         :return: Query dict
         """
-        filters_dict = filters.q
+        index_name, key_condition_expressions, post_filters = self.plan_query(filters)
         filter_expressions = list()
+        for k, v in post_filters.items():
+            prop, cond = self.get_condition(k)
+            if issubclass(cond, (Between,)):
+                filter_expressions.append(cond(Attr(prop), *v))
+            elif issubclass(cond, (AttributeNotExists, AttributeExists)):
+                filter_expressions.append(cond(Attr(prop)))
+            else:
+                filter_expressions.append(cond(Attr(prop), v))
+        return self.build_query_params(filter_expressions, key_condition_expressions, index_name, filters)
+
+    def plan_query(self, filters):
+        """
+        Splits the filters of a QuerySet into key conditions and the filters
+        that run as a FilterExpression after the items are read.
+        :param filters: QuerySet object
+        :return: (index_name, key_condition_expressions, post_filters dict)
+        """
+        filters_dict = dict(filters.q)
         key_condition_expressions = list()
         index_name, key_name, key_value = self.get_index_name(filters)
 
@@ -361,16 +1263,7 @@ class BaseDocument(BaseSchema):
         else:
             key_condition_expressions.append(CONDITIONS['eq'](Key(key_name), key_value))
             filters_dict.pop(key_name)
-
-        for k, v in filters_dict.items():
-            prop, cond = self.get_condition(k)
-            if issubclass(cond, (Between,)):
-                filter_expressions.append(cond(Attr(prop), *v))
-            elif issubclass(cond, (AttributeNotExists, AttributeExists)):
-                filter_expressions.append(cond(Attr(prop)))
-            else:
-                filter_expressions.append(cond(Attr(prop), v))
-        return self.build_query_params(filter_expressions, key_condition_expressions, index_name, filters)
+        return index_name, key_condition_expressions, filters_dict
 
     def add_expressions(self, expressions):
         if len(expressions) > 1:
@@ -405,12 +1298,36 @@ class BaseDocument(BaseSchema):
             name = self._get_indexed_props_dict()[filters.index_name]['name']
             return filters.index_name, name, filters.q[name]
         indexes = self.get_indexes()
+        candidates = dict()
         for k, v in filters.q.items():
             prop, cond = self.get_condition(k)
-            prop_obj = self._base_properties.get(prop)
-            if prop in indexes and issubclass(cond, Equals):
-                return prop_obj.index_name or self.default_index_name.format(prop), prop, v
-        raise QueryError('All gfilter queries must have a global secondary index that uses the Equals condition.')
+            if prop in indexes and issubclass(cond, Equals) and prop not in candidates:
+                candidates[prop] = v
+        if not candidates:
+            raise QueryError('All gfilter queries must have a global secondary index that uses the Equals condition.')
+        prop = self.choose_index(tuple(candidates.keys()))
+        prop_obj = self._base_properties.get(prop)
+        return prop_obj.index_name or self.default_index_name.format(prop), prop, candidates[prop]
+
+    def choose_index(self, props):
+        """
+        Picks the indexed property with the lowest estimated read cost (see
+        get_index_stats). Properties without stats come last and ties go to the
+        property declared first, so the order of the filters doesn't matter.
+        The choice is cached per set of properties.
+        :param props: Tuple of indexed property names with an Equals condition
+        :return: Property name
+        """
+        cache = self._get_index_cache()
+        key = ('plan', frozenset(props))
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+        order = {name: i for i, name in enumerate(self._base_properties)}
+        costs = [(self.estimate_index_cost(prop), order.get(prop, len(order)), prop) for prop in props]
+        cost, i, prop = min(costs, key=lambda c: (c[0] is None, c[0] or 0, c[1], c[2]))
+        return cache.setdefault(key, prop)
 
     #####################
     # Document Prep     #
@@ -443,7 +1360,21 @@ class BaseDocument(BaseSchema):
         self.id = self._get_short_id(pk)
         self.pk = self.id
 
+    @classmethod
+    def _get_index_cache(cls):
+        # Stored in the class' own __dict__ so subclasses don't share a cache
+        if '_index_cache' not in cls.__dict__:
+            cls._index_cache = dict()
+        return cls._index_cache
+
     def _get_indexed_props(self, index_type='global'):
+        cache = self._get_index_cache()
+        try:
+            return cache[('props', index_type)]
+        except KeyError:
+            return cache.setdefault(('props', index_type), self._build_indexed_props(index_type))
+
+    def _build_indexed_props(self, index_type='global'):
         if index_type == 'global':
             index_list = ['_doc_type']
         else:
@@ -456,7 +1387,13 @@ class BaseDocument(BaseSchema):
         return index_list
 
     def _get_indexed_props_dict(self, index_type='global'):
+        cache = self._get_index_cache()
+        try:
+            return cache[('dict', index_type)]
+        except KeyError:
+            return cache.setdefault(('dict', index_type), self._build_indexed_props_dict(index_type))
 
+    def _build_indexed_props_dict(self, index_type='global'):
         indexes = {}
 
         for key, prop in list(self._base_properties.items()):
@@ -470,38 +1407,78 @@ class BaseDocument(BaseSchema):
 
         return indexes
 
-    def prep_doc(self, create_pk=False):
+    @classmethod
+    def get_index_stats(cls):
         """
-        This method Validates, gets the Python value, checks unique indexes,
-        gets the db value, and then returns the prepared doc dict object.
-        Useful for save and backup functions.
-        @return:
+        Returns the statistics used to pick an index for gfilter queries keyed
+        by property name. Each one has items_per_value (or item_count and
+        distinct_values) and optionally item_size in bytes. Stats declared in
+        Meta.index_stats take precedence over sampled ones.
+        :return: dict
         """
-        doc = self._data.copy()
-        for key, prop in list(self._base_properties.items()):
-            prop.validate(doc.get(key), key)
-            v = doc.get(key)
+        stats = dict(cls._get_index_cache().get('sampled_stats', {}))
+        stats.update(getattr(cls.Meta, 'index_stats', None) or {})
+        return stats
 
-            raw_value = prop.get_python_value(doc.get(key))
-            if prop.unique:
-                self.check_unique(key, raw_value)
+    @classmethod
+    def set_index_stats(cls, stats):
+        """
+        Replaces the sampled index statistics and clears the cached index choices.
+        :param stats: dict of property name to stats dict
+        :return: None
+        """
+        cache = cls._get_index_cache()
+        cache['sampled_stats'] = stats
+        for key in [k for k in cache if k[0] == 'plan']:
+            cache.pop(key, None)
 
-            if v or v is False:
-                value = prop.get_db_value(raw_value)
-                doc[key] = value
-            else:
-                try:
-                    doc.pop(key)
-                except KeyError:
-                    pass
+    def sample_index_stats(self, sample_size=1000):
+        """
+        Reads up to sample_size documents and sets items_per_value for each
+        global index from the number of distinct values in the sample.
+        :param sample_size: Max number of documents to read
+        :return: dict of property name to stats dict
+        """
+        items = self.get_doc_list(self.objects().all(limit=sample_size))[:sample_size]
+        stats = dict()
+        for prop in self._get_indexed_props():
+            if prop == '_doc_type':
+                continue
+            values = [json.dumps(i[prop], sort_keys=True, default=str) for i in items if i.get(prop) is not None]
+            if values:
+                stats[prop] = {'items_per_value': len(values) / len(set(values))}
+        self.set_index_stats(stats)
+        return stats
+
+    def estimate_index_cost(self, prop):
+        """
+        Approximate read capacity units of an Equals query on the global index
+        of prop (eventually consistent reads of 4 KB per unit).
+        :param prop: Property name
+        :return: float or None if there are no stats for the index
+        """
+        stats = self.get_index_stats().get(prop)
+        if not stats:
+            return None
+        items = stats.get('items_per_value')
+        if items is None:
+            try:
+                items = stats['item_count'] / stats['distinct_values']
+            except (KeyError, ZeroDivisionError):
+                return None
+        return items * stats.get('item_size', 1024) / 8192.0
 
-        doc['_doc_type'] = docb.utils.get_doc_type(self.__class__)
-        if create_pk:
-            doc['_id'] = self.create_pk(doc, return_pk=True)
-            for key, value in doc.items():
-                if type(value) == float:
-                    doc[key] = decimal.Decimal(str(value))
-        return doc
+    def prep_doc(self, create_pk=False, check_unique=True):
+        """
+        This method Validates, gets the Python value, checks unique indexes,
+        gets the db value, and then returns the prepared doc dict object.
+        Useful for save and backup functions. The work is done by a function
+        generated for each class (see docb.compiler).
+        @param create_pk: Add a new _id to the doc
+        @param check_unique: Query the table to check unique properties
+        @return:
+        """
+        return self._compiled_prep_doc(create_pk, check_unique)
 
     def check_unique(self, key, value):
         obj = self.objects().filter({key: value})
@@ -548,8 +1525,9 @@ class BaseDocument(BaseSchema):
     def restore(self, restore_path):
         file_path, path_type, bucket = self.get_path_type(restore_path)
         docs = self.get_restore_json(file_path, path_type, bucket)
-        for doc in docs:
-            self.__class__(**doc).save()
+        with self.Meta.handler.background():
+            for doc in docs:
+                self.__class__(**doc).save()
 
     def remove_id(self, doc):
         doc._data.pop('_id')
@@ -561,7 +1539,8 @@ class BaseDocument(BaseSchema):
 
     def backup(self, export_path):
         file_path, path_type, bucket = self.get_path_type(export_path)
-        json_docs = [doc.prep_doc() for doc in self.objects().all()]
+        with self.Meta.handler.background():
+            json_docs = [doc.prep_doc() for doc in self.objects().all()]
 
         if path_type == 'local':
             with open(export_path, 'w+') as f:
@@ -572,6 +1551,60 @@ class BaseDocument(BaseSchema):
             self._s3.Object(bucket, file_path).put(
                 Body=json.dumps(json_docs))
 
+    def export(self, filters, path, format='parquet', fields=None, segments=1, prefetch=0, part_size=None):
+        """
+        Streams the items of a QuerySet to a Parquet, CSV or Arrow file, page
+        by page. With segments > 1 the table is read with a parallel Scan and
+        every segment is written to its own file (part-00000.parquet, ...) in
+        the directory or S3 prefix path.
+        :param filters: QuerySet object
+        :param path: Local path or s3://bucket/key
+        :param format: 'parquet', 'csv' or 'arrow'
+        :param fields: Names of the columns (default: _id and every property)
+        :param segments: Number of scan segments written in parallel
+        :param prefetch: Number of pages fetched ahead while a page is written (single file exports)
+        :param part_size: Bytes per part of S3 multipart uploads (default: docb.export.PART_SIZE)
+        :return: Number of items exported
+        """
+        # Imported here so pyarrow is only loaded by exports
+        import docb.export
+        docb.export.get_writer_class(format)
+        fields = docb.export.get_fields(self.__class__, fields)
+        if segments <= 1:
+            return self._export_pages(self.iter_pages(filters, prefetch=prefetch), path, format, fields, part_size)
+        scans = [self.iter_scan_pages(filters, segment, segments) for segment in range(segments)]
+        if self.get_path_type(path)[1] == 'local':
+            os.makedirs(path, exist_ok=True)
+
+        def export_segment(segment):
+            return self._export_pages(scans[segment], docb.export.partition_path(path, segment, format), format,
+                                      fields, part_size)
+
+        with ThreadPoolExecutor(max_workers=segments) as executor:
+            return sum(executor.map(docb.utils.bind_context(export_segment), range(segments)))
+
+    def _export_pages(self, pages, path, format, fields, part_size):
+        import docb.export
+        file_path, path_type, bucket = self.get_path_type(path)
+        if path_type == 'local':
+            try:
+                with self.Meta.handler.background():
+                    return docb.export.write_file(pages, file_path, self.__class__, format, fields)
+            finally:
+                pages.close()
+        sink = docb.export.S3MultipartFile(self._s3.meta.client, bucket, file_path,
+                                           part_size=part_size or docb.export.PART_SIZE)
+        try:
+            with self.Meta.handler.background():
+                count = docb.export.write_pages(pages, sink, self.__class__, format, fields)
+        except BaseException:
+            sink.abort()
+            raise
+        finally:
+            pages.close()
+            sink.close()
+        return count
+
     ########################
     # Unit Tests           #
     ########################
@@ -580,27 +1613,38 @@ class BaseDocument(BaseSchema):
         """
         Creates a table according to a table_config. Please only use
         for unit tests. Please use the build_cf_template and build_cf_resources
-        otherwise.
+        otherwise. If the handler already has the table's description cached
+        (see DocbHandler.prewarm) the table exists and no request is made.
         """
+        handler = self.Meta.handler
+        if self.Meta.use_db in handler._descriptions:
+            return self._dynamodb
         try:
             config = self.Meta.config
         except AttributeError:
-            config = self.Meta.handler.get_config(self.Meta.use_db)
+            config = handler.get_config(self.Meta.use_db)
 
-        table_config = docb.utils.TableConfig(**config)
+        import docb.config
+        table_config = docb.config.TableConfig(**config)
         table_config.validate()
 
         global_indexes = self._get_indexed_props_dict().items()
 
-        connection = docb.utils.TableConnection(
-            **self.Meta.handler.config[
+        connection = docb.config.TableConnection(
+            **handler.config[
                 self.Meta.use_db]['connection'])
 
-        return self._connection.create_table(**docb.utils.build_cf_args(connection.table, table_config,
-                                                                        global_indexes))
+        args = docb.utils.build_cf_args(connection.table, table_config, global_indexes)
+        if 'StreamSpecification' in args:
+            # CloudFormation only takes the StreamViewType but the API needs StreamEnabled too
+            args['StreamSpecification']['StreamEnabled'] = True
+        table = self._connection.create_table(**args)
+        handler.set_table_description(self.Meta.use_db, table.meta.data)
+        return table
 
     def delete_table(self):
         self._dynamodb.delete()
+        self.Meta.handler.set_table_description(self.Meta.use_db, None)
 
     class Meta:
         use_db = 'default'
@@ -18,9 +18,38 @@ class DocSaveError(Exception):
     pass
 
 
+class VersionConflictError(DocSaveError):
+    """
+    A versioned document was changed (or deleted) since it was read.
+    """
+    pass
+
+
 class ResourceError(Exception):
     pass
 
 
 class ImproperlyConfigured(Exception):
     pass
+
+
+class TransactionError(DocSaveError):
+    """
+    A transaction was cancelled. reasons has the CancellationReasons of
+    each item (in the order they were added) when DynamoDB returns them.
+    """
+
+    def __init__(self, message, reasons=None):
+        super(TransactionError, self).__init__(message)
+        self.reasons = reasons or []
+
+
+class BulkSaveError(DocSaveError):
+    """
+    Some documents of a concurrent bulk_save weren't saved. failed has the
+    docb.bulk.BulkResult(doc, success, error) of each of them.
+    """
+
+    def __init__(self, message, failed=None):
+        super(BulkSaveError, self).__init__(message)
+        self.failed = failed or []
@@ -0,0 +1,303 @@
+"""
+Streaming export of query results to Parquet, Arrow IPC or CSV files on
+disk or in S3. Every page is converted to a record batch and written as it
+is read, so only a few pages are held in memory whatever the size of the
+result. S3 objects are sent with a multipart upload as the parts fill up.
+
+Parquet and Arrow need pyarrow (pip install docb[export]), which is only
+imported when one of them is written. CSV only uses the standard library.
+"""
+import csv
+import datetime
+import decimal
+import io
+import json
+import os
+
+from docb.codec import property_kind
+from docb.exceptions import ImproperlyConfigured, QueryError
+
+FORMATS = ('parquet', 'csv', 'arrow')
+# S3 parts have to be at least 5 MiB except the last one
+PART_SIZE = 8 * 1024 * 1024
+
+# pyarrow and pyarrow.parquet, set by require_pyarrow
+pa = pq = None
+
+
+def require_pyarrow(format):
+    """
+    Imports pyarrow the first time a Parquet or Arrow file is written so
+    importing docb doesn't pay for it.
+    :param format: Export format that needs pyarrow
+    :return: None
+    """
+    global pa, pq
+    if pa is not None:
+        return
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImproperlyConfigured('Exporting to {} requires pyarrow. Install it with pip install pyarrow.'
+                                   .format(format))
+    pa, pq = pyarrow, pyarrow.parquet
+
+
+def get_fields(doc_class, fields=None):
+    """
+    :param doc_class: Document class
+    :param fields: Names of the columns (default: _id and every property)
+    :return: List of field names
+    """
+    if fields:
+        return list(fields)
+    return ['_id'] + list(doc_class._base_properties.keys())
+
+
+def get_kinds(doc_class, fields):
+    kinds = list()
+    for field in fields:
+        prop = doc_class._base_properties.get(field)
+        kinds.append(property_kind(prop) if prop is not None else 'str' if field == '_id' else None)
+    return kinds
+
+
+def get_schema(doc_class, fields):
+    """
+    The Arrow schema of the properties. Properties without a built in type
+    (like lists and dicts) are exported as JSON strings.
+    :param doc_class: Document class
+    :param fields: List of field names
+    :return: pyarrow.Schema
+    """
+    require_pyarrow('arrow')
+    types = {'str': pa.string(), 'int': pa.int64(), 'float': pa.float64(), 'bool': pa.bool_(),
+             'date': pa.date32(), 'datetime': pa.timestamp('s')}
+    return pa.schema([(field, types.get(kind, pa.string()))
+                      for field, kind in zip(fields, get_kinds(doc_class, fields))])
+
+
+def export_value(value, kind):
+    """
+    Converts a decoded item value to the Python type of its column.
+    :param value: Value from an item dict
+    :param kind: See docb.codec.property_kind
+    """
+    if value is None:
+        return None
+    if kind == 'date' and isinstance(value, str):
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    if kind == 'datetime' and isinstance(value, str):
+        return datetime.datetime.strptime(value.rstrip('Z'), '%Y-%m-%dT%H:%M:%S')
+    if kind == 'float':
+        return float(value)
+    if kind == 'int':
+        return int(value)
+    if kind is None and not isinstance(value, str):
+        return json.dumps(value, default=lambda v: float(v) if isinstance(v, decimal.Decimal) else str(v))
+    return value
+
+
+class ExportWriter(object):
+    """
+    Base class of the format writers. write is called with every page of
+    items and close when the export is done.
+    """
+
+    def __init__(self, sink, doc_class, fields):
+        """
+        :param sink: Binary file object
+        :param doc_class: Document class
+        :param fields: List of field names
+        """
+        self.sink = sink
+        self.fields = fields
+        self.kinds = get_kinds(doc_class, fields)
+
+    def columns(self, items):
+        return [[export_value(item.get(field), kind) for item in items]
+                for field, kind in zip(self.fields, self.kinds)]
+
+    def write(self, items):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class ArrowWriter(ExportWriter):
+    format = 'arrow'
+
+    def __init__(self, sink, doc_class, fields):
+        require_pyarrow(self.format)
+        super(ArrowWriter, self).__init__(sink, doc_class, fields)
+        self.schema = get_schema(doc_class, fields)
+        self.writer = self.open()
+
+    def open(self):
+        return pa.ipc.new_file(self.sink, self.schema)
+
+    def write(self, items):
+        arrays = [pa.array(values, type=field.type) for values, field in zip(self.columns(items), self.schema)]
+        self.writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+class ParquetWriter(ArrowWriter):
+    """
+    Every page becomes a row group.
+    """
+    format = 'parquet'
+
+    def open(self):
+        return pq.ParquetWriter(self.sink, self.schema)
+
+
+class CsvWriter(ExportWriter):
+    """
+    Empty values are written as empty strings.
+    """
+
+    def __init__(self, sink, doc_class, fields):
+        super(CsvWriter, self).__init__(sink, doc_class, fields)
+        self.write_rows([self.fields])
+
+    def write_rows(self, rows):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        self.sink.write(buffer.getvalue().encode('utf-8'))
+
+    def write(self, items):
+        self.write_rows(zip(*self.columns(items)))
+
+
+WRITERS = {'parquet': ParquetWriter, 'csv': CsvWriter, 'arrow': ArrowWriter}
+
+
+def get_writer_class(format):
+    try:
+        return WRITERS[format]
+    except KeyError:
+        raise QueryError('Unknown export format {}. Use one of {}.'.format(format, ', '.join(FORMATS)))
+
+
+class S3MultipartFile(io.RawIOBase):
+    """
+    A write-only file that uploads an S3 object in parts of part_size bytes.
+    Objects smaller than one part are sent with a single PutObject. The
+    upload is only completed by close, abort drops the parts sent so far.
+    """
+
+    def __init__(self, client, bucket, key, part_size=PART_SIZE):
+        """
+        :param client: Boto3 S3 client
+        :param bucket: Bucket name
+        :param key: Object key
+        :param part_size: Bytes per part
+        """
+        super(S3MultipartFile, self).__init__()
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.parts = list()
+        self.upload_id = None
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def _upload_part(self, body):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        number = len(self.parts) + 1
+        response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                           PartNumber=number, Body=body)
+        self.parts.append({'PartNumber': number, 'ETag': response['ETag']})
+
+    def close(self):
+        if self.closed:
+            return
+        if self.upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+        else:
+            if self.buffer:
+                self._upload_part(bytes(self.buffer))
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                  MultipartUpload={'Parts': self.parts})
+        self.buffer = bytearray()
+        super(S3MultipartFile, self).close()
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        self.buffer = bytearray()
+        super(S3MultipartFile, self).close()
+
+
+def write_pages(pages, sink, doc_class, format, fields):
+    """
+    :param pages: Iterable of lists of decoded item dicts
+    :param sink: Binary file object
+    :param doc_class: Document class
+    :param format: 'parquet', 'csv' or 'arrow'
+    :param fields: List of field names
+    :return: Number of rows written
+    """
+    writer = get_writer_class(format)(sink, doc_class, fields)
+    count = 0
+    try:
+        for items in pages:
+            if items:
+                writer.write(items)
+                count += len(items)
+    finally:
+        writer.close()
+    return count
+
+
+def write_file(pages, path, doc_class, format, fields):
+    """
+    Writes pages to a temporary file next to path that replaces path once
+    every page is written, so a failed export doesn't leave a truncated file.
+    :param pages: Iterable of lists of decoded item dicts
+    :param path: Local file path
+    :param doc_class: Document class
+    :param format: 'parquet', 'csv' or 'arrow'
+    :param fields: List of field names
+    :return: Number of rows written
+    """
+    tmp_path = '{}.tmp'.format(path)
+    try:
+        with open(tmp_path, 'wb') as sink:
+            count = write_pages(pages, sink, doc_class, format, fields)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    os.replace(tmp_path, path)
+    return count
+
+
+def partition_path(path, segment, format):
+    """
+    :return: Path of the file a scan segment is written to in the directory (or S3 prefix) path
+    """
+    return '{}/part-{:05d}.{}'.format(path.rstrip('/'), segment, format)
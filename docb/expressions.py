@@ -0,0 +1,348 @@
+"""
+Compiles boto3 condition objects and update values (including F
+expressions) into the expression strings, placeholders and wire format
+values the low-level client expects.
+"""
+import decimal
+
+from boto3.dynamodb.conditions import ConditionExpressionBuilder
+
+from docb.codec import encode_value
+from docb.exceptions import DocSaveError
+
+
+def _db_value(value):
+    # encode_value only converts top-level floats
+    if isinstance(value, float):
+        return decimal.Decimal(str(value))
+    if isinstance(value, (list, tuple)):
+        return [_db_value(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _db_value(v) for k, v in value.items()}
+    return value
+
+
+def add_numbers(a, b):
+    """
+    Adds two numbers the way DynamoDB would, converting floats when the other one is a Decimal.
+    """
+    if isinstance(a, float) and isinstance(b, decimal.Decimal):
+        a = decimal.Decimal(str(a))
+    elif isinstance(b, float) and isinstance(a, decimal.Decimal):
+        b = decimal.Decimal(str(b))
+    return a + b
+
+
+class ExpressionBuilder(object):
+    """
+    Collects the placeholders of every expression of one request so they
+    don't collide.
+    """
+
+    def __init__(self):
+        self.builder = ConditionExpressionBuilder()
+        self.names = dict()
+        self.values = dict()
+        self.count = 0
+
+    def condition(self, condition, is_key_condition=False):
+        """
+        :param condition: boto3.dynamodb.conditions.ConditionBase
+        :param is_key_condition: True for a KeyConditionExpression
+        :return: Expression string
+        """
+        built = self.builder.build_expression(condition, is_key_condition=is_key_condition)
+        self.names.update(built.attribute_name_placeholders)
+        self.values.update(built.attribute_value_placeholders)
+        return built.condition_expression
+
+    def name(self, name):
+        """
+        :param name: Attribute name
+        :return: Name placeholder
+        """
+        for placeholder, value in self.names.items():
+            if value == name and placeholder.startswith('#u'):
+                return placeholder
+        placeholder = '#u{}'.format(self.count)
+        self.count += 1
+        self.names[placeholder] = name
+        return placeholder
+
+    def value(self, value):
+        """
+        :param value: Python value
+        :return: Value placeholder
+        """
+        placeholder = ':u{}'.format(self.count)
+        self.count += 1
+        self.values[placeholder] = _db_value(value)
+        return placeholder
+
+    def params(self):
+        """
+        :return: dict with ExpressionAttributeNames and ExpressionAttributeValues (if there are any)
+        """
+        params = dict()
+        if self.names:
+            params['ExpressionAttributeNames'] = dict(self.names)
+        if self.values:
+            params['ExpressionAttributeValues'] = {k: encode_value(v) for k, v in self.values.items()}
+        return params
+
+
+def and_conditions(*conditions):
+    """
+    Combines the conditions that aren't None with AND.
+    :param conditions: boto3.dynamodb.conditions.ConditionBase or None
+    :return: ConditionBase or None
+    """
+    combined = None
+    for condition in conditions:
+        if condition is not None:
+            combined = condition if combined is None else combined & condition
+    return combined
+
+
+def condition_params(condition):
+    """
+    Request parameters for a ConditionExpression.
+    :param condition: boto3.dynamodb.conditions.ConditionBase or None
+    :return: dict
+    """
+    if condition is None:
+        return dict()
+    builder = ExpressionBuilder()
+    params = {'ConditionExpression': builder.condition(condition)}
+    params.update(builder.params())
+    return params
+
+
+def compile_operand(operand, builder):
+    if isinstance(operand, Operand):
+        return operand.compile(builder)
+    return builder.value(operand)
+
+
+def evaluate_operand(operand, item):
+    if isinstance(operand, Operand):
+        return operand.evaluate(item)
+    return _db_value(operand)
+
+
+class Operand(object):
+    """
+    A value computed by DynamoDB when an update is applied.
+    """
+
+    def __add__(self, other):
+        return Arithmetic(self, '+', other)
+
+    def __radd__(self, other):
+        return Arithmetic(other, '+', self)
+
+    def __sub__(self, other):
+        return Arithmetic(self, '-', other)
+
+    def __rsub__(self, other):
+        return Arithmetic(other, '-', self)
+
+    def append(self, values):
+        """
+        :param values: List added to the end of the list
+        :return: Operand
+        """
+        return ListAppend(self, list(values))
+
+    def prepend(self, values):
+        """
+        :param values: List added to the start of the list
+        :return: Operand
+        """
+        return ListAppend(list(values), self)
+
+    def compile(self, builder):
+        raise NotImplementedError
+
+    def evaluate(self, item):
+        """
+        Computes the value DynamoDB would store for item.
+        :param item: Item dict before the update
+        """
+        raise NotImplementedError
+
+
+class F(Operand):
+    """
+    The stored value of an attribute, e.g. F('no_subscriptions') + 1.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def if_not_exists(self, value):
+        """
+        :param value: Value used when the attribute doesn't exist
+        :return: Operand
+        """
+        return IfNotExists(self, value)
+
+    def compile(self, builder):
+        return builder.name(self.name)
+
+    def evaluate(self, item):
+        return item.get(self.name)
+
+    def __repr__(self):
+        return 'F({!r})'.format(self.name)
+
+
+class IfNotExists(Operand):
+
+    def __init__(self, attr, value):
+        self.attr = attr
+        self.value = value
+
+    def compile(self, builder):
+        return 'if_not_exists({}, {})'.format(self.attr.compile(builder), compile_operand(self.value, builder))
+
+    def evaluate(self, item):
+        if item.get(self.attr.name) is not None:
+            return item[self.attr.name]
+        return evaluate_operand(self.value, item)
+
+
+class ListAppend(Operand):
+
+    def __init__(self, first, second):
+        self.first = first
+        self.second = second
+
+    def compile(self, builder):
+        return 'list_append({}, {})'.format(compile_operand(self.first, builder),
+                                            compile_operand(self.second, builder))
+
+    def evaluate(self, item):
+        return list(evaluate_operand(self.first, item)) + list(evaluate_operand(self.second, item))
+
+
+class Arithmetic(Operand):
+
+    def __init__(self, left, operator, right):
+        if isinstance(left, Arithmetic) or isinstance(right, Arithmetic):
+            raise DocSaveError('Update expressions can only add or subtract two operands.')
+        self.left = left
+        self.operator = operator
+        self.right = right
+
+    def increment(self, name):
+        """
+        Returns the number added to attribute name if the expression is
+        name + number (or name - number), otherwise None.
+        """
+        left, right = self.left, self.right
+        if self.operator == '+' and isinstance(right, F):
+            left, right = right, left
+        if not isinstance(left, F) or left.name != name:
+            return None
+        if not isinstance(right, (int, float, decimal.Decimal)) or isinstance(right, bool):
+            return None
+        return right if self.operator == '+' else -right
+
+    def compile(self, builder):
+        return '{} {} {}'.format(compile_operand(self.left, builder), self.operator,
+                                 compile_operand(self.right, builder))
+
+    def evaluate(self, item):
+        left, right = evaluate_operand(self.left, item), evaluate_operand(self.right, item)
+        return add_numbers(left, right if self.operator == '+' else -right)
+
+
+class Remove(object):
+
+    def __repr__(self):
+        return 'REMOVE'
+
+
+# Removes the attribute like an empty value does
+REMOVE = Remove()
+
+
+def _update_value(doc_class, key, value):
+    # Converts a plain update value like save does. Empty values become REMOVE
+    prop = doc_class._base_properties.get(key)
+    if prop is not None and value is not REMOVE:
+        prop.validate(value, key)
+        value = prop.get_python_value(value)
+        value = prop.get_db_value(value) if value or value is False else None
+    if value is not REMOVE and (value or value is False):
+        return value
+    return REMOVE
+
+
+def update_params(doc_class, values, condition=None, increment_version=False):
+    """
+    UpdateItem parameters that set (or remove) the values. Values can be
+    Operands like F('count') + 1: adding a number to the attribute itself
+    becomes an ADD, which also works when the attribute doesn't exist yet.
+    :param doc_class: Document class
+    :param values: dict of property values or Operands
+    :param condition: boto3.dynamodb.conditions.ConditionBase or None
+    :param increment_version: Add 1 to _version
+    :return: dict
+    """
+    builder = ExpressionBuilder()
+    sets, adds, removes = list(), list(), list()
+    for key, value in values.items():
+        if isinstance(value, Operand):
+            increment = value.increment(key) if isinstance(value, Arithmetic) else None
+            if increment is not None:
+                adds.append('{} {}'.format(builder.name(key), builder.value(increment)))
+            else:
+                sets.append('{} = {}'.format(builder.name(key), value.compile(builder)))
+            continue
+        value = _update_value(doc_class, key, value)
+        if value is REMOVE:
+            removes.append(builder.name(key))
+        else:
+            sets.append('{} = {}'.format(builder.name(key), builder.value(value)))
+    if increment_version:
+        adds.append('{} {}'.format(builder.name('_version'), builder.value(1)))
+    expression = list()
+    for action, parts in (('SET', sets), ('ADD', adds), ('REMOVE', removes)):
+        if parts:
+            expression.append('{} {}'.format(action, ', '.join(parts)))
+    params = {'UpdateExpression': ' '.join(expression)}
+    if condition is not None:
+        params['ConditionExpression'] = builder.condition(condition)
+    params.update(builder.params())
+    return params
+
+
+def apply_update(doc_class, item, values, increment_version=False):
+    """
+    Computes locally what an update made with update_params stores.
+    :param doc_class: Document class
+    :param item: Item dict before the update
+    :param values: dict of property values or Operands
+    :param increment_version: Add 1 to _version
+    :return: Item dict after the update
+    """
+    new = dict(item)
+    for key, value in values.items():
+        if isinstance(value, Operand):
+            increment = value.increment(key) if isinstance(value, Arithmetic) else None
+            if increment is not None:
+                # ADD treats a missing attribute as 0
+                new[key] = add_numbers(item.get(key) or 0, increment)
+            else:
+                new[key] = value.evaluate(item)
+            continue
+        value = _update_value(doc_class, key, value)
+        if value is REMOVE:
+            new.pop(key, None)
+        else:
+            new[key] = value
+    if increment_version:
+        new['_version'] = (item.get('_version') or 0) + 1
+    return new
@@ -1,9 +1,24 @@
+import contextlib
+import contextvars
+import os
+import threading
 import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+import botocore.config
+from botocore.exceptions import ClientError
+import docb.batching
 import docb.document
 import docb.properties
+import docb.session
+import docb.transaction
 import docb.utils
+from docb.cache import QueryCache
+from docb.exceptions import ImproperlyConfigured
+from docb.metrics import build_event
+from docb.throttle import INTERACTIVE, BACKGROUND, CAPACITY_OPERATIONS, RateLimiter
 
 REPLICATION_GROUPS = [
     'us-east-1',
@@ -14,6 +29,37 @@ REPLICATION_GROUPS = [
     'eu-west-1'
 ]
 
+_handlers = weakref.WeakSet()
+
+
+def _reset_handlers_after_fork():
+    for handler in list(_handlers):
+        handler.reset_connections()
+
+
+if hasattr(os, 'register_at_fork'):
+    # Sockets in a connection pool must not be shared between processes
+    os.register_at_fork(after_in_child=_reset_handlers_after_fork)
+
+
+class DocbClient(object):
+    """
+    Client-like wrapper for a label. Its methods send requests through
+    DocbHandler.call so they are rate limited and reported to the metrics hooks.
+    """
+
+    def __init__(self, handler, db_label, priority=None, doc_class=None):
+        self.handler = handler
+        self.db_label = db_label
+        self.priority = priority
+        self.doc_class = doc_class
+
+    def __getattr__(self, operation):
+        def call(**params):
+            return self.handler.call(self.db_label, operation, params, priority=self.priority,
+                                     doc_class=self.doc_class)
+        return call
+
 
 class DocbHandler(object):
     """
@@ -27,36 +73,459 @@ class DocbHandler(object):
             'config':{
                   'endpoint_url':'http://localhost:8000'
                 },
+            'client_config':{
+                'max_pool_connections':50,
+                'tcp_keepalive':True,
+                'connect_timeout':2,
+                'read_timeout':5
+            },
+            'rate_limit':{
+                'read':100,
+                'write':50,
+                'indexes':{'city-index':{'read':20, 'write':20}}
+            },
             'table_config':{
                 'write_capacity':2,
                 'read_capacity':3
             }
         }
     })
+
+    Boto3 resources are not thread safe so each thread gets its own
+    resource and Table (set 'thread_local' to False on a label to share one).
+    The low-level client returned by get_client is thread safe and shared.
+    Sessions, resources, clients and tables are only created the first time
+    a label is used.
+
+    'query_cache' is optional. If it is True (or a dict with ttl and
+    max_bytes) query results are cached in the process until a document of
+    the same _doc_type is written.
+
+    'rate_limit' is optional. If it is True the read and write budgets come
+    from the label's table_config capacities. Calls made inside
+    handler.background() (and bulk saves) yield to interactive calls.
+
+    'get_batching' is optional. If it is True (or a dict with window and
+    max_batch) concurrent Document.get calls are coalesced into BatchGetItem
+    requests (see docb.batching).
     """
 
     def __init__(self, config):
         self.config = config
-        self.get_tables()
+        self._descriptions = dict()
+        self._index_names = dict()
+        self._metrics_hooks = list()
+        self._identity_map = contextvars.ContextVar('docb_identity_map_{}'.format(id(self)), default=None)
+        self._priority = contextvars.ContextVar('docb_priority_{}'.format(id(self)), default=INTERACTIVE)
+        self.reset_connections()
+        _handlers.add(self)
 
-    def get_tables(self):
+    def reset_connections(self):
+        """
+        Drops the session, clients, resources and tables so they are created
+        again on next use. Called automatically in child processes after a fork.
+        :return: None
+        """
+        self._session = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._shared = dict()
+        self._clients = dict()
+        self._limiters = dict()
+        self._query_caches = dict()
+        self._batchers = dict()
+        self._async_batchers = weakref.WeakKeyDictionary()
+
+    def get_session(self):
+        """
+        Returns the Boto3 session shared by the handler's connections. Callers
+        must hold self._lock since sessions are not thread safe.
+        :return: boto3.session.Session
+        """
+        if self._session is None:
+            self._session = boto3.session.Session()
+        return self._session
+
+    def _get_store(self, db_label):
+        """
+        Returns the dict the resource and table for a label are kept in. This
+        is thread local unless the label sets 'thread_local' to False.
+        :param db_label: Name of the DB label
+        :return: dict
+        """
+        if not self.get_settings(db_label).get('thread_local', True):
+            return self._shared.setdefault(db_label, dict())
         try:
-            return self._tables
+            stores = self._local.stores
         except AttributeError:
-            self._tables = dict()
-            for db_label, conn in self.get_connections().items():
-                self._tables[db_label] = conn.Table(self.config[db_label]['connection']['table'])
-            return self._tables
+            stores = self._local.stores = dict()
+        return stores.setdefault(db_label, dict())
 
-    def get_connections(self):
+    def get_client_config(self, db_label):
+        """
+        Builds the botocore Config (max_pool_connections, tcp_keepalive,
+        connect_timeout, read_timeout, retries) from the label's client_config.
+        :param db_label: Name of the DB label
+        :return: botocore.config.Config or None
+        """
+        client_config = self.get_settings(db_label).get('client_config')
+        if not client_config:
+            return None
+        return botocore.config.Config(**client_config)
+
+    def get_boto_kwargs(self, db_label):
+        kwargs = dict(self.get_settings(db_label).get('config', {}))
+        client_config = self.get_client_config(db_label)
+        if client_config is not None:
+            if kwargs.get('config') is not None:
+                client_config = kwargs['config'].merge(client_config)
+            kwargs['config'] = client_config
+        return kwargs
+
+    def get_connection(self, db_label):
+        """
+        Returns the Boto3 DynamoDB resource for the label and the current thread.
+        :param db_label: Name of the DB label
+        :return: boto3 DynamoDB ServiceResource
+        """
+        store = self._get_store(db_label)
         try:
-            return self._connections
-        except AttributeError:
-            self._connections = dict()
-            for db_label, db_info in self.config.items():
-                self._connections[db_label] = boto3.resource(
-                    'dynamodb', **db_info.get('config', {}))
-            return self._connections
+            return store['connection']
+        except KeyError:
+            # Sessions are not thread safe either so resource creation is serialized
+            with self._lock:
+                connection = self.get_session().resource('dynamodb', **self.get_boto_kwargs(db_label))
+            return store.setdefault('connection', connection)
+
+    def get_table(self, db_label):
+        """
+        Returns the Boto3 DynamoDB Table resource for the label and the current thread.
+        :param db_label: Name of the DB label
+        :return: boto3 DynamoDB Table resource
+        """
+        store = self._get_store(db_label)
+        try:
+            return store['table']
+        except KeyError:
+            table = self.get_connection(db_label).Table(self.get_table_name(db_label))
+            if db_label in self._descriptions:
+                # Attribute access on the Table won't call DescribeTable
+                table.meta.data = self._descriptions[db_label]
+            return store.setdefault('table', table)
+
+    def get_client(self, db_label):
+        """
+        Returns the low-level DynamoDB client for the label. Clients are
+        thread safe so one is shared by all threads.
+        :param db_label: Name of the DB label
+        :return: botocore DynamoDB client
+        """
+        try:
+            return self._clients[db_label]
+        except KeyError:
+            with self._lock:
+                if db_label not in self._clients:
+                    self._clients[db_label] = self.get_session().client(
+                        'dynamodb', **self.get_boto_kwargs(db_label))
+            return self._clients[db_label]
+
+    def get_streams_client(self, db_label):
+        """
+        Returns the low-level DynamoDB Streams client for the label (see
+        docb.streams). Stream reads don't use the table's capacity so they
+        don't go through the rate limiter.
+        :param db_label: Name of the DB label
+        :return: botocore DynamoDBStreams client
+        """
+        key = (db_label, 'dynamodbstreams')
+        try:
+            return self._clients[key]
+        except KeyError:
+            with self._lock:
+                if key not in self._clients:
+                    self._clients[key] = self.get_session().client(
+                        'dynamodbstreams', **self.get_boto_kwargs(db_label))
+            return self._clients[key]
+
+    def get_docb_client(self, db_label, priority=None, doc_class=None):
+        """
+        Returns a client for the label whose calls go through DocbHandler.call.
+        :param db_label: Name of the DB label
+        :param priority: docb.throttle.INTERACTIVE or BACKGROUND (default: the caller's priority, see background)
+        :param doc_class: Document class reported in metrics events
+        :return: DocbClient
+        """
+        return DocbClient(self, db_label, priority, doc_class)
+
+    def add_metrics_hook(self, hook):
+        """
+        Adds a callable that receives a docb.metrics.MetricsEvent for every
+        call made through DocbHandler.call (e.g. a docb.metrics.MetricsAggregator).
+        :param hook: Callable
+        :return: hook
+        """
+        self._metrics_hooks.append(hook)
+        return hook
+
+    def remove_metrics_hook(self, hook):
+        self._metrics_hooks.remove(hook)
+
+    def get_rate_limiter(self, db_label):
+        """
+        Returns the label's RateLimiter or None if it doesn't have a rate_limit.
+        :param db_label: Name of the DB label
+        :return: docb.throttle.RateLimiter
+        """
+        try:
+            return self._limiters[db_label]
+        except KeyError:
+            settings = self.get_settings(db_label)
+            limiter = RateLimiter.from_config(settings.get('rate_limit'), settings.get('table_config'))
+            with self._lock:
+                return self._limiters.setdefault(db_label, limiter)
+
+    def get_query_cache(self, db_label):
+        """
+        Returns the label's QueryCache or None if it doesn't have a query_cache.
+        :param db_label: Name of the DB label
+        :return: docb.cache.QueryCache
+        """
+        try:
+            return self._query_caches[db_label]
+        except KeyError:
+            cache = QueryCache.from_config(self.get_settings(db_label).get('query_cache'))
+            with self._lock:
+                return self._query_caches.setdefault(db_label, cache)
+
+    def get_batcher(self, db_label, doc_class):
+        """
+        Returns the GetBatcher of a class or None if the label doesn't have get_batching.
+        :param db_label: Name of the DB label
+        :param doc_class: Document class
+        :return: docb.batching.GetBatcher
+        """
+        key = (db_label, doc_class)
+        try:
+            return self._batchers[key]
+        except KeyError:
+            batcher = docb.batching.GetBatcher.from_config(doc_class.get_items,
+                                                           self.get_settings(db_label).get('get_batching'))
+            with self._lock:
+                return self._batchers.setdefault(key, batcher)
+
+    def get_async_batcher(self, db_label, doc_class):
+        """
+        Returns the AsyncGetBatcher of a class for the running event loop.
+        Async gets are always batched, the label's get_batching only sets the options.
+        :param db_label: Name of the DB label
+        :param doc_class: Document class
+        :return: docb.batching.AsyncGetBatcher
+        """
+        # Imported here so only async callers pay for asyncio
+        import asyncio
+        loop = asyncio.get_running_loop()
+        batchers = self._async_batchers.setdefault(loop, dict())
+        key = (db_label, doc_class)
+        if key not in batchers:
+            batchers[key] = docb.batching.AsyncGetBatcher.from_config(
+                doc_class.get_items, loop, self.get_settings(db_label).get('get_batching'))
+        return batchers[key]
+
+    def invalidate_query_cache(self, db_label, *doc_types):
+        """
+        Makes the cached query results of the doc types stale.
+        :param db_label: Name of the DB label
+        :param doc_types: _doc_type values that were written (all of them if none are given)
+        :return: None
+        """
+        cache = self.get_query_cache(db_label)
+        if cache is None:
+            return
+        if not doc_types:
+            cache.invalidate_all()
+        for doc_type in doc_types:
+            cache.invalidate(doc_type)
+
+    def get_priority(self):
+        return self._priority.get()
+
+    @contextlib.contextmanager
+    def background(self):
+        """
+        Runs the calls made inside the block at background priority. Prefetch
+        and fan-out threads started inside the block inherit it.
+        """
+        token = self._priority.set(BACKGROUND)
+        try:
+            yield
+        finally:
+            self._priority.reset(token)
+
+    @contextlib.contextmanager
+    def session(self):
+        """
+        Keeps one Document instance per key for the documents loaded inside
+        the block (see docb.session). Repeated gets of a loaded key don't read
+        it again. The map is cleared when the outermost block exits.
+        :return: docb.session.IdentityMap
+        """
+        identity_map = self._identity_map.get()
+        if identity_map is not None:
+            yield identity_map
+            return
+        identity_map = docb.session.IdentityMap()
+        token = self._identity_map.set(identity_map)
+        try:
+            yield identity_map
+        finally:
+            self._identity_map.reset(token)
+            identity_map.clear()
+
+    def get_identity_map(self):
+        """
+        :return: The docb.session.IdentityMap of the current session or None
+        """
+        return self._identity_map.get()
+
+    @contextlib.contextmanager
+    def transaction(self, max_items=docb.transaction.MAX_TRANSACTION_ITEMS):
+        """
+        Collects the writes made with the yielded docb.transaction.Transaction
+        and sends them with TransactWriteItems at the end of the block.
+        Nothing is sent if the block raises.
+        :param max_items: Items per TransactWriteItems call
+        """
+        tx = docb.transaction.Transaction(self, max_items)
+        yield tx
+        tx.commit()
+
+    def transact_get(self, refs, max_items=docb.transaction.MAX_TRANSACTION_ITEMS):
+        """
+        Reads documents with TransactGetItems.
+        :param refs: List of Documents or (Document class, pk) tuples
+        :param max_items: Items per TransactGetItems call
+        :return: List of Documents (None where the document doesn't exist) in the order of refs
+        """
+        return docb.transaction.transact_get(self, refs, max_items)
+
+    def call(self, db_label, operation, params, priority=None, doc_class=None, page=None):
+        """
+        Sends a request with the label's client through its rate limiter and
+        reports it to the metrics hooks.
+        :param db_label: Name of the DB label
+        :param operation: Name of the client method (e.g. 'query')
+        :param params: Request parameters
+        :param priority: docb.throttle.INTERACTIVE or BACKGROUND (default: the caller's priority, see background)
+        :param doc_class: Document class reported in metrics events
+        :param page: Page number of a query or scan reported in metrics events
+        :return: Response dict
+        """
+        method = getattr(self.get_client(db_label), operation)
+        hooks = self._metrics_hooks
+        if hooks:
+            method = self._instrument(method, db_label, operation, doc_class, page)
+            if operation in CAPACITY_OPERATIONS:
+                params.setdefault('ReturnConsumedCapacity', 'INDEXES')
+        limiter = self.get_rate_limiter(db_label)
+        if limiter is None:
+            return method(**params)
+        return limiter.call(method, operation, params, self.get_priority() if priority is None else priority)
+
+    def _instrument(self, method, db_label, operation, doc_class, page):
+        # Only the request itself is timed, not the time spent waiting for the rate limiter
+        def call(**params):
+            start = time.perf_counter()
+            try:
+                response = method(**params)
+            except Exception as e:
+                # Connection errors and timeouts have no error code so they are reported by class name
+                code = e.response['Error']['Code'] if isinstance(e, ClientError) else e.__class__.__name__
+                self._emit(build_event(db_label, operation, params, None, time.perf_counter() - start,
+                                       doc_class=doc_class, page=page, error=code))
+                raise
+            self._emit(build_event(db_label, operation, params, response, time.perf_counter() - start,
+                                   doc_class=doc_class, page=page))
+            return response
+        return call
+
+    def _emit(self, event):
+        for hook in self._metrics_hooks:
+            hook(event)
+
+    def get_table_name(self, db_label):
+        return self.get_settings(db_label)['connection']['table']
+
+    def describe_table(self, db_label, refresh=False):
+        """
+        Returns the DescribeTable description of the label's table. It is
+        only fetched from DynamoDB once unless refresh is True.
+        :param db_label: Name of the DB label
+        :param refresh: Fetch the description again
+        :return: dict
+        """
+        if refresh or db_label not in self._descriptions:
+            response = self.get_client(db_label).describe_table(TableName=self.get_table_name(db_label))
+            self.set_table_description(db_label, response['Table'])
+        return self._descriptions[db_label]
+
+    def set_table_description(self, db_label, description):
+        """
+        Caches (or clears if description is None) the table description for
+        the label and applies it to the current thread's Table resource.
+        :param db_label: Name of the DB label
+        :param description: DescribeTable description or None
+        :return: None
+        """
+        if description is None:
+            self._descriptions.pop(db_label, None)
+        else:
+            self._descriptions[db_label] = description
+        table = self._get_store(db_label).get('table')
+        if table is not None:
+            table.meta.data = description
+
+    def prewarm(self, labels=None, connections=1):
+        """
+        Pays the connection costs up front (e.g. in a Lambda init or worker
+        start-up hook) so the first request doesn't. For each label this
+        resolves credentials, caches the table description and index names, and
+        opens connections keep-alive connections that stay parked in the
+        client's pool.
+        :param labels: List of DB labels (default: all labels)
+        :param connections: Number of connections to open per label
+        :return: None
+        """
+        for db_label in labels or list(self.config.keys()):
+            with self._lock:
+                credentials = self.get_session().get_credentials()
+            if credentials is not None:
+                credentials.get_frozen_credentials()
+            self.describe_table(db_label, refresh=True)
+            self.get_table(db_label)
+            if self.get_settings(db_label).get('documents'):
+                self.get_index_names(db_label)
+            if connections > 1:
+                self._open_connections(db_label, connections)
+
+    def _open_connections(self, db_label, connections):
+        client = self.get_client(db_label)
+        connections = min(connections, client.meta.config.max_pool_connections)
+        # The barrier makes the requests overlap so each one needs its own connection
+        barrier = threading.Barrier(connections, timeout=10)
+        table_name = self.get_table_name(db_label)
+
+        def describe(i):
+            barrier.wait()
+            return client.describe_table(TableName=table_name)
+
+        with ThreadPoolExecutor(connections) as executor:
+            list(executor.map(describe, range(connections)))
+
+    def get_tables(self):
+        return {db_label: self.get_table(db_label) for db_label in self.config.keys()}
+
+    def get_connections(self):
+        return {db_label: self.get_connection(db_label) for db_label in self.config.keys()}
 
     def get_db(self, db_label):
         return self.get_settings(db_label)
@@ -64,6 +533,19 @@ class DocbHandler(object):
     def get_config(self, db_label):
         return self.get_settings(db_label).get('table_config')
 
+    def get_cursor_secret(self, db_label):
+        """
+        Returns the key pagination cursors are signed with: the label's
+        'cursor_secret' setting or the DOCB_CURSOR_SECRET environment variable.
+        :param db_label: Name of the DB label
+        :return: str
+        """
+        secret = self.get_settings(db_label).get('cursor_secret') or os.environ.get('DOCB_CURSOR_SECRET')
+        if not secret:
+            raise ImproperlyConfigured('Set cursor_secret for {} or the DOCB_CURSOR_SECRET environment variable '
+                                       'to use cursors.'.format(db_label))
+        return secret
+
     def get_settings(self, db_label):
         return self.config[db_label]
 
@@ -78,18 +560,24 @@ class DocbHandler(object):
         return doc_list
 
     def get_index_names(self, db_label, index_type='global'):
-        indexes = dict()
-        for i in self.get_documents_by_label(db_label):
-            indexes.update(i()._get_indexed_props_dict(index_type))
-        return indexes
+        try:
+            return self._index_names[(db_label, index_type)]
+        except KeyError:
+            indexes = dict()
+            for i in self.get_documents_by_label(db_label):
+                indexes.update(i()._get_indexed_props_dict(index_type))
+            return self._index_names.setdefault((db_label, index_type), indexes)
 
     def validate_table_config(self, db_label):
-        tc = docb.utils.TableConfig(**self.config[db_label]['table_config'])
+        # The table schemas need valley.contrib which is only used for deployment
+        import docb.config
+        tc = docb.config.TableConfig(**self.config[db_label]['table_config'])
         tc.validate()
         return tc
 
     def validate_table_connection(self, conn):
-        tc = docb.utils.TableConnection(**conn)
+        import docb.config
+        tc = docb.config.TableConnection(**conn)
         tc.validate()
         return tc
 
@@ -0,0 +1,173 @@
+"""
+Metrics for the DynamoDB calls a DocbHandler makes. Hooks added with
+DocbHandler.add_metrics_hook receive a MetricsEvent for every call.
+MetricsAggregator is a hook that keeps totals in memory and
+render_prometheus exports them in the Prometheus text format.
+"""
+import threading
+from collections import namedtuple
+
+from docb.throttle import READ_OPERATIONS
+
+MetricsEvent = namedtuple('MetricsEvent', ['db_label', 'doc_class', 'operation', 'index', 'read_units',
+                                           'write_units', 'scanned_count', 'count', 'page', 'latency', 'error'])
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def consumed_units(operation, consumed_capacity):
+    """
+    Splits the ConsumedCapacity of a response into read and write units.
+    :param operation: Name of the client method
+    :param consumed_capacity: dict, list of dicts or None
+    :return: (read_units, write_units)
+    """
+    if not consumed_capacity:
+        return 0.0, 0.0
+    if isinstance(consumed_capacity, dict):
+        consumed_capacity = [consumed_capacity]
+    read = write = 0.0
+    for capacity in consumed_capacity:
+        if 'ReadCapacityUnits' in capacity or 'WriteCapacityUnits' in capacity:
+            read += capacity.get('ReadCapacityUnits', 0)
+            write += capacity.get('WriteCapacityUnits', 0)
+        elif operation in READ_OPERATIONS:
+            read += capacity.get('CapacityUnits', 0)
+        else:
+            write += capacity.get('CapacityUnits', 0)
+    return read, write
+
+
+def build_event(db_label, operation, params, response, latency, doc_class=None, page=None, error=None):
+    """
+    :param db_label: Name of the DB label
+    :param operation: Name of the client method
+    :param params: Request parameters
+    :param response: Response dict or None if the call failed
+    :param latency: Seconds the call took
+    :param doc_class: Document class that made the call
+    :param page: Page number of a query or scan
+    :param error: Error code (or exception class name for errors without a code) if the call failed
+    :return: MetricsEvent
+    """
+    response = response or {}
+    read_units, write_units = consumed_units(operation, response.get('ConsumedCapacity'))
+    return MetricsEvent(db_label=db_label, doc_class=doc_class.__name__ if doc_class else None,
+                        operation=operation, index=params.get('IndexName'), read_units=read_units,
+                        write_units=write_units, scanned_count=response.get('ScannedCount'),
+                        count=response.get('Count'), page=page, latency=latency, error=error)
+
+
+class OperationStats(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.pages = 0
+        self.read_units = 0.0
+        self.write_units = 0.0
+        self.scanned_count = 0
+        self.count = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+
+    def add(self, event):
+        self.calls += 1
+        if event.error:
+            self.errors += 1
+        if event.page:
+            self.pages += 1
+        self.read_units += event.read_units
+        self.write_units += event.write_units
+        self.scanned_count += event.scanned_count or 0
+        self.count += event.count or 0
+        self.latency_sum += event.latency
+        self.latency_max = max(self.latency_max, event.latency)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if event.latency <= bound:
+                self.latency_buckets[i] += 1
+
+    def as_dict(self):
+        return {'calls': self.calls, 'errors': self.errors, 'pages': self.pages,
+                'read_units': self.read_units, 'write_units': self.write_units,
+                'scanned_count': self.scanned_count, 'count': self.count,
+                'latency_sum': self.latency_sum, 'latency_max': self.latency_max}
+
+
+class MetricsAggregator(object):
+    """
+    In-memory totals keyed by (db_label, doc_class, operation, index). Add
+    an instance with DocbHandler.add_metrics_hook.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = dict()
+
+    def __call__(self, event):
+        self.record(event)
+
+    def record(self, event):
+        key = (event.db_label, event.doc_class, event.operation, event.index)
+        with self.lock:
+            try:
+                stats = self.stats[key]
+            except KeyError:
+                stats = self.stats[key] = OperationStats()
+            stats.add(event)
+
+    def snapshot(self):
+        """
+        :return: dict of (db_label, doc_class, operation, index) to a dict of totals
+        """
+        with self.lock:
+            return {key: stats.as_dict() for key, stats in self.stats.items()}
+
+    def reset(self):
+        with self.lock:
+            self.stats = dict()
+
+
+def _labels(key, **extra):
+    names = ('db_label', 'doc_class', 'operation', 'index')
+    pairs = [(name, value) for name, value in zip(names, key) if value is not None] + sorted(extra.items())
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+COUNTERS = (
+    ('calls', 'requests_total', 'DynamoDB requests'),
+    ('errors', 'errors_total', 'DynamoDB requests that raised an error'),
+    ('pages', 'pages_total', 'Query and scan pages fetched'),
+    ('read_units', 'read_capacity_units_total', 'Consumed read capacity units'),
+    ('write_units', 'write_capacity_units_total', 'Consumed write capacity units'),
+    ('scanned_count', 'scanned_items_total', 'Items read before filter expressions were applied'),
+    ('count', 'returned_items_total', 'Items returned after filter expressions were applied'),
+)
+
+
+def render_prometheus(aggregator, prefix='docb'):
+    """
+    Exports the totals of a MetricsAggregator in the Prometheus text format.
+    :param aggregator: MetricsAggregator
+    :param prefix: Prefix of the metric names
+    :return: str
+    """
+    with aggregator.lock:
+        stats = sorted(aggregator.stats.items(), key=lambda i: tuple(str(v) for v in i[0]))
+        lines = []
+        for attr, name, help_text in COUNTERS:
+            name = '{}_{}'.format(prefix, name)
+            lines += ['# HELP {} {}'.format(name, help_text), '# TYPE {} counter'.format(name)]
+            for key, s in stats:
+                lines.append('{}{} {}'.format(name, _labels(key), getattr(s, attr)))
+        name = '{}_request_latency_seconds'.format(prefix)
+        lines += ['# HELP {} DynamoDB request latency'.format(name), '# TYPE {} histogram'.format(name)]
+        for key, s in stats:
+            for bound, count in zip(LATENCY_BUCKETS, s.latency_buckets):
+                lines.append('{}_bucket{} {}'.format(name, _labels(key, le=bound), count))
+            lines.append('{}_bucket{} {}'.format(name, _labels(key, le='+Inf'), s.calls))
+            lines.append('{}_sum{} {}'.format(name, _labels(key), s.latency_sum))
+            lines.append('{}_count{} {}'.format(name, _labels(key), s.calls))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,142 @@
+"""
+Helpers for reading query results one page at a time: background prefetch,
+Page objects and signed, URL-safe cursors.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import queue
+import threading
+
+from docb.exceptions import QueryError
+from docb.utils import bind_context
+
+_DONE = object()
+
+
+def prefetch(iterable, size):
+    """
+    Iterates over iterable in a background thread that keeps up to size
+    values ahead of the consumer. Closing the returned generator (or letting
+    it be garbage collected) stops the thread and closes iterable.
+    :param iterable: Iterable (e.g. a generator of pages)
+    :param size: Max number of values waiting for the consumer
+    :return: Generator
+    """
+    buffer = queue.Queue(maxsize=size)
+    stopped = threading.Event()
+
+    def put(value):
+        while not stopped.is_set():
+            try:
+                buffer.put(value, timeout=0.05)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        end = (_DONE, None)
+        try:
+            for value in iterable:
+                if not put((value, None)):
+                    return
+        except BaseException as e:
+            # Even SystemExit or KeyboardInterrupt is handed to the consumer so it doesn't wait forever
+            end = (None, e)
+        finally:
+            try:
+                close = getattr(iterable, 'close', None)
+                if close is not None:
+                    close()
+            finally:
+                put(end)
+
+    thread = threading.Thread(target=bind_context(produce), daemon=True)
+    thread.start()
+    try:
+        while True:
+            value, error = buffer.get()
+            if error is not None:
+                raise error
+            if value is _DONE:
+                return
+            yield value
+    finally:
+        stopped.set()
+        thread.join()
+
+
+class Page(object):
+    """
+    A page of documents. cursor is None on the last page, otherwise pass it to
+    QuerySet.after to get the documents that come after this page.
+    """
+
+    def __init__(self, items, cursor=None):
+        self.items = items
+        self.cursor = cursor
+
+    @property
+    def has_next(self):
+        return self.cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        return self.items[index]
+
+    def __repr__(self):
+        return '<Page: {} items has_next={}>'.format(len(self.items), self.has_next)
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def _sign(payload, secret, scope):
+    if isinstance(secret, str):
+        secret = secret.encode('utf-8')
+    return hmac.new(secret, payload + b'|' + scope.encode('utf-8'), hashlib.sha256).digest()[:16]
+
+
+def encode_cursor(key, secret, scope):
+    """
+    Encodes a wire format ExclusiveStartKey as a compact, URL-safe cursor
+    signed with HMAC-SHA256. scope is signed too (but not included) so the
+    cursor is only valid for the same query.
+    :param key: Wire format key dict
+    :param secret: Secret key
+    :param scope: str identifying the query
+    :return: str
+    """
+    payload = json.dumps(key, separators=(',', ':'), sort_keys=True).encode('utf-8')
+    return '{}.{}'.format(_b64encode(payload), _b64encode(_sign(payload, secret, scope)))
+
+
+def decode_cursor(cursor, secret, scope):
+    """
+    Verifies and decodes a cursor made by encode_cursor.
+    :param cursor: str
+    :param secret: Secret key
+    :param scope: str identifying the query
+    :return: Wire format key dict
+    """
+    try:
+        payload, signature = cursor.split('.')
+        payload = _b64decode(payload)
+        valid = hmac.compare_digest(_b64decode(signature), _sign(payload, secret, scope))
+    except (ValueError, TypeError, AttributeError):
+        valid = False
+    if not valid:
+        raise QueryError('Invalid cursor.')
+    return json.loads(payload.decode('utf-8'))
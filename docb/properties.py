@@ -3,11 +3,14 @@ Redis document property classes. Much of the date and time property
 code was borrowed or inspired by Benoit Chesneau's CouchDBKit library.
 """
 
+from valley.exceptions import ValidationException
 from valley.mixins import CharVariableMixin, IntegerVariableMixin, \
     FloatVariableMixin, SlugVariableMixin, \
     EmailVariableMixin, BooleanMixin, DateMixin, DateTimeMixin
 from valley.properties import BaseProperty as VBaseProperty
 
+from docb.utils import import_util
+
 
 class BaseProperty(VBaseProperty):
 
@@ -112,3 +115,51 @@ class DateTimeProperty(DateTimeMixin, BaseProperty):
             **kwargs)
         self.auto_now = auto_now
         self.auto_now_add = auto_now_add
+
+
+class ReferenceProperty(BaseProperty):
+    """
+    Stores the long _id of a document of another class. Reading the
+    attribute loads the referenced document with a get the first time
+    (see QuerySet.prefetch_related to load the references of many
+    documents at once). Assign a saved document or its _id.
+    """
+
+    def __init__(self, doc_class, **kwargs):
+        """
+        :param doc_class: Document class or its dotted path (for classes defined later)
+        """
+        super(ReferenceProperty, self).__init__(**kwargs)
+        self._doc_class = doc_class
+
+    def get_doc_class(self):
+        if isinstance(self._doc_class, str):
+            self._doc_class = import_util(self._doc_class)
+        return self._doc_class
+
+    def validate(self, value, key):
+        super(ReferenceProperty, self).validate(value, key)
+        if not value or isinstance(value, str):
+            return
+        doc_class = self.get_doc_class()
+        if not isinstance(value, doc_class) or not value._data.get('_id'):
+            raise ValidationException('{0}: This value should be a saved {1} or its _id'.format(
+                key, doc_class.__name__))
+
+    def get_id(self, value):
+        """
+        :param value: Document or short or long _id
+        :return: Long _id or None
+        """
+        if not value:
+            return None
+        if isinstance(value, str):
+            return self.get_doc_class().get_key(value)['_id']
+        return value._data.get('_id')
+
+    def get_db_value(self, value):
+        return self.get_id(value)
+
+    def get_python_value(self, value):
+        # Keeps loaded documents so they are only read once
+        return value or None
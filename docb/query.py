@@ -1,8 +1,16 @@
+from collections import namedtuple
 from statistics import mean
 
+from .codec import property_kind
 from .exceptions import QueryError
+from .metrics import consumed_units
 
 REPR_OUTPUT_SIZE = 20
+# Property kinds that mean and sum aggregate with NumPy
+COLUMN_KINDS = ('int', 'float', 'bool')
+
+# An __in filter split into one BatchGetItem key (keys) or one key query (querysets) per value
+FanOut = namedtuple('FanOut', ['prop', 'values', 'keys', 'querysets'])
 
 
 def create_list(a):
@@ -33,6 +41,135 @@ def combine_dicts(a, b, op=combine_list):
     return z
 
 
+class QueryPlan(object):
+    """
+    The compiled Query request of a QuerySet (see QuerySet.explain). If the
+    plan was analyzed scanned_count, count, pages and read_units are set.
+    """
+
+    def __init__(self, doc_class_name, params, post_filters=None, paginate_by=None, paginated=False,
+                 max_results=None, sort_attr=None, sort_reverse=False, estimated_read_units=None):
+        self.doc_class_name = doc_class_name
+        self.params = params
+        self.post_filters = post_filters or []
+        self.paginate_by = paginate_by
+        self.paginated = paginated
+        self.max_results = max_results
+        self.sort_attr = sort_attr
+        self.sort_reverse = sort_reverse
+        self.estimated_read_units = estimated_read_units
+        self.fan_out = None
+        self.analyzed = False
+        self.pages = None
+        self.scanned_count = None
+        self.count = None
+        self.read_units = None
+
+    @property
+    def table_name(self):
+        return self.params.get('TableName')
+
+    @property
+    def index_name(self):
+        return self.params.get('IndexName')
+
+    @property
+    def key_condition(self):
+        return self.params.get('KeyConditionExpression')
+
+    @property
+    def filter_expression(self):
+        return self.params.get('FilterExpression')
+
+    @property
+    def page_limit(self):
+        return self.params.get('Limit')
+
+    @property
+    def warnings(self):
+        warnings = ['{} runs as a FilterExpression after the items are read (and billed)'.format(key)
+                    for key in self.post_filters]
+        if self.post_filters and self.page_limit:
+            warnings.append('Limit is applied before the FilterExpression so pages can have fewer items')
+        if self.sort_attr:
+            warnings.append('Results are sorted by {} after every page is read'.format(self.sort_attr))
+        return warnings
+
+    def set_analysis(self, responses):
+        """
+        :param responses: Raw Query responses of each page
+        """
+        self.analyzed = True
+        self.pages = len(responses)
+        # BatchGetItem responses of a fan-out have Responses instead of counts
+        self.count = sum(r.get('Count', sum(len(i) for i in r.get('Responses', {}).values())) for r in responses)
+        self.scanned_count = sum(r.get('ScannedCount', 0) for r in responses) or self.count
+        self.read_units = sum(consumed_units('query', r.get('ConsumedCapacity'))[0] for r in responses)
+
+    def as_dict(self):
+        plan = {
+            'doc_class': self.doc_class_name,
+            'table': self.table_name,
+            'index': self.index_name,
+            'key_condition': self.key_condition,
+            'filter_expression': self.filter_expression,
+            'expression_attribute_names': self.params.get('ExpressionAttributeNames', {}),
+            'expression_attribute_values': self.params.get('ExpressionAttributeValues', {}),
+            'limit': self.page_limit,
+            'max_results': self.max_results,
+            'paginate_by': self.paginate_by,
+            'paginated': self.paginated,
+            'exclusive_start_key': self.params.get('ExclusiveStartKey'),
+            'sort_attr': self.sort_attr,
+            'sort_reverse': self.sort_reverse,
+            'post_filters': self.post_filters,
+            'estimated_read_units': self.estimated_read_units,
+            'fan_out': self.fan_out,
+            'warnings': self.warnings,
+        }
+        if self.analyzed:
+            plan.update({'pages': self.pages, 'scanned_count': self.scanned_count, 'count': self.count,
+                         'read_units': self.read_units})
+        return plan
+
+    def set_fan_out(self, fan_out):
+        """
+        :param fan_out: FanOut the query is split into
+        """
+        self.fan_out = {'property': fan_out.prop, 'values': len(fan_out.values),
+                        'operation': 'batch_get_item' if fan_out.keys is not None else 'query'}
+
+    def __str__(self):
+        if self.fan_out and self.fan_out['operation'] == 'batch_get_item':
+            lines = ['BatchGetItem {}: {} keys ({})'.format(
+                self.table_name, self.fan_out['values'], self.fan_out['property'])]
+        else:
+            lines = ['Query {} on {}'.format(self.table_name, self.index_name or 'the table'),
+                     '  Key condition: {}'.format(self.key_condition)]
+            if self.fan_out:
+                lines.append('  Fan-out: {} concurrent queries, one per {} value'.format(
+                    self.fan_out['values'], self.fan_out['property']))
+        if self.filter_expression:
+            lines.append('  Filter (post-read): {}'.format(self.filter_expression))
+        for name, key in (('Names', 'ExpressionAttributeNames'), ('Values', 'ExpressionAttributeValues')):
+            if self.params.get(key):
+                lines.append('  {}: {}'.format(name, self.params[key]))
+        if self.page_limit:
+            lines.append('  Limit: {}'.format(self.page_limit))
+        if self.paginated:
+            lines.append('  Paginated: only the first page is read')
+        if self.estimated_read_units is not None:
+            lines.append('  Estimated read units per key: {:.2f}'.format(self.estimated_read_units))
+        if self.analyzed:
+            lines.append('  Pages: {} Scanned: {} Returned: {} Read units: {}'.format(
+                self.pages, self.scanned_count, self.count, self.read_units))
+        lines += ['  Warning: {}'.format(w) for w in self.warnings]
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return '<QueryPlan: {} on {}>'.format(self.doc_class_name, self.index_name or self.table_name)
+
+
 class QuerySetMixin(object):
     query_type = None
 
@@ -53,6 +190,7 @@ class QuerySetMixin(object):
         self.global_index = global_index
         self.index_name = index_name
         self.evaluated = False
+        self.prefetch_fields = ()
         if q and parent_q:
             self.q = self.combine_qs()
 
@@ -77,17 +215,54 @@ class QuerySetMixin(object):
         if self._result_cache is None:
             self._result_cache = list(self.evaluate())
 
+    def aggregate(self):
+        """
+        Returns the write-maintained aggregate (see docb.aggregates) that
+        matches the query or None.
+        """
+        return self._doc_class().get_aggregate(self)
+
+    def _field_aggregate(self, attr):
+        aggregate = self.aggregate()
+        if aggregate is not None and attr in aggregate.fields:
+            return aggregate
+        return None
+
     def count(self):
+        aggregate = self.aggregate()
+        if aggregate is not None:
+            return aggregate.count
         return len(list(self.evaluate()))
 
     def attr_list(self, attr):
         self._doc_class._base_properties[attr]
         return [getattr(i, attr) for i in self.evaluate()]
 
+    def _columns(self, attr):
+        # Numbers are read into a NumPy column (see to_columns) instead of documents when NumPy is installed
+        if property_kind(self._doc_class._base_properties[attr]) not in COLUMN_KINDS:
+            return None
+        from .columns import np
+        if np is None:
+            return None
+        return self.to_columns([attr])
+
     def mean(self, attr):
+        aggregate = self._field_aggregate(attr)
+        if aggregate is not None:
+            return aggregate.mean(attr)
+        columns = self._columns(attr)
+        if columns is not None:
+            return columns.mean(attr)
         return mean(self.attr_list(attr))
 
     def sum(self, attr):
+        aggregate = self._field_aggregate(attr)
+        if aggregate is not None:
+            return aggregate.sum(attr)
+        columns = self._columns(attr)
+        if columns is not None:
+            return columns.sum(attr)
         return sum(self.attr_list(attr))
 
     def __bool__(self):
@@ -107,16 +282,20 @@ class QuerySetMixin(object):
 
 class QuerySet(QuerySetMixin):
 
+    def _chain(self, qs):
+        qs.prefetch_fields = self.prefetch_fields
+        return qs
+
     def filter(self, q, sort_attr=None, sort_reverse=False, limit=None, paginate_by=None, paginated=False, start_key=None):
         q.update({'_doc_type': self._doc_class.__name__})
-        return QuerySet(self._doc_class, q, self.q, sort_attr=sort_attr, sort_reverse=sort_reverse, limit=limit,
-                        paginate_by=paginate_by, start_key=start_key, paginated=paginated)
+        return self._chain(QuerySet(self._doc_class, q, self.q, sort_attr=sort_attr, sort_reverse=sort_reverse,
+                                    limit=limit, paginate_by=paginate_by, start_key=start_key, paginated=paginated))
 
     def gfilter(self, q, index_name=None, sort_attr=None, sort_reverse=False, limit=None, paginate_by=None,
                 paginated=False, start_key=None):
-        return QuerySet(self._doc_class, q, self.q, global_index=True, index_name=index_name, sort_attr=sort_attr,
-                        sort_reverse=sort_reverse, limit=limit, paginate_by=paginate_by, paginated=paginated,
-                        start_key=start_key)
+        return self._chain(QuerySet(self._doc_class, q, self.q, global_index=True, index_name=index_name,
+                                    sort_attr=sort_attr, sort_reverse=sort_reverse, limit=limit,
+                                    paginate_by=paginate_by, paginated=paginated, start_key=start_key))
 
     def get(self, q):
         q.update({'_doc_type': self._doc_class.__name__})
@@ -131,14 +310,108 @@ class QuerySet(QuerySetMixin):
         return qs[0]
 
     def all(self, sort_attr=None, sort_reverse=False, limit=None, paginate_by=None, paginated=False, start_key=None):
-        return QuerySet(self._doc_class,
-                        {'_doc_type': self._doc_class.__name__}, self.q, sort_attr=sort_attr,
-                        sort_reverse=sort_reverse, limit=limit, paginate_by=paginate_by, paginated=paginated,
-                        start_key=start_key)
+        return self._chain(QuerySet(self._doc_class,
+                                    {'_doc_type': self._doc_class.__name__}, self.q, sort_attr=sort_attr,
+                                    sort_reverse=sort_reverse, limit=limit, paginate_by=paginate_by,
+                                    paginated=paginated, start_key=start_key))
+
+    def prefetch_related(self, *fields):
+        """
+        Returns a copy of the QuerySet that loads the documents of the
+        ReferenceProperty fields with batched reads: one concurrent
+        BatchGetItem per 100 distinct references of each page instead of a
+        get per document.
+        :param fields: Names of ReferenceProperty fields
+        :return: QuerySet
+        """
+        qs = self.__class__(self._doc_class, self.q, global_index=self.global_index, index_name=self.index_name,
+                            sort_attr=self.sort_attr, sort_reverse=self.sort_reverse, limit=self.limit,
+                            paginate_by=self.paginate_by, paginated=self.paginated, start_key=self.start_key)
+        qs.prefetch_fields = tuple(self.prefetch_fields) + fields
+        return qs
 
     def evaluate(self):
+        if self.prefetch_fields:
+            return iter(self._doc_class.prefetch_references(list(self._doc_class().evaluate(self)),
+                                                            self.prefetch_fields))
         return self._doc_class().evaluate(self)
 
+    def iterator(self, prefetch=0):
+        """
+        Yields documents as pages are read without caching the results.
+        :param prefetch: Number of pages fetched ahead on a background thread while the current page is processed
+        :return: Generator of documents
+        """
+        doc = self._doc_class()
+        pages = doc.iter_pages(self, prefetch=prefetch)
+        try:
+            for items in pages:
+                docs = [self._doc_class.from_item(item) for item in items]
+                if self.prefetch_fields:
+                    self._doc_class.prefetch_references(docs, self.prefetch_fields)
+                yield from docs
+        finally:
+            pages.close()
+
+    def to_columns(self, fields=None, prefetch=0):
+        """
+        Streams the matching items into typed NumPy arrays without building
+        documents. Requires NumPy.
+        :param fields: Names of the columns (default: every property)
+        :param prefetch: Number of pages fetched ahead on a background thread
+        :return: docb.columns.Columns
+        """
+        from .columns import from_pages
+        return from_pages(self._doc_class, self._doc_class().iter_pages(self, prefetch=prefetch), fields)
+
+    def export(self, path, format='parquet', fields=None, segments=1, prefetch=0):
+        """
+        Streams the matching items to a Parquet, CSV or Arrow file on disk or
+        in S3 (s3://bucket/key). With segments > 1 the table is read with a
+        parallel Scan and each segment is written to its own file in the
+        directory path. See Document.export.
+        :return: Number of items exported
+        """
+        return self._doc_class().export(self, path, format=format, fields=fields, segments=segments,
+                                        prefetch=prefetch)
+
+    def pages(self, page_size=20):
+        """
+        Yields docb.pagination.Page objects of page_size documents. Each page
+        has a signed cursor that QuerySet.after takes to continue from there.
+        :param page_size: Number of documents per page
+        :return: Generator of Page
+        """
+        return self._doc_class().iter_cursor_pages(self, page_size)
+
+    def after(self, cursor):
+        """
+        Returns a copy of the QuerySet that starts after the page the cursor came from.
+        :param cursor: Page.cursor of the same query
+        :return: QuerySet
+        """
+        start_key = self._doc_class().decode_cursor(self, cursor)
+        return self._chain(self.__class__(self._doc_class, self.q, global_index=self.global_index,
+                                          index_name=self.index_name, sort_attr=self.sort_attr,
+                                          sort_reverse=self.sort_reverse, limit=self.limit,
+                                          paginate_by=self.paginate_by, paginated=self.paginated,
+                                          start_key=start_key))
+
+    def update(self, **changes):
+        """
+        Applies changes (values or docb.expressions.F expressions) to every
+        matching document with concurrent UpdateItem calls.
+        :return: Number of documents updated
+        """
+        return self._doc_class().bulk_update(self, changes)
+
+    def explain(self, analyze=False):
+        """
+        Returns the QueryPlan of the query. With analyze=True the query is run
+        and the plan has the scanned and returned counts, pages and consumed capacity.
+        """
+        return self._doc_class().explain(self, analyze=analyze)
+
 
 class QueryManager(object):
 
@@ -149,3 +422,24 @@ class QueryManager(object):
         self.gfilter = QuerySet(self._doc_class).gfilter
         self.get = QuerySet(self._doc_class).get
         self.all = QuerySet(self._doc_class).all
+        self.prefetch_related = QuerySet(self._doc_class).prefetch_related
+
+    def update(self, pk, **changes):
+        """
+        Updates the document with pk with one UpdateItem call, without reading
+        it first, e.g. update(pk, no_subscriptions=F('no_subscriptions') + 1).
+        :param pk: Short or long _id
+        :param changes: Values or docb.expressions.F expressions
+        :return: The updated document
+        """
+        item = self._doc_class().update_item(self._doc_class.get_key(pk), changes)
+        if item is None:
+            raise QueryError('No {} with the pk of {} found.'.format(self._doc_class.__name__, pk))
+        doc = self._doc_class(**item)
+        identity_map = self._doc_class.Meta.handler.get_identity_map()
+        if identity_map is not None:
+            # The instance loaded in the session gets the updated values
+            loaded = identity_map.add(doc)
+            loaded._data = doc._data
+            return loaded
+        return doc
@@ -0,0 +1,62 @@
+"""
+Identity map for the documents loaded inside a DocbHandler.session()
+block, e.g. one web request. Every key maps to a single Document instance:
+get and get_many return the instance that is already in the map without
+reading it again, and query results reuse it instead of building a new one.
+
+The map is kept in a ContextVar, so threads and asyncio tasks that enter
+their own session don't share documents.
+"""
+
+
+class IdentityMap(object):
+
+    def __init__(self):
+        self.docs = dict()
+
+    @staticmethod
+    def get_key(doc_class, doc_id):
+        return doc_class.Meta.use_db, doc_class.get_key(doc_id)['_doc_type'], doc_id
+
+    def get(self, doc_class, doc_id):
+        """
+        :param doc_class: Document class
+        :param doc_id: Long _id
+        :return: Document or None
+        """
+        return self.docs.get(self.get_key(doc_class, doc_id))
+
+    def add(self, doc):
+        """
+        Adds a loaded document unless the map already has one with its key.
+        :param doc: Document
+        :return: The document in the map
+        """
+        return self.docs.setdefault(self.get_key(doc.__class__, doc._data['_id']), doc)
+
+    def put(self, doc):
+        """
+        Adds a saved document, replacing the one with the same key.
+        :param doc: Document
+        :return: None
+        """
+        self.docs[self.get_key(doc.__class__, doc._data['_id'])] = doc
+
+    def remove(self, doc_class, doc_id):
+        """
+        Drops the document of a key, e.g. after it was deleted or updated without being read.
+        :param doc_class: Document class
+        :param doc_id: Long _id
+        :return: None
+        """
+        self.docs.pop(self.get_key(doc_class, doc_id), None)
+
+    def clear(self):
+        self.docs.clear()
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __contains__(self, doc):
+        doc_id = doc._data.get('_id')
+        return doc_id is not None and self.docs.get(self.get_key(doc.__class__, doc_id)) is doc
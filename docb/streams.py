@@ -0,0 +1,275 @@
+"""
+Change-feed consumer for a label's DynamoDB Stream. Shards are read in
+parallel, records are decoded into Document instances and handed to the
+handlers registered for their class in batches, and the sequence number of
+every batch that was handled is saved to a checkpoint store.
+"""
+import json
+import os
+import threading
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+import docb.utils
+from docb.exceptions import ImproperlyConfigured
+
+# new and old are Document instances (None when the stream view type or event doesn't include the image)
+ChangeEvent = namedtuple('ChangeEvent', ['event_name', 'doc_class', 'new', 'old', 'keys', 'sequence_number',
+                                         'shard_id'])
+
+
+class CheckpointStore(object):
+    """
+    Base class for checkpoint stores. Subclasses save the last handled
+    sequence number of each shard (e.g. in a database).
+    """
+
+    def get(self, stream_arn, shard_id):
+        """
+        :return: The last handled sequence number of the shard or None
+        """
+        raise NotImplementedError
+
+    def set(self, stream_arn, shard_id, sequence_number):
+        raise NotImplementedError
+
+
+class MemoryCheckpointStore(CheckpointStore):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkpoints = dict()
+
+    def get(self, stream_arn, shard_id):
+        return self.checkpoints.get((stream_arn, shard_id))
+
+    def set(self, stream_arn, shard_id, sequence_number):
+        with self.lock:
+            self.checkpoints[(stream_arn, shard_id)] = sequence_number
+
+
+class FileCheckpointStore(CheckpointStore):
+    """
+    Keeps checkpoints in a JSON file. The file is replaced atomically on every
+    checkpoint so it is never left half written.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.checkpoints = json.load(f)
+        except FileNotFoundError:
+            self.checkpoints = dict()
+
+    def get(self, stream_arn, shard_id):
+        return self.checkpoints.get(stream_arn, {}).get(shard_id)
+
+    def set(self, stream_arn, shard_id, sequence_number):
+        with self.lock:
+            self.checkpoints.setdefault(stream_arn, {})[shard_id] = sequence_number
+            tmp_path = '{}.tmp'.format(self.path)
+            with open(tmp_path, 'w') as f:
+                json.dump(self.checkpoints, f)
+            os.replace(tmp_path, self.path)
+
+
+class StreamProcessor(object):
+    """
+    Example:
+    processor = StreamProcessor(handler, 'dynamodb', FileCheckpointStore('checkpoints.json'))
+    processor.register(TestDocument, invalidate_cache)
+    processor.run()
+
+    Handlers are called with a list of ChangeEvents of their class in stream
+    order. A shard's checkpoint is only saved after every handler of a batch
+    returned, so records are delivered at least once: if a handler raises,
+    the batch is read again by the next run. Records of classes without a
+    handler are skipped.
+    """
+
+    def __init__(self, handler, db_label, checkpoint_store=None, batch_size=100, workers=4,
+                 iterator_type='TRIM_HORIZON', poll_interval=1.0):
+        """
+        :param handler: DocbHandler
+        :param db_label: Name of the DB label whose table has a stream (see 'stream_enabled' in table_config)
+        :param checkpoint_store: CheckpointStore (default: MemoryCheckpointStore)
+        :param batch_size: Max records per GetRecords call and so per handler call
+        :param workers: Number of shards read in parallel
+        :param iterator_type: Where shards without a checkpoint are read from: 'TRIM_HORIZON' or 'LATEST'
+        :param poll_interval: Seconds run waits when every shard has been read to the end
+        """
+        self.handler = handler
+        self.db_label = db_label
+        self.checkpoint_store = checkpoint_store or MemoryCheckpointStore()
+        self.batch_size = batch_size
+        self.workers = workers
+        self.iterator_type = iterator_type
+        self.poll_interval = poll_interval
+        self.handlers = OrderedDict()
+        self.doc_classes = dict()
+        self._stream_arn = None
+        self._iterators = dict()
+        self._finished = set()
+
+    def register(self, doc_class, callback):
+        """
+        :param doc_class: Document class
+        :param callback: Called with a list of ChangeEvents of doc_class
+        :return: callback
+        """
+        self.handlers.setdefault(doc_class, list()).append(callback)
+        self.doc_classes[docb.utils.get_doc_type(doc_class)] = doc_class
+        return callback
+
+    @property
+    def client(self):
+        return self.handler.get_streams_client(self.db_label)
+
+    @property
+    def stream_arn(self):
+        if self._stream_arn is None:
+            arn = self.handler.describe_table(self.db_label, refresh=True).get('LatestStreamArn')
+            if arn is None:
+                raise ImproperlyConfigured('The table of {} has no stream. Set stream_enabled in its '
+                                           'table_config.'.format(self.db_label))
+            self._stream_arn = arn
+        return self._stream_arn
+
+    def get_shards(self):
+        shards = list()
+        kwargs = {'StreamArn': self.stream_arn}
+        while True:
+            description = self.client.describe_stream(**kwargs)['StreamDescription']
+            shards += description['Shards']
+            if 'LastEvaluatedShardId' not in description:
+                return shards
+            kwargs['ExclusiveStartShardId'] = description['LastEvaluatedShardId']
+
+    def get_shard_levels(self, shards):
+        """
+        Groups shards so parents come before their children: records of an
+        item are only in order if a parent shard is read before its children.
+        :param shards: Shards from DescribeStream
+        :return: List of lists of shards
+        """
+        parents = {s['ShardId']: s.get('ParentShardId') for s in shards}
+
+        def depth(shard_id):
+            level = 0
+            while parents.get(shard_id) in parents:
+                shard_id = parents[shard_id]
+                level += 1
+            return level
+
+        levels = dict()
+        for shard in shards:
+            levels.setdefault(depth(shard['ShardId']), list()).append(shard)
+        return [levels[level] for level in sorted(levels)]
+
+    def get_shard_iterator(self, shard_id):
+        kwargs = {'StreamArn': self.stream_arn, 'ShardId': shard_id}
+        sequence_number = self.checkpoint_store.get(self.stream_arn, shard_id)
+        if sequence_number is None:
+            kwargs['ShardIteratorType'] = self.iterator_type
+        else:
+            kwargs.update({'ShardIteratorType': 'AFTER_SEQUENCE_NUMBER', 'SequenceNumber': sequence_number})
+        return self.client.get_shard_iterator(**kwargs)['ShardIterator']
+
+    def decode(self, record, shard_id):
+        """
+        :param record: Stream record
+        :param shard_id: Id of the record's shard
+        :return: ChangeEvent or None if the record's class has no handler
+        """
+        data = record['dynamodb']
+        keys = data['Keys']
+        doc_class = self.doc_classes.get(keys.get('_doc_type', {}).get('S'))
+        if doc_class is None:
+            return None
+        codec = doc_class.get_codec()
+        images = [doc_class(**codec.decode(data[image])) if image in data else None
+                  for image in ('NewImage', 'OldImage')]
+        return ChangeEvent(record['eventName'], doc_class, images[0], images[1], codec.decode_key(keys),
+                           data['SequenceNumber'], shard_id)
+
+    def dispatch(self, events):
+        """
+        Calls the handlers with the events of their class.
+        :param events: List of ChangeEvents
+        :return: None
+        """
+        batches = OrderedDict()
+        for event in events:
+            batches.setdefault(event.doc_class, list()).append(event)
+        for doc_class, batch in batches.items():
+            for callback in self.handlers[doc_class]:
+                callback(batch)
+
+    def process_shard(self, shard_id):
+        """
+        Reads a shard until it is closed or there are no more records yet.
+        :param shard_id: Shard id
+        :return: Number of records read
+        """
+        count = 0
+        # Continue where the last pass stopped so LATEST doesn't skip records written in between
+        iterator = self._iterators.pop(shard_id, None)
+        try:
+            if iterator is None:
+                iterator = self.get_shard_iterator(shard_id)
+            while iterator is not None:
+                try:
+                    response = self.client.get_records(ShardIterator=iterator, Limit=self.batch_size)
+                except ClientError as e:
+                    # Iterators expire after 15 minutes
+                    if e.response['Error']['Code'] != 'ExpiredIteratorException':
+                        raise
+                    iterator = self.get_shard_iterator(shard_id)
+                    continue
+                records = response['Records']
+                iterator = response.get('NextShardIterator')
+                if not records:
+                    break
+                events = [self.decode(record, shard_id) for record in records]
+                self.dispatch([event for event in events if event is not None])
+                self.checkpoint_store.set(self.stream_arn, shard_id, records[-1]['dynamodb']['SequenceNumber'])
+                count += len(records)
+        except ClientError as e:
+            # The shard was trimmed (records are kept for 24 hours)
+            if e.response['Error']['Code'] != 'ResourceNotFoundException':
+                raise
+            iterator = None
+        if iterator is None:
+            self._finished.add(shard_id)
+        else:
+            self._iterators[shard_id] = iterator
+        return count
+
+    def run_once(self):
+        """
+        Reads every shard of the stream up to its end, parents before children.
+        :return: Number of records read
+        """
+        count = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for shards in self.get_shard_levels(self.get_shards()):
+                shard_ids = [s['ShardId'] for s in shards if s['ShardId'] not in self._finished]
+                count += sum(executor.map(docb.utils.bind_context(self.process_shard), shard_ids))
+        return count
+
+    def run(self, stop_event=None):
+        """
+        Reads the stream until stop_event is set, waiting poll_interval
+        seconds whenever every shard has been read to the end. New shards are
+        picked up on every pass.
+        :param stop_event: threading.Event
+        :return: None
+        """
+        stop_event = stop_event or threading.Event()
+        while not stop_event.is_set():
+            if not self.run_once():
+                stop_event.wait(self.poll_interval)
@@ -16,7 +16,8 @@ def create_handler():
             'table_config': {
                 'write_capacity': 2,
                 'read_capacity': 2
-            }
+            },
+            'cursor_secret': 'docb-test-secret'
         },
     })
 
@@ -59,6 +60,13 @@ class DynamoTestCustomIndex(TestDocument):
                                         write_capacity=2, read_capacity=2)
 
 
+class VersionedDocument(TestDocument):
+
+    class Meta:
+        use_db = 'dynamodb'
+        versioned = True
+
+
 class Student(docb.document.Document):
     first_name = docb.properties.CharProperty(required=True)
     last_name = docb.properties.CharProperty(required=True)
@@ -1,3 +1,20 @@
 from .utils import *
+from .loading import *
+from .codec import *
+from .compiler import *
+from .bulk import *
+from .throttle import *
+from .metrics import *
+from .pagination import *
+from .cache import *
+from .transaction import *
+from .expressions import *
+from .streams import *
+from .aggregates import *
+from .columns import *
+from .export import *
+from .references import *
+from .batching import *
+from .session import *
 from .properties import *
 from .documents import *
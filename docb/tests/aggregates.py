@@ -0,0 +1,112 @@
+import statistics
+import unittest
+
+import docb.properties
+from docb.aggregates import get_deltas, TOTAL_ID
+from docb.exceptions import DocSaveError
+from docb.expressions import F
+from docb.testcase import DocbTestCase, TestDocument
+
+
+class AggregatedDocument(TestDocument):
+    state = docb.properties.CharProperty()
+
+    class Meta:
+        use_db = 'dynamodb'
+        aggregates = {'fields': ['gpa', 'no_subscriptions'], 'group_by': ['state']}
+
+
+class DeltasTestCase(unittest.TestCase):
+
+    def test_deltas(self):
+        old = {'gpa': 3.0, 'state': 'NC', 'no_subscriptions': 2}
+        new = {'gpa': 3.5, 'state': 'VA', 'no_subscriptions': 2}
+        deltas = get_deltas(AggregatedDocument, old, new)
+        self.assertEqual(deltas[TOTAL_ID], {'_sum_gpa': 0.5})
+        self.assertEqual(deltas['state=VA'], {'_count': 1, '_sum_gpa': 3.5, '_count_gpa': 1,
+                                              '_sum_no_subscriptions': 2, '_count_no_subscriptions': 1})
+        self.assertEqual(deltas['state=NC']['_count'], -1)
+        self.assertEqual(get_deltas(AggregatedDocument, None, {'state': 'NC'}),
+                         {TOTAL_ID: {'_count': 1}, 'state=NC': {'_count': 1}})
+        self.assertEqual(get_deltas(AggregatedDocument, new, new), {})
+
+
+class AggregatesTestCase(DocbTestCase):
+    doc_class = AggregatedDocument
+
+    def assertAggregates(self, qs):
+        docs = list(qs.iterator())
+        values = [d.gpa for d in docs if d.gpa is not None]
+        self.assertIsNotNone(qs.aggregate())
+        self.assertEqual(qs.count(), len(docs))
+        self.assertAlmostEqual(qs.sum('gpa'), sum(values))
+        self.assertEqual(qs.sum('no_subscriptions'), sum(d.no_subscriptions or 0 for d in docs))
+        if values:
+            self.assertAlmostEqual(qs.mean('gpa'), statistics.mean(values))
+
+    def check(self):
+        self.assertAggregates(AggregatedDocument.objects().all())
+        for state in ('NC', 'VA'):
+            self.assertAggregates(AggregatedDocument.objects().filter({'state': state}))
+
+    def test_save_delete(self):
+        alpha = AggregatedDocument(name='Alpha', gpa=3.0, state='NC')
+        alpha.save()
+        AggregatedDocument(name='Bravo', gpa=2.0, state='NC').save()
+        AggregatedDocument(name='Charlie', state='VA').save()
+        self.check()
+        alpha.state = 'VA'
+        alpha.gpa = 4.0
+        alpha.save()
+        self.check()
+        alpha.delete()
+        self.check()
+        with self.assertRaises(statistics.StatisticsError):
+            AggregatedDocument.objects().filter({'state': 'VA'}).mean('gpa')
+
+    def test_updates(self):
+        alpha = AggregatedDocument(name='Alpha', gpa=3.0, state='NC')
+        alpha.save()
+        doc = AggregatedDocument.objects().update(alpha.pk, gpa=F('gpa') + 1.5, state='VA')
+        self.assertEqual((doc.gpa, doc.state), (4.5, 'VA'))
+        self.check()
+        AggregatedDocument(name='Bravo', gpa=1.0, state='NC').save()
+        self.assertEqual(AggregatedDocument.objects().all().update(gpa=F('gpa') - 0.5), 2)
+        self.check()
+
+    def test_bulk_save(self):
+        docs = [AggregatedDocument(name='Name {}'.format(i), gpa=float(i), state=('NC', 'VA')[i % 2])
+                for i in range(30)]
+        AggregatedDocument().bulk_save(docs)
+        self.check()
+        docs = sorted(AggregatedDocument.objects().all(), key=lambda d: d.name)
+        docs[0].gpa = 10.0
+        docs[1].state = 'NC'
+        results = list(AggregatedDocument().iter_bulk_save(docs[:5], workers=2))
+        self.assertEqual([r.error for r in results if not r.success], [])
+        self.check()
+
+    def test_rebuild(self):
+        AggregatedDocument(name='Alpha', gpa=3.0, state='NC').save()
+        AggregatedDocument(name='Bravo', gpa=2.0, state='VA').save()
+        doc = AggregatedDocument()
+        doc.apply_aggregate_deltas({TOTAL_ID: {'_count': 5}, 'state=SC': {'_count': 1}})
+        self.assertEqual(AggregatedDocument.objects().all().count(), 7)
+        self.assertEqual(doc.rebuild_aggregates(), 3)
+        self.check()
+        self.assertEqual(AggregatedDocument.objects().filter({'state': 'SC'}).count(), 0)
+
+    def test_unmatched_queries(self):
+        AggregatedDocument(name='Alpha', gpa=3.0, state='NC').save()
+        self.assertIsNone(AggregatedDocument.objects().filter({'gpa': 3.0}).aggregate())
+        self.assertIsNone(AggregatedDocument.objects().all(limit=1).aggregate())
+        self.assertEqual(AggregatedDocument.objects().filter({'gpa': 3.0}).count(), 1)
+
+    def test_transaction(self):
+        with self.assertRaises(DocSaveError):
+            with self.docb_handler.transaction() as tx:
+                tx.save(AggregatedDocument(name='Alpha'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import asyncio
+import contextvars
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from docb.batching import AsyncGetBatcher, GetBatcher
+from docb.exceptions import QueryError
+from docb.testcase import DocbTestCase, TestDocument
+
+
+class FakeLoader(object):
+
+    def __init__(self, error=None):
+        self.calls = []
+        self.error = error
+        self.lock = threading.Lock()
+
+    def __call__(self, ids):
+        with self.lock:
+            self.calls.append(ids)
+        if self.error is not None:
+            raise self.error
+        return {i: {'_id': i} for i in ids if i != 'missing'}
+
+
+class GetBatcherTestCase(unittest.TestCase):
+
+    def test_coalesce(self):
+        loader = FakeLoader()
+        batcher = GetBatcher(loader, window=0.1)
+        ids = ['a', 'b', 'a', 'c', 'missing', 'b']
+        with ThreadPoolExecutor(len(ids)) as executor:
+            results = list(executor.map(batcher.load, ids))
+        self.assertEqual(results, [{'_id': 'a'}, {'_id': 'b'}, {'_id': 'a'}, {'_id': 'c'}, None, {'_id': 'b'}])
+        self.assertEqual(len(loader.calls), 1)
+        self.assertEqual(sorted(loader.calls[0]), ['a', 'b', 'c', 'missing'])
+        self.assertEqual(batcher.load('d'), {'_id': 'd'})
+        self.assertEqual(loader.calls[-1], ['d'])
+
+    def test_max_batch(self):
+        loader = FakeLoader()
+        batcher = GetBatcher(loader, window=0.05, max_batch=3)
+        with ThreadPoolExecutor(7) as executor:
+            results = list(executor.map(batcher.load, [str(i) for i in range(7)]))
+        self.assertEqual(results, [{'_id': str(i)} for i in range(7)])
+        self.assertTrue(all(len(ids) <= 3 for ids in loader.calls))
+        self.assertEqual(sorted(i for ids in loader.calls for i in ids), [str(i) for i in range(7)])
+
+    def test_error(self):
+        batcher = GetBatcher(FakeLoader(error=ValueError('failed')), window=0.05)
+        with ThreadPoolExecutor(3) as executor:
+            futures = [executor.submit(batcher.load, i) for i in 'abc']
+        for future in futures:
+            self.assertIsInstance(future.exception(), ValueError)
+
+    def test_from_config(self):
+        self.assertIsNone(GetBatcher.from_config(FakeLoader(), None))
+        self.assertEqual(GetBatcher.from_config(FakeLoader(), {'window': 0.01}).window, 0.01)
+
+
+class AsyncGetBatcherTestCase(unittest.TestCase):
+
+    def test_coalesce(self):
+        loader = FakeLoader()
+
+        async def run():
+            batcher = AsyncGetBatcher(loader, asyncio.get_running_loop())
+            first = await asyncio.gather(*[batcher.load(i) for i in ['a', 'b', 'a', 'missing']])
+            second = await batcher.load('c')
+            return first, second
+
+        first, second = asyncio.run(run())
+        self.assertEqual(first, [{'_id': 'a'}, {'_id': 'b'}, {'_id': 'a'}, None])
+        self.assertEqual(second, {'_id': 'c'})
+        self.assertEqual(loader.calls, [['a', 'b', 'missing'], ['c']])
+
+    def test_context(self):
+        priority = contextvars.ContextVar('priority', default='interactive')
+        seen = []
+
+        def load_items(ids):
+            seen.append(priority.get())
+            return {}
+
+        async def run():
+            priority.set('background')
+            batcher = AsyncGetBatcher(load_items, asyncio.get_running_loop())
+            await asyncio.gather(batcher.load('a'), batcher.load('b'))
+
+        asyncio.run(run())
+        # The read runs in the executor with the context of the caller
+        self.assertEqual(seen, ['background'])
+
+    def test_error(self):
+        async def run():
+            batcher = AsyncGetBatcher(FakeLoader(error=ValueError('failed')), asyncio.get_running_loop())
+            return await asyncio.gather(batcher.load('a'), batcher.load('b'), return_exceptions=True)
+
+        self.assertTrue(all(isinstance(r, ValueError) for r in asyncio.run(run())))
+
+
+class BatchedGetTestCase(DocbTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(BatchedGetTestCase, cls).setUpClass()
+        cls.docb_handler.config['dynamodb']['get_batching'] = {'window': 0.05}
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.docb_handler.config['dynamodb'].pop('get_batching')
+        super(BatchedGetTestCase, cls).tearDownClass()
+
+    def setUp(self):
+        self.docs = [TestDocument(name='Batched {}'.format(i)) for i in range(5)]
+        for doc in self.docs:
+            doc.save()
+        self.calls = []
+        self.hook = self.docb_handler.add_metrics_hook(lambda event: self.calls.append(event.operation))
+
+    def tearDown(self):
+        self.docb_handler.remove_metrics_hook(self.hook)
+        super(BatchedGetTestCase, self).tearDown()
+
+    def test_get(self):
+        pks = [doc.pk for doc in self.docs] + [self.docs[0]._id]
+        with ThreadPoolExecutor(len(pks)) as executor:
+            docs = list(executor.map(TestDocument.get, pks))
+        self.assertEqual([d.name for d in docs], [d.name for d in self.docs] + [self.docs[0].name])
+        self.assertIsNot(docs[0], docs[-1])
+        self.assertEqual(self.calls, ['batch_get_item'])
+        with self.assertRaises(QueryError):
+            TestDocument.get('missing')
+
+    def test_aget(self):
+        async def run():
+            return await asyncio.gather(*[TestDocument.aget(doc.pk) for doc in self.docs])
+
+        docs = asyncio.run(run())
+        self.assertEqual([d.name for d in docs], [d.name for d in self.docs])
+        self.assertEqual(self.calls, ['batch_get_item'])
+        with self.assertRaises(QueryError):
+            asyncio.run(TestDocument.aget('missing'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+import unittest
+
+from botocore.exceptions import ClientError
+
+from docb.bulk import (BatchWriter, BatchGetter, UniqueTracker, write_batches, backoff_delay, iter_chunks,
+                       prep_chunk, get_batches)
+from docb.exceptions import DocSaveError
+from docb.testcase import Student
+
+
+def make_item(i):
+    return {'_doc_type': {'S': 'Doc'}, '_id': {'S': str(i)}}
+
+
+class FakeClient(object):
+    """
+    Returns the first item of every request as unprocessed `unprocessed` times
+    and raises `errors` before succeeding.
+    """
+
+    def __init__(self, unprocessed=0, errors=()):
+        self.unprocessed = unprocessed
+        self.errors = list(errors)
+        self.calls = []
+
+    def batch_write_item(self, RequestItems):
+        self.calls.append(RequestItems)
+        if self.errors:
+            raise ClientError({'Error': {'Code': self.errors.pop(0)}}, 'BatchWriteItem')
+        requests = RequestItems['docbtest']
+        if self.unprocessed:
+            self.unprocessed -= 1
+            return {'UnprocessedItems': {'docbtest': requests[:1]}}
+        return {'UnprocessedItems': {}}
+
+
+class FakeGetClient(object):
+    """
+    Returns the last key of every request as unprocessed `unprocessed` times.
+    """
+
+    def __init__(self, unprocessed=0):
+        self.unprocessed = unprocessed
+        self.calls = []
+
+    def batch_get_item(self, RequestItems):
+        keys = RequestItems['docbtest']['Keys']
+        self.calls.append(keys)
+        if self.unprocessed:
+            self.unprocessed -= 1
+            return {'Responses': {'docbtest': keys[:-1]}, 'UnprocessedKeys': {'docbtest': {'Keys': keys[-1:]}}}
+        return {'Responses': {'docbtest': keys}, 'UnprocessedKeys': {}}
+
+
+class BatchGetterTestCase(unittest.TestCase):
+
+    def test_retries_unprocessed(self):
+        client = FakeGetClient(unprocessed=2)
+        items = BatchGetter(client, 'docbtest', base_delay=0).get([make_item(i) for i in range(3)])
+        self.assertEqual(sorted(i['_id']['S'] for i in items), ['0', '1', '2'])
+        self.assertEqual(len(client.calls), 3)
+
+    def test_get_batches(self):
+        client = FakeGetClient()
+        items = get_batches([make_item(i) for i in range(250)], BatchGetter(client, 'docbtest'), workers=3)
+        self.assertEqual(len(items), 250)
+        self.assertEqual(sorted(len(c) for c in client.calls), [50, 100, 100])
+
+
+class BatchWriterTestCase(unittest.TestCase):
+
+    def writer(self, client, max_retries=3):
+        return BatchWriter(client, 'docbtest', max_retries=max_retries, base_delay=0)
+
+    def test_backoff_delay(self):
+        for attempt in range(10):
+            self.assertTrue(0 <= backoff_delay(attempt, 0.05, 1.0) <= 1.0)
+
+    def test_retries_unprocessed(self):
+        client = FakeClient(unprocessed=2)
+        results = self.writer(client).write([(i, make_item(i)) for i in range(3)])
+        self.assertEqual(sorted(results), [(0, None), (1, None), (2, None)])
+        self.assertEqual(len(client.calls), 3)
+        self.assertEqual(len(client.calls[-1]['docbtest']), 1)
+
+    def test_gives_up_after_max_retries(self):
+        client = FakeClient(unprocessed=10)
+        results = dict(self.writer(client, max_retries=2).write([(i, make_item(i)) for i in range(3)]))
+        self.assertIsInstance(results[0], DocSaveError)
+        self.assertIsNone(results[1])
+        self.assertEqual(len(client.calls), 3)
+
+    def test_retries_throttling(self):
+        client = FakeClient(errors=['ProvisionedThroughputExceededException'])
+        results = self.writer(client).write([(0, make_item(0))])
+        self.assertEqual(results, [(0, None)])
+
+    def test_other_errors_fail_batch(self):
+        client = FakeClient(errors=['ValidationException'])
+        results = self.writer(client).write([(0, make_item(0)), (1, make_item(1))])
+        self.assertEqual([ref for ref, error in results], [0, 1])
+        self.assertTrue(all(isinstance(error, ClientError) for ref, error in results))
+        self.assertEqual(len(client.calls), 1)
+
+    def test_write_batches(self):
+        client = FakeClient(unprocessed=1)
+        entries = ((i, make_item(i) if i != 7 else ValueError('bad')) for i in range(100))
+        results = list(write_batches(entries, self.writer(client), workers=3, queue_size=2))
+        self.assertEqual(sorted(r.doc for r in results), list(range(100)))
+        self.assertEqual([r.doc for r in results if not r.success], [7])
+
+    def test_write_batches_closed_early(self):
+        client = FakeClient()
+        results = write_batches(((i, make_item(i)) for i in range(1000)), self.writer(client), workers=2)
+        next(results)
+        results.close()
+        self.assertLess(len(client.calls), 40)
+
+
+class BulkLoadTestCase(unittest.TestCase):
+
+    def test_iter_chunks(self):
+        chunks = list(iter_chunks((i for i in range(7)), 3))
+        self.assertEqual(chunks, [(0, [0, 1, 2]), (3, [3, 4, 5]), (6, [6])])
+
+    def test_prep_chunk(self):
+        rows = [dict(first_name='Brian', last_name='Jenkins', slug='brian-j', email='brian@docb.com',
+                     hometown='Durham', gpa=3.5),
+                dict(first_name='George', last_name='Jenkins')]
+        (first, item, error), second = prep_chunk(Student, 10, rows, check_unique=False)
+        self.assertEqual((first, error), (10, None))
+        self.assertEqual(item['gpa'], {'N': '3.5'})
+        self.assertEqual(item['_doc_type'], {'S': 'Student'})
+        self.assertEqual(second[0], 11)
+        self.assertIsNone(second[1])
+        self.assertTrue(second[2].startswith('ValidationException'))
+
+    def test_unique_tracker(self):
+        tracker = UniqueTracker(['slug', 'email'])
+        self.assertIsNone(tracker.check(0, {'slug': {'S': 'a'}, 'email': {'S': 'a@docb.com'}}))
+        self.assertIn('slug with the value of a in row 0', tracker.check(1, {'slug': {'S': 'a'}, 'email': {'S': 'b'}}))
+        # A rejected row doesn't claim its other values
+        self.assertIsNone(tracker.check(2, {'slug': {'S': 'c'}, 'email': {'S': 'b'}}))
+        self.assertIsNone(tracker.check(3, {'slug': {'NULL': True}}))
+        self.assertIsNone(tracker.check(4, {'slug': {'NULL': True}}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import unittest
+
+from docb.cache import QueryCache, ANY
+from docb.testcase import DocbTestCase, TestDocument, VersionedDocument
+from docb.tests.throttle import FakeClock
+
+
+class QueryCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = QueryCache(ttl=10, max_bytes=1000, clock=self.clock)
+
+    def test_from_config(self):
+        self.assertIsNone(QueryCache.from_config(None))
+        self.assertEqual(QueryCache.from_config(True).ttl, 60)
+        self.assertEqual(QueryCache.from_config({'ttl': 5, 'max_bytes': 100}).max_bytes, 100)
+
+    def test_ttl(self):
+        self.cache.set('q', 'Doc', self.cache.generation('Doc'), [1])
+        self.assertEqual(self.cache.get('q', 'Doc'), [1])
+        self.clock.now = 11
+        self.assertIsNone(self.cache.get('q', 'Doc'))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_invalidate(self):
+        self.cache.set('q', 'Doc', self.cache.generation('Doc'), [1])
+        self.cache.set('g', ANY, self.cache.generation(ANY), [2])
+        self.cache.set('o', 'Other', self.cache.generation('Other'), [3])
+        self.cache.invalidate('Doc')
+        self.assertIsNone(self.cache.get('q', 'Doc'))
+        self.assertIsNone(self.cache.get('g', ANY))
+        self.assertEqual(self.cache.get('o', 'Other'), [3])
+        self.cache.invalidate_all()
+        self.assertIsNone(self.cache.get('o', 'Other'))
+
+    def test_stale_set(self):
+        generation = self.cache.generation('Doc')
+        self.cache.invalidate('Doc')
+        self.cache.set('q', 'Doc', generation, [1])
+        self.assertIsNone(self.cache.get('q', 'Doc'))
+
+    def test_memory_budget(self):
+        value = ['x' * 300]
+        for key in ('a', 'b', 'c', 'd'):
+            self.cache.set(key, 'Doc', 0, value)
+            if key == 'b':
+                self.cache.get('a', 'Doc')
+        self.assertLessEqual(self.cache.size, 1000)
+        self.assertEqual(list(self.cache.entries.keys()), ['a', 'c', 'd'])
+        self.cache.set('big', 'Doc', 0, ['x' * 2000])
+        self.assertNotIn('big', self.cache.entries)
+
+
+class DocumentQueryCacheTestCase(DocbTestCase):
+    doc_class = TestDocument
+
+    def setUp(self):
+        super(DocumentQueryCacheTestCase, self).setUp()
+        self.settings = self.docb_handler.get_settings('dynamodb')
+        self.settings['query_cache'] = {'ttl': 60}
+        self.docb_handler._query_caches.pop('dynamodb', None)
+        self.cache = self.docb_handler.get_query_cache('dynamodb')
+        TestDocument(name='Alpha').save()
+
+    def tearDown(self):
+        self.settings.pop('query_cache')
+        self.docb_handler._query_caches.pop('dynamodb', None)
+        super(DocumentQueryCacheTestCase, self).tearDown()
+
+    def test_cached(self):
+        self.assertEqual(len(TestDocument.objects().all()), 1)
+        self.assertEqual(len(TestDocument.objects().all()), 1)
+        self.assertEqual(self.cache.hits, 1)
+        TestDocument(name='Bravo').save()
+        self.assertEqual(len(TestDocument.objects().all()), 2)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_key_per_class(self):
+        qs = TestDocument.objects().all()
+        self.assertNotEqual(TestDocument().get_query_cache_key(qs), VersionedDocument().get_query_cache_key(qs))
+
+    def test_items_copied(self):
+        client = self.docb_handler.get_client('dynamodb')
+        client.put_item(TableName='docbtest', Item={'_doc_type': {'S': 'TestDocument'}, '_id': {'S': 'tags'},
+                                                    'tags': {'L': [{'S': 'a'}]}})
+        qs = TestDocument.objects().filter({'_id': 'tags'})
+        items = TestDocument().get_doc_list(qs)
+        items[0]['tags'].append('b')
+        self.assertEqual(TestDocument().get_doc_list(qs)[0]['tags'], ['a'])
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_invalidated_by_writes(self):
+        doc = TestDocument.objects().get({'name': 'Alpha'})
+        len(TestDocument.objects().all())
+        doc.delete()
+        self.assertEqual(len(TestDocument.objects().all()), 0)
+        TestDocument().bulk_save([TestDocument(name='Charlie')])
+        self.assertEqual(len(TestDocument.objects().all()), 1)
+        TestDocument().flush_db()
+        self.assertEqual(len(TestDocument.objects().all()), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import decimal
+import unittest
+
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+
+from docb.codec import DocumentCodec, encode_value, property_kind
+from docb.testcase import DocbTestCase, Student, TestDocument
+
+
+class CodecTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.doc = {
+            '_id': 'abc:id:dynamodb:TestDocument',
+            '_doc_type': 'TestDocument',
+            'name': 'Brian',
+            'last_updated': '2019-01-01T12:00:00Z',
+            'date_created': '2019-01-01',
+            'is_active': False,
+            'no_subscriptions': 3,
+            'gpa': 3.25,
+            'nickname': 'Bri',
+            'scores': [1, 2],
+        }
+
+    def test_property_kind(self):
+        props = TestDocument._base_properties
+        self.assertEqual(property_kind(props['name']), 'str')
+        self.assertEqual(property_kind(props['no_subscriptions']), 'int')
+        self.assertEqual(property_kind(props['gpa']), 'float')
+        self.assertEqual(property_kind(props['is_active']), 'bool')
+        self.assertEqual(property_kind(props['date_created']), 'date')
+        self.assertEqual(property_kind(props['last_updated']), 'datetime')
+
+    def test_encode_matches_type_serializer(self):
+        serializer = TypeSerializer()
+        expected = {k: serializer.serialize(decimal.Decimal(str(v)) if type(v) == float else v)
+                    for k, v in self.doc.items()}
+        self.assertEqual(DocumentCodec(TestDocument).encode(self.doc), expected)
+
+    def test_decode(self):
+        codec = DocumentCodec(TestDocument)
+        item = codec.encode(self.doc)
+        decoded = codec.decode(item)
+        self.assertEqual(decoded, self.doc)
+        self.assertIs(type(decoded['no_subscriptions']), int)
+        self.assertIs(type(decoded['gpa']), float)
+        # Undeclared attributes use the generic deserializer
+        self.assertEqual(decoded['scores'], TypeDeserializer().deserialize(item['scores']))
+
+    def test_decode_unexpected_type(self):
+        codec = DocumentCodec(Student)
+        self.assertEqual(codec.decode({'gpa': {'S': 'n/a'}}), {'gpa': 'n/a'})
+
+    def test_encode_value(self):
+        self.assertEqual(encode_value(2.5), {'N': '2.5'})
+        self.assertEqual(encode_value(decimal.Decimal('2.5')), {'N': '2.5'})
+        self.assertEqual(encode_value(True), {'BOOL': True})
+        self.assertEqual(encode_value(None), {'NULL': True})
+
+
+class DecodedTypesTestCase(DocbTestCase):
+
+    def test_get(self):
+        doc = TestDocument(name='Decoded', no_subscriptions=3, gpa=3.25)
+        doc.save()
+        for loaded in (TestDocument.get(doc.pk), TestDocument.objects().get({'name': 'Decoded'})):
+            # Declared numbers are read as int and float, not Decimal
+            self.assertIs(type(loaded._data['no_subscriptions']), int)
+            self.assertIs(type(loaded._data['gpa']), float)
+            self.assertEqual(loaded.gpa, 3.25)
+
+
+if __name__ == '__main__':
+    unittest.main()
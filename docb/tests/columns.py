@@ -0,0 +1,102 @@
+import datetime
+import statistics
+import unittest
+from collections import OrderedDict
+from unittest import mock
+
+import docb.properties
+from docb.columns import ColumnBuilder, from_pages, np
+from docb.testcase import DocbTestCase, TestDocument
+
+
+class ColumnDocument(TestDocument):
+    state = docb.properties.CharProperty()
+
+    class Meta:
+        use_db = 'dynamodb'
+
+
+@unittest.skipIf(np is None, 'NumPy is not installed')
+class ColumnBuilderTestCase(unittest.TestCase):
+
+    def test_grow(self):
+        builder = ColumnBuilder(OrderedDict([('n', np.dtype('int64')), ('s', np.dtype(object))]), capacity=2)
+        builder.append([{'n': 1, 's': 'a'}, {'s': 'b'}, {'n': 3}])
+        builder.append([{'n': i} for i in range(10)])
+        self.assertEqual(builder.capacity, 16)
+        columns = builder.build()
+        self.assertEqual(len(columns), 13)
+        self.assertEqual(columns['n'].dtype, np.int64)
+        self.assertEqual(columns['n'][:3].tolist(), [1, None, 3])
+        self.assertEqual(columns['s'].count(), 2)
+        self.assertEqual(columns.sum('n'), 49)
+
+    def test_types(self):
+        pages = [[{'gpa': 3.5, 'is_active': True, 'date_created': '2026-10-19',
+                   'last_updated': '2026-10-19T00:18:01Z'}], [{'gpa': None, 'is_active': False}]]
+        columns = from_pages(ColumnDocument, pages, ['gpa', 'is_active', 'date_created', 'last_updated'])
+        self.assertEqual(columns['gpa'].dtype, np.float64)
+        self.assertEqual(columns['is_active'].tolist(), [True, False])
+        self.assertEqual(columns.min('date_created'), datetime.date(2026, 10, 19))
+        self.assertEqual(columns.max('last_updated'), datetime.datetime(2026, 10, 19, 0, 18, 1))
+        self.assertEqual(columns.count('last_updated'), 1)
+        self.assertEqual(columns.mean('gpa'), 3.5)
+        empty = from_pages(ColumnDocument, [], ['gpa'])
+        self.assertEqual((len(empty), empty.sum('gpa')), (0, 0))
+        with self.assertRaises(statistics.StatisticsError):
+            empty.mean('gpa')
+        with self.assertRaises(KeyError):
+            empty['name']
+
+    def test_group_by(self):
+        pages = [[{'state': 'VA', 'gpa': 3.0, 'no_subscriptions': 2}, {'state': 'NC', 'gpa': 2.0},
+                  {'state': 'VA', 'gpa': 4.0, 'no_subscriptions': 3}, {'state': 'SC'}, {'gpa': 1.0}]]
+        groups = from_pages(ColumnDocument, pages).group_by('state')
+        self.assertEqual(list(groups.count().items()), [('NC', 1), ('SC', 1), ('VA', 2)])
+        self.assertEqual(groups.count('gpa'), {'NC': 1, 'SC': 0, 'VA': 2})
+        self.assertEqual(groups.sum('no_subscriptions'), {'NC': 0, 'SC': 0, 'VA': 5})
+        self.assertEqual(groups.mean('gpa'), {'NC': 2.0, 'SC': None, 'VA': 3.5})
+        self.assertEqual(groups.min('gpa'), {'NC': 2.0, 'SC': None, 'VA': 3.0})
+        self.assertEqual(groups.max('gpa'), {'NC': 2.0, 'SC': None, 'VA': 4.0})
+        self.assertEqual(groups.percentile('gpa', 50), {'NC': 2.0, 'SC': None, 'VA': 3.5})
+
+
+@unittest.skipIf(np is None, 'NumPy is not installed')
+class ToColumnsTestCase(DocbTestCase):
+    doc_class = ColumnDocument
+
+    def test_to_columns(self):
+        ColumnDocument().bulk_save([ColumnDocument(name='Name {}'.format(i), gpa=float(i), no_subscriptions=i + 1,
+                                                   state=('NC', 'VA')[i % 2]) for i in range(20)])
+        columns = ColumnDocument.objects().all(paginate_by=7).to_columns(['gpa', 'no_subscriptions', 'state'])
+        self.assertEqual(len(columns), 20)
+        gpas = [float(i) for i in range(20)]
+        # FloatProperty stores 0.0 as missing
+        self.assertEqual(columns.count('gpa'), 19)
+        self.assertAlmostEqual(columns.sum('gpa'), sum(gpas))
+        self.assertAlmostEqual(columns.mean('gpa'), statistics.mean(gpas[1:]))
+        self.assertEqual((columns.min('no_subscriptions'), columns.max('no_subscriptions')), (1, 20))
+        self.assertEqual(columns.percentile('no_subscriptions', [0, 100]), [1.0, 20.0])
+        self.assertEqual(columns.group_by('state').count(), {'NC': 10, 'VA': 10})
+        self.assertEqual(columns.group_by('state').sum('no_subscriptions'), {'NC': 100, 'VA': 110})
+
+        columns = ColumnDocument.objects().filter({'state': 'VA'}).to_columns()
+        self.assertEqual(len(columns), 10)
+        self.assertIn('date_created', columns)
+
+    def test_mean_sum(self):
+        ColumnDocument().bulk_save([ColumnDocument(name='Name {}'.format(i), gpa=float(i), no_subscriptions=i + 1,
+                                                   state=('NC', 'VA')[i % 2]) for i in range(10)])
+        qs = ColumnDocument.objects().all()
+        # Read as columns without building documents
+        with mock.patch.object(ColumnDocument, 'from_item', side_effect=AssertionError):
+            self.assertEqual(qs.sum('no_subscriptions'), 55)
+            self.assertIs(type(qs.sum('no_subscriptions')), int)
+            self.assertAlmostEqual(qs.mean('gpa'), 5.0)
+        with mock.patch('docb.columns.np', None):
+            self.assertEqual(qs.sum('no_subscriptions'), 55)
+            self.assertEqual(qs.mean('no_subscriptions'), 5.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import datetime
+import unittest
+
+import docb.utils
+from docb.document import Document
+from docb.properties import (CharProperty, SlugProperty, EmailProperty, IntegerProperty, FloatProperty,
+                             BooleanProperty, DateProperty, DateTimeProperty)
+from valley.exceptions import ValidationException
+
+
+class UpperCharProperty(CharProperty):
+
+    def get_db_value(self, value):
+        if not value:
+            return
+        return str(value).upper()
+
+
+class Profile(Document):
+    name = CharProperty(required=True, min_length=2, max_length=10, unique=True)
+    slug = SlugProperty()
+    email = EmailProperty()
+    code = UpperCharProperty(default_value='abc')
+    age = IntegerProperty(min_value=1, max_value=120)
+    score = FloatProperty(default_value=1.5)
+    is_admin = BooleanProperty()
+    birthday = DateProperty(required=False)
+    joined = DateTimeProperty(required=False)
+
+    def check_unique(self, key, value):
+        self.unique_checks.append((key, value))
+        return True
+
+
+def legacy_prep_doc(self, create_pk=False):
+    """
+    The generic prep_doc loop the compiled function replaces.
+    """
+    doc = self._data.copy()
+    for key, prop in list(self._base_properties.items()):
+        prop.validate(doc.get(key), key)
+        v = doc.get(key)
+
+        raw_value = prop.get_python_value(doc.get(key))
+        if prop.unique:
+            self.check_unique(key, raw_value)
+
+        if v or v is False:
+            value = prop.get_db_value(raw_value)
+            doc[key] = value
+        else:
+            try:
+                doc.pop(key)
+            except KeyError:
+                pass
+
+    doc['_doc_type'] = docb.utils.get_doc_type(self.__class__)
+    return doc
+
+
+def run(prep, **kwargs):
+    doc = Profile(**kwargs)
+    doc.unique_checks = []
+    try:
+        return prep(doc), doc.unique_checks
+    except ValidationException as e:
+        return str(e), doc.unique_checks
+
+
+class CompiledPrepDocTestCase(unittest.TestCase):
+    cases = [
+        dict(name='Brian', slug='brian-j', email='brian@docb.com', age=30, score=3.5, is_admin=True,
+             birthday=datetime.date(1990, 1, 2), joined=datetime.datetime(2019, 1, 2, 3, 4, 5, 6)),
+        dict(name='Brian', age=0, score=0.0, is_admin=False),
+        dict(name='Brian', birthday='1990-01-02', joined='2019-01-02T03:04:05'),
+        dict(name='B'),
+        dict(name='Brian Jinwright'),
+        dict(name=None),
+        dict(name='Brian', slug='not a slug'),
+        dict(name='Brian', email='nope'),
+        dict(name='Brian', age=200),
+        dict(name='Brian', age='ten'),
+        dict(name='Brian', score=3),
+        dict(name='Brian', is_admin='maybe'),
+        dict(name='Brian', birthday='yesterday'),
+    ]
+
+    def test_matches_generic_prep_doc(self):
+        for kwargs in self.cases:
+            with self.subTest(**kwargs):
+                self.assertEqual(run(Profile.prep_doc, **kwargs), run(legacy_prep_doc, **kwargs))
+
+    def test_compiled_per_class(self):
+        class Admin(Profile):
+            level = IntegerProperty()
+
+        self.assertIsNot(Admin._compiled_prep_doc, Profile._compiled_prep_doc)
+        doc = Admin(name='Brian', level=3)
+        doc.unique_checks = []
+        self.assertEqual(doc.prep_doc()['level'], 3)
+        self.assertEqual(doc.prep_doc()['_doc_type'], 'Admin')
+
+
+if __name__ == '__main__':
+    unittest.main()
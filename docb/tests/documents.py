@@ -4,7 +4,11 @@ import unittest
 import datetime
 
 
-from docb.testcase import (DocbTestCase, DynamoTestDocumentSlug, TestDocument, DynamoTestCustomIndex, Student)
+import docb.properties
+from docb.document import Document
+from docb.exceptions import BulkSaveError, TransactionError, VersionConflictError
+from docb.testcase import (DocbTestCase, DynamoTestDocumentSlug, TestDocument, DynamoTestCustomIndex, Student,
+                           VersionedDocument)
 
 from valley.exceptions import ValidationException
 
@@ -154,6 +158,110 @@ class DynamoTestCase(DocbTestCase):
         qs = self.doc_class.objects().filter({'city': 'Durham'}, limit=2)
         self.assertEqual(2, len(qs))
 
+    def test_explain(self):
+        qs = self.doc_class.objects().filter({'city': 'Durham'}, limit=2)
+        plan = qs.explain()
+        self.assertIsNone(plan.index_name)
+        self.assertEqual(plan.table_name, 'docbtest')
+        self.assertEqual(plan.post_filters, ['city'])
+        self.assertEqual(plan.page_limit, 2)
+        self.assertEqual(len(plan.warnings), 2)
+        self.assertFalse(plan.analyzed)
+        self.assertIn('Filter (post-read)', str(plan))
+        self.assertEqual(2, len(qs))
+
+    def test_explain_gfilter(self):
+        plan = self.doc_class.objects().gfilter({'city': 'Durham'}).explain()
+        self.assertEqual(plan.index_name, 'city-index')
+        self.assertIsNone(plan.filter_expression)
+        self.assertEqual(plan.post_filters, [])
+        self.assertEqual(plan.warnings, [])
+
+    def test_explain_analyze(self):
+        plan = self.doc_class.objects().filter({'city': 'Durham'}).explain(analyze=True)
+        self.assertTrue(plan.analyzed)
+        self.assertEqual(plan.pages, 1)
+        self.assertEqual(plan.scanned_count, 3)
+        self.assertEqual(plan.count, 2)
+        self.assertGreater(plan.read_units, 0)
+        self.assertEqual(plan.as_dict()['count'], 2)
+
+    def test_in_ids(self):
+        ids = [self.t3._id, self.t1._id, 'missing'] + ['missing-{}'.format(i) for i in range(150)]
+        qs = self.doc_class.objects().filter({'_id__in': ids})
+        self.assertEqual([d.name for d in qs], ['Lakewood YMCA', 'Goo and Sons'])
+        plan = qs.explain(analyze=True)
+        self.assertEqual(plan.fan_out, {'property': '_id', 'values': 153, 'operation': 'batch_get_item'})
+        self.assertEqual(plan.count, 2)
+        self.assertEqual(plan.pages, 2)
+
+    def test_in_pks(self):
+        qs = self.doc_class.objects().filter({'pk__in': [self.t1.pk, self.t2.pk]})
+        self.assertEqual(sorted(d._id for d in qs), sorted([self.t1._id, self.t2._id]))
+
+    def test_in_ids_with_filter(self):
+        qs = self.doc_class.objects().filter({'_id__in': [self.t1._id, self.t2._id, self.t3._id], 'city': 'Durham'})
+        self.assertEqual(sorted(d.name for d in qs), ['Goo and Sons', 'Lakewood YMCA'])
+        self.assertEqual(qs.explain().fan_out['operation'], 'query')
+
+    def test_in_indexed_prop(self):
+        qs = self.doc_class.objects().gfilter({'city__in': ['Durham', 'Charlotte', 'Durham']})
+        self.assertEqual(3, len(qs))
+        plan = qs.explain()
+        self.assertEqual(plan.index_name, 'city-index')
+        self.assertEqual(plan.fan_out['values'], 2)
+        qs = self.doc_class.objects().filter({'city__in': ['Durham', 'Raleigh']}, sort_attr='name')
+        self.assertEqual([d.name for d in qs], ['Goo and Sons', 'Lakewood YMCA'])
+
+    def test_sample_index_stats(self):
+        stats = self.doc_class().sample_index_stats()
+        self.assertEqual(stats, {'city': {'items_per_value': 1.5}})
+        self.assertEqual(self.doc_class.get_index_stats(), stats)
+        self.doc_class.set_index_stats({})
+
+    def test_bulk_save(self):
+        docs = [self.doc_class(name='Bulk Doc {}'.format(i), slug='bulk-{}'.format(i), gpa=2.5,
+                               email='bulk{}@docb.com'.format(i), city='Raleigh') for i in range(30)]
+        self.doc_class().bulk_save(docs)
+        qs = self.doc_class.objects().filter({'city': 'Raleigh'})
+        self.assertEqual(30, len(qs))
+        self.assertEqual(2.5, qs[0].gpa)
+        self.assertIsNotNone(docs[0].pk)
+        self.assertEqual(self.doc_class.get(docs[0].pk).name, docs[0].name)
+
+    def test_bulk_save_workers(self):
+        docs = (self.doc_class(name='Bulk Doc {}'.format(i), slug='bulk-{}'.format(i), gpa=2.5,
+                               email='bulk{}@docb.com'.format(i), city='Raleigh') for i in range(30))
+        # The result isn't consumed: every doc is written before bulk_save returns
+        self.doc_class().bulk_save(docs, workers=3)
+        saved = self.doc_class.objects().filter({'city': 'Raleigh'})
+        self.assertEqual(30, len(saved))
+        self.assertEqual(2.5, saved[0].gpa)
+
+    def test_iter_bulk_save(self):
+        docs = (self.doc_class(name='Bulk Doc {}'.format(i), slug='bulk-{}'.format(i), gpa=2.5,
+                               email='bulk{}@docb.com'.format(i), city='Raleigh') for i in range(30))
+        results = list(self.doc_class().iter_bulk_save(docs, workers=3))
+        self.assertEqual(30, len(results))
+        self.assertTrue(all(r.success for r in results))
+        self.assertEqual(30, len(self.doc_class.objects().filter({'city': 'Raleigh'})))
+        saved = self.doc_class.get(results[0].doc.pk)
+        self.assertEqual(saved.name, results[0].doc.name)
+
+    def test_bulk_save_workers_invalid_doc(self):
+        docs = [self.doc_class(name='Bulk Doc', slug='bulk', email='bulk@docb.com', city='Raleigh'),
+                self.doc_class(name='No City', slug='no-city', email='no-city@docb.com')]
+        results = {r.doc.name: r for r in self.doc_class().iter_bulk_save(docs, workers=2)}
+        self.assertTrue(results['Bulk Doc'].success)
+        self.assertFalse(results['No City'].success)
+        self.assertIsInstance(results['No City'].error, ValidationException)
+        docs = [self.doc_class(name='Bulk Doc 2', slug='bulk-2', email='bulk2@docb.com', city='Raleigh'),
+                self.doc_class(name='No City 2', slug='no-city-2', email='no-city-2@docb.com')]
+        with self.assertRaises(BulkSaveError) as context:
+            self.doc_class().bulk_save(docs, workers=2)
+        self.assertEqual([r.doc.name for r in context.exception.failed], ['No City 2'])
+        self.assertEqual(2, len(self.doc_class.objects().filter({'city': 'Raleigh'})))
+
     def test_local_backup(self):
 
         self.doc_class().backup('test-backup.json')
@@ -194,6 +302,31 @@ class ConditionsTestCase(DocbTestCase):
                                  email='joe@autogy.com', hometown="Pittsburgh", high_school='Riverside')
         self.t7.save()
 
+    def test_bulk_load(self):
+        rows = [dict(first_name='Student', last_name=str(i), slug='student-{}'.format(i), gpa=3.0,
+                     email='student{}@docb.com'.format(i), hometown='Raleigh') for i in range(40)]
+        rows[5]['gpa'] = 'A+'
+        rows[12].pop('hometown')
+        rows[30]['slug'] = 'brian-j'
+        report = self.doc_class().bulk_load(rows, processes=2, chunk_size=7, workers=2)
+        self.assertEqual(report.saved, 37)
+        self.assertEqual([e.index for e in report.errors], [5, 12, 30])
+        self.assertIn('gpa: This value should be a float.', report.errors[0].error)
+        self.assertEqual(len(self.doc_class.objects().filter({'hometown': 'Raleigh'})), 37)
+
+    def test_bulk_load_duplicates(self):
+        rows = [dict(first_name='Student', last_name=str(i), slug='student-{}'.format(i), gpa=3.0,
+                     email='student{}@docb.com'.format(i), hometown='Raleigh') for i in range(20)]
+        # Same chunk and a later chunk
+        rows[2]['slug'] = rows[1]['slug']
+        rows[15]['email'] = rows[0]['email']
+        report = self.doc_class().bulk_load(rows, processes=2, chunk_size=7, workers=2)
+        self.assertEqual(report.saved, 18)
+        self.assertEqual([e.index for e in report.errors], [2, 15])
+        self.assertIn('slug with the value of student-1 in row 1', report.errors[0].error)
+        self.assertEqual(len(self.doc_class.objects().filter({'slug': 'student-1'})), 1)
+        self.assertEqual(len(self.doc_class.objects().filter({'email': 'student0@docb.com'})), 1)
+
     def test_contains(self):
         qs = self.doc_class.objects().filter({'hometown__contains':'Du'})
         self.assertEqual(2, len(qs))
@@ -251,6 +384,105 @@ class ConditionsTestCase(DocbTestCase):
         self.assertEqual(5, len(qs))
 
 
+class Listing(Document):
+    city = docb.properties.CharProperty(global_index=True)
+    state = docb.properties.CharProperty(global_index=True)
+    zip_code = docb.properties.CharProperty(global_index=True)
+
+    class Meta:
+        use_db = 'dynamodb'
+        index_stats = {
+            'city': {'items_per_value': 20},
+            'state': {'item_count': 10000, 'distinct_values': 50},
+        }
+
+
+class Place(Document):
+    city = docb.properties.CharProperty(global_index=True)
+    state = docb.properties.CharProperty(global_index=True)
+
+    class Meta:
+        use_db = 'dynamodb'
+
+
+class IndexSelectionTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        Listing.set_index_stats({})
+
+    def test_lowest_cost(self):
+        qs = Listing.objects().gfilter({'state': 'NC', 'city': 'Durham'})
+        self.assertEqual(Listing().get_index_name(qs), ('city-index', 'city', 'Durham'))
+
+    def test_unknown_stats_last(self):
+        qs = Listing.objects().gfilter({'zip_code': '27701', 'state': 'NC'})
+        self.assertEqual(Listing().get_index_name(qs), ('state-index', 'state', 'NC'))
+
+    def test_no_stats_order(self):
+        for filters in ({'state': 'NC', 'city': 'Durham'}, {'city': 'Durham', 'state': 'NC'}):
+            qs = Place.objects().gfilter(filters)
+            self.assertEqual(Place().get_index_name(qs), ('city-index', 'city', 'Durham'))
+
+    def test_override(self):
+        qs = Listing.objects().gfilter({'state': 'NC', 'city': 'Durham'}, index_name='state-index')
+        self.assertEqual(Listing().get_index_name(qs), ('state-index', 'state', 'NC'))
+
+    def test_plan_cache(self):
+        qs = Listing.objects().gfilter({'zip_code': '27701', 'state': 'NC'})
+        Listing().get_index_name(qs)
+        self.assertEqual(Listing._get_index_cache()[('plan', frozenset(['zip_code', 'state']))], 'state')
+        Listing.set_index_stats({'zip_code': {'items_per_value': 5}})
+        self.assertEqual(Listing().get_index_name(qs), ('zip_code-index', 'zip_code', '27701'))
+
+    def test_explain_estimate(self):
+        plan = Listing().explain(Listing.objects().gfilter({'city': 'Durham'}))
+        self.assertEqual(plan.estimated_read_units, 2.5)
+
+
+class VersionedTestCase(DocbTestCase):
+    doc_class = VersionedDocument
+
+    def test_version(self):
+        doc = VersionedDocument(name='Alpha')
+        doc.save()
+        self.assertEqual(doc._data['_version'], 1)
+        doc = VersionedDocument.get(doc._id)
+        self.assertEqual(doc._data['_version'], 1)
+        doc.gpa = 3.0
+        doc.save()
+        self.assertEqual(VersionedDocument.get(doc._id)._data['_version'], 2)
+
+    def test_conflict(self):
+        VersionedDocument(name='Alpha').save()
+        first = VersionedDocument.objects().get({'name': 'Alpha'})
+        second = VersionedDocument.objects().get({'name': 'Alpha'})
+        first.gpa = 3.0
+        first.save()
+        second.gpa = 2.0
+        with self.assertRaises(VersionConflictError):
+            second.save()
+        with self.assertRaises(VersionConflictError):
+            second.delete()
+        self.assertEqual(VersionedDocument.get(first._id).gpa, 3.0)
+        first.delete()
+        self.assertEqual(len(VersionedDocument.objects().all()), 0)
+
+    def test_transaction(self):
+        doc = VersionedDocument(name='Alpha')
+        doc.save()
+        stale = VersionedDocument.get(doc._id)
+        with self.docb_handler.transaction() as tx:
+            tx.update(doc, gpa=3.0)
+        self.assertEqual(doc._data['_version'], 2)
+        self.assertEqual(VersionedDocument.get(doc._id)._data['_version'], 2)
+        with self.assertRaises(TransactionError):
+            with self.docb_handler.transaction() as tx:
+                tx.save(stale)
+        with self.docb_handler.transaction() as tx:
+            tx.save(doc)
+        self.assertEqual(VersionedDocument.get(doc._id)._data['_version'], 3)
+
+
 class DynamoIndexTestCase(DocbTestCase):
     doc_class = DynamoTestCustomIndex
 
@@ -0,0 +1,156 @@
+import csv
+import datetime
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    pa = pq = None
+
+import docb.properties
+from docb.exceptions import QueryError
+from docb.export import CsvWriter, S3MultipartFile, export_value
+from docb.testcase import DocbTestCase, TestDocument
+
+
+class ExportDocument(TestDocument):
+    state = docb.properties.CharProperty()
+
+    class Meta:
+        use_db = 'dynamodb'
+
+
+class FakeS3Client(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def create_multipart_upload(self, **kwargs):
+        self.calls.append(('create', kwargs))
+        return {'UploadId': 'upload-1'}
+
+    def upload_part(self, **kwargs):
+        self.calls.append(('part', kwargs))
+        return {'ETag': 'etag-{}'.format(kwargs['PartNumber'])}
+
+    def complete_multipart_upload(self, **kwargs):
+        self.calls.append(('complete', kwargs))
+
+    def abort_multipart_upload(self, **kwargs):
+        self.calls.append(('abort', kwargs))
+
+    def put_object(self, **kwargs):
+        self.calls.append(('put', kwargs))
+
+
+class S3MultipartFileTestCase(unittest.TestCase):
+
+    def test_multipart(self):
+        client = FakeS3Client()
+        f = S3MultipartFile(client, 'bucket', 'export.csv', part_size=4)
+        f.write(b'abcdef')
+        f.write(b'ghij')
+        f.close()
+        self.assertEqual([c[0] for c in client.calls], ['create', 'part', 'part', 'part', 'complete'])
+        self.assertEqual([c[1]['Body'] for c in client.calls if c[0] == 'part'], [b'abcd', b'efgh', b'ij'])
+        self.assertEqual(client.calls[-1][1]['MultipartUpload']['Parts'][2], {'PartNumber': 3, 'ETag': 'etag-3'})
+
+    def test_small_object(self):
+        client = FakeS3Client()
+        f = S3MultipartFile(client, 'bucket', 'export.csv', part_size=100)
+        f.write(b'abc')
+        f.close()
+        self.assertEqual(client.calls, [('put', {'Bucket': 'bucket', 'Key': 'export.csv', 'Body': b'abc'})])
+
+    def test_abort(self):
+        client = FakeS3Client()
+        f = S3MultipartFile(client, 'bucket', 'export.csv', part_size=2)
+        f.write(b'abc')
+        f.abort()
+        f.close()
+        self.assertEqual([c[0] for c in client.calls], ['create', 'part', 'abort'])
+
+    def test_export_value(self):
+        self.assertEqual(export_value('2026-10-19', 'date'), datetime.date(2026, 10, 19))
+        self.assertEqual(export_value('2026-10-19T00:18:01Z', 'datetime'), datetime.datetime(2026, 10, 19, 0, 18, 1))
+        self.assertEqual(export_value(['a', 1], None), '["a", 1]')
+        self.assertIsNone(export_value(None, 'int'))
+
+
+class ExportTestCase(DocbTestCase):
+    doc_class = ExportDocument
+
+    def setUp(self):
+        super(ExportTestCase, self).setUp()
+        ExportDocument().bulk_save([ExportDocument(name='Name {}'.format(i), gpa=i + 0.5, state=('NC', 'VA')[i % 2])
+                                   for i in range(25)])
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+        super(ExportTestCase, self).tearDown()
+
+    def test_csv(self):
+        path = os.path.join(self.dir.name, 'export.csv')
+        qs = ExportDocument.objects().filter({'state': 'NC'}, paginate_by=4)
+        self.assertEqual(qs.export(path, format='csv', fields=['name', 'gpa', 'is_active']), 13)
+        with open(path) as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(len(rows), 13)
+        row = [r for r in rows if r['name'] == 'Name 2'][0]
+        self.assertEqual((row['gpa'], row['is_active']), ('2.5', 'True'))
+
+    def test_failed_export(self):
+        path = os.path.join(self.dir.name, 'export.csv')
+        qs = ExportDocument.objects().all(paginate_by=10)
+        qs.export(path, format='csv', fields=['name'])
+        with open(path) as f:
+            exported = f.read()
+        with mock.patch.object(CsvWriter, 'write', side_effect=[None, RuntimeError('failed')]):
+            with self.assertRaises(RuntimeError):
+                qs.export(path, format='csv', fields=['name'])
+        # The earlier export isn't replaced by a truncated file
+        with open(path) as f:
+            self.assertEqual(f.read(), exported)
+        self.assertEqual(os.listdir(self.dir.name), ['export.csv'])
+
+    def test_unknown_format(self):
+        with self.assertRaises(QueryError):
+            ExportDocument.objects().all().export(os.path.join(self.dir.name, 'export.xml'), format='xml')
+
+    @unittest.skipIf(pa is None, 'pyarrow is not installed')
+    def test_parquet(self):
+        path = os.path.join(self.dir.name, 'export.parquet')
+        self.assertEqual(ExportDocument.objects().all(paginate_by=10).export(path), 25)
+        parquet = pq.ParquetFile(path)
+        self.assertEqual(parquet.metadata.num_row_groups, 3)
+        table = parquet.read()
+        self.assertEqual(table.schema.field('gpa').type, pa.float64())
+        self.assertEqual(table.schema.field('date_created').type, pa.date32())
+        self.assertTrue(pa.types.is_timestamp(table.schema.field('last_updated').type))
+        self.assertEqual(table.column_names[0], '_id')
+        self.assertEqual(sorted(table.column('gpa').to_pylist()), [i + 0.5 for i in range(25)])
+
+    @unittest.skipIf(pa is None, 'pyarrow is not installed')
+    def test_arrow_segments(self):
+        path = os.path.join(self.dir.name, 'export')
+        qs = ExportDocument.objects().filter({'state': 'VA'}, paginate_by=5)
+        self.assertEqual(qs.export(path, format='arrow', fields=['_id', 'name', 'no_subscriptions'], segments=3), 12)
+        self.assertEqual(sorted(os.listdir(path)), ['part-00000.arrow', 'part-00001.arrow', 'part-00002.arrow'])
+        names = list()
+        for name in os.listdir(path):
+            with pa.ipc.open_file(os.path.join(path, name)) as reader:
+                table = reader.read_all()
+                self.assertEqual(table.schema.field('no_subscriptions').type, pa.int64())
+                names += table.column('name').to_pylist()
+        self.assertEqual(sorted(names), sorted('Name {}'.format(i) for i in range(1, 25, 2)))
+        with self.assertRaises(QueryError):
+            ExportDocument.objects().all(limit=5).export(path, segments=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+
+from boto3.dynamodb.conditions import Attr
+
+from docb.exceptions import DocSaveError, QueryError
+from docb.expressions import F, REMOVE, update_params
+from docb.testcase import DocbTestCase, TestDocument, VersionedDocument
+
+
+class UpdateParamsTestCase(unittest.TestCase):
+
+    def test_add(self):
+        params = update_params(TestDocument, {'no_subscriptions': F('no_subscriptions') + 2,
+                                              'gpa': 1 + F('gpa')})
+        self.assertEqual(params['UpdateExpression'], 'ADD #u0 :u1, #u2 :u3')
+        self.assertEqual(params['ExpressionAttributeNames'], {'#u0': 'no_subscriptions', '#u2': 'gpa'})
+        self.assertEqual(params['ExpressionAttributeValues'], {':u1': {'N': '2'}, ':u3': {'N': '1'}})
+        params = update_params(TestDocument, {'no_subscriptions': F('no_subscriptions') - 1})
+        self.assertEqual(params['ExpressionAttributeValues'], {':u1': {'N': '-1'}})
+
+    def test_set_and_remove(self):
+        params = update_params(TestDocument, {'gpa': F('no_subscriptions') + 0.5, 'name': 'Alpha',
+                                              'state': REMOVE, 'tags': F('tags').if_not_exists([]).append(['a'])},
+                               condition=Attr('name').exists())
+        self.assertEqual(params['UpdateExpression'],
+                         'SET #u0 = #u1 + :u2, #u3 = :u4, #u6 = list_append(if_not_exists(#u6, :u7), :u8) REMOVE #u5')
+        self.assertEqual(params['ExpressionAttributeValues'][':u2'], {'N': '0.5'})
+        self.assertEqual(params['ExpressionAttributeValues'][':u7'], {'L': []})
+        self.assertEqual(params['ConditionExpression'], 'attribute_exists(#n0)')
+        self.assertEqual(params['ExpressionAttributeNames']['#n0'], 'name')
+
+    def test_invalid(self):
+        with self.assertRaises(DocSaveError):
+            F('gpa') + 1 + 1
+
+
+class UpdateTestCase(DocbTestCase):
+
+    def setUp(self):
+        super(UpdateTestCase, self).setUp()
+        self.doc = TestDocument(name='Alpha', no_subscriptions=3)
+        self.doc.save()
+
+    def test_update(self):
+        doc = TestDocument.objects().update(self.doc.pk, no_subscriptions=F('no_subscriptions') + 1, gpa=3.5)
+        self.assertEqual((doc.no_subscriptions, doc.gpa, doc.name), (4, 3.5, 'Alpha'))
+        doc = TestDocument.objects().update(self.doc._id, gpa=REMOVE)
+        self.assertIsNone(TestDocument.get(self.doc.pk).gpa)
+        with self.assertRaises(QueryError):
+            TestDocument.objects().update('missing', gpa=3.5)
+        self.assertEqual(len(TestDocument.objects().all()), 1)
+
+    def test_list_append(self):
+        key = TestDocument.get_key(self.doc.pk)
+        for tags in (['a'], ['b', 'c']):
+            TestDocument.objects().update(self.doc.pk, tags=F('tags').if_not_exists([]).append(tags))
+        item = self.doc._client.get_item(TableName=self.doc._table_name,
+                                         Key=TestDocument.get_codec().encode_key(key))['Item']
+        self.assertEqual(item['tags'], {'L': [{'S': 'a'}, {'S': 'b'}, {'S': 'c'}]})
+
+    def test_queryset_update(self):
+        for name in ('Bravo', 'Charlie', 'Delta'):
+            TestDocument(name=name, no_subscriptions=1, gpa=2.0).save()
+        count = TestDocument.objects().filter({'gpa': 2.0}).update(no_subscriptions=F('no_subscriptions') + 10)
+        self.assertEqual(count, 3)
+        docs = TestDocument.objects().all()
+        self.assertEqual(sorted(d.no_subscriptions for d in docs), [3, 11, 11, 11])
+
+
+class VersionedUpdateTestCase(DocbTestCase):
+    doc_class = VersionedDocument
+
+    def test_update_increments_version(self):
+        doc = VersionedDocument(name='Alpha')
+        doc.save()
+        updated = VersionedDocument.objects().update(doc.pk, gpa=3.0)
+        self.assertEqual(updated._data['_version'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import subprocess
+import sys
+import threading
+import unittest
+
+from docb.loading import DocbHandler
+from docb.testcase import DocbTestCase, TestDocument
+
+
+def create_pooled_handler(**settings):
+    db_settings = {
+        'connection': {
+            'table': 'docbtest'
+        },
+        'config': {
+            'endpoint_url': 'http://dynamodb:8000'
+        },
+        'client_config': {
+            'max_pool_connections': 50,
+            'connect_timeout': 2,
+            'read_timeout': 5
+        },
+        'table_config': {
+            'write_capacity': 2,
+            'read_capacity': 2
+        }
+    }
+    db_settings.update(settings)
+    return DocbHandler({'dynamodb': db_settings})
+
+
+def in_thread(func):
+    result = []
+    t = threading.Thread(target=lambda: result.append(func()))
+    t.start()
+    t.join()
+    return result[0]
+
+
+class DocbHandlerTestCase(unittest.TestCase):
+
+    def test_client_config(self):
+        handler = create_pooled_handler()
+        client = handler.get_client('dynamodb')
+        self.assertEqual(client.meta.config.max_pool_connections, 50)
+        self.assertEqual(client.meta.config.connect_timeout, 2)
+        self.assertEqual(client.meta.config.read_timeout, 5)
+        conn = handler.get_connection('dynamodb')
+        self.assertEqual(conn.meta.client.meta.config.max_pool_connections, 50)
+
+    def test_thread_local_tables(self):
+        handler = create_pooled_handler()
+        table = handler.get_table('dynamodb')
+        self.assertIs(table, handler.get_table('dynamodb'))
+        self.assertEqual(table.name, 'docbtest')
+        other = in_thread(lambda: handler.get_table('dynamodb'))
+        self.assertIsNot(table, other)
+        self.assertEqual(other.name, 'docbtest')
+
+    def test_shared_tables(self):
+        handler = create_pooled_handler(thread_local=False)
+        table = handler.get_table('dynamodb')
+        self.assertIs(table, in_thread(lambda: handler.get_table('dynamodb')))
+
+    def test_shared_client(self):
+        handler = create_pooled_handler()
+        client = handler.get_client('dynamodb')
+        self.assertIs(client, in_thread(lambda: handler.get_client('dynamodb')))
+
+    def test_lazy_connections(self):
+        handler = create_pooled_handler()
+        self.assertIsNone(handler._session)
+        self.assertEqual(handler._clients, {})
+        self.assertFalse(hasattr(handler._local, 'stores'))
+
+
+class ColdStartTestCase(unittest.TestCase):
+    # Deployment modules, the optional dependencies of exports and to_columns, and asyncio (only used by aget)
+    deployment_modules = ('sammy', 'envs', 'valley.contrib', 'docb.config', 'pyarrow', 'docb.export', 'numpy',
+                          'docb.columns', 'asyncio')
+
+    def test_import_skips_deployment_modules(self):
+        code = 'import sys, docb; print(",".join(m for m in {!r} if m in sys.modules))'.format(
+            self.deployment_modules)
+        output = subprocess.check_output([sys.executable, '-c', code]).decode().strip()
+        self.assertEqual(output, '')
+
+    def test_table_config_imported_on_use(self):
+        code = ('import sys, docb.loading; h = docb.loading.DocbHandler({"dynamodb": {"table_config": {}}}); '
+                'tc = h.validate_table_config("dynamodb"); print("docb.config" in sys.modules, tc.__class__.__name__)')
+        output = subprocess.check_output([sys.executable, '-c', code]).decode().strip()
+        self.assertEqual(output, 'True TableConfig')
+
+
+class PrewarmTestCase(DocbTestCase):
+    doc_class = TestDocument
+
+    def test_create_table_caches_description(self):
+        description = self.docb_handler.describe_table('dynamodb')
+        self.assertEqual(description['TableName'], 'docbtest')
+        self.assertIs(description, self.docb_handler._descriptions['dynamodb'])
+
+    def test_prewarm(self):
+        handler = create_pooled_handler()
+        handler.prewarm(connections=3)
+        self.assertEqual(handler.describe_table('dynamodb')['TableName'], 'docbtest')
+        table = handler.get_table('dynamodb')
+
+        def fail_load():
+            raise AssertionError('DescribeTable should not be called')
+
+        table.load = fail_load
+        self.assertEqual(table.key_schema[0]['AttributeName'], '_doc_type')
+
+    def test_prewarmed_create_table(self):
+        TestDocument.Meta.handler.prewarm()
+        self.assertEqual(TestDocument().create_table().name, 'docbtest')
+
+
+if __name__ == '__main__':
+    unittest.main()
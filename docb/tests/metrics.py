@@ -0,0 +1,100 @@
+import unittest
+from unittest import mock
+
+from botocore.exceptions import EndpointConnectionError
+
+from docb.metrics import MetricsAggregator, MetricsEvent, consumed_units, render_prometheus
+from docb.testcase import DocbTestCase, TestDocument
+
+
+def make_event(**kwargs):
+    values = dict(db_label='dynamodb', doc_class='TestDocument', operation='query', index=None, read_units=0.5,
+                  write_units=0.0, scanned_count=10, count=2, page=1, latency=0.02, error=None)
+    values.update(kwargs)
+    return MetricsEvent(**values)
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def test_consumed_units(self):
+        self.assertEqual(consumed_units('query', None), (0.0, 0.0))
+        self.assertEqual(consumed_units('query', {'CapacityUnits': 1.5}), (1.5, 0.0))
+        self.assertEqual(consumed_units('batch_write_item', [{'CapacityUnits': 2}, {'CapacityUnits': 3}]),
+                         (0.0, 5.0))
+        self.assertEqual(consumed_units('transact_write_items',
+                                        [{'ReadCapacityUnits': 1, 'WriteCapacityUnits': 4}]), (1.0, 4.0))
+
+    def test_aggregator(self):
+        aggregator = MetricsAggregator()
+        aggregator(make_event())
+        aggregator(make_event(page=2, latency=0.2))
+        aggregator(make_event(operation='put_item', read_units=0.0, write_units=1.0, scanned_count=None,
+                              count=None, page=None, error='ConditionalCheckFailedException'))
+        stats = aggregator.snapshot()
+        query = stats[('dynamodb', 'TestDocument', 'query', None)]
+        self.assertEqual(query['calls'], 2)
+        self.assertEqual(query['pages'], 2)
+        self.assertEqual(query['scanned_count'], 20)
+        self.assertEqual(query['count'], 4)
+        self.assertEqual(query['read_units'], 1.0)
+        self.assertEqual(query['latency_max'], 0.2)
+        put = stats[('dynamodb', 'TestDocument', 'put_item', None)]
+        self.assertEqual(put['errors'], 1)
+        self.assertEqual(put['write_units'], 1.0)
+        aggregator.reset()
+        self.assertEqual(aggregator.snapshot(), {})
+
+    def test_render_prometheus(self):
+        aggregator = MetricsAggregator()
+        aggregator(make_event(index='city-index'))
+        text = render_prometheus(aggregator)
+        labels = 'db_label="dynamodb",doc_class="TestDocument",operation="query",index="city-index"'
+        self.assertIn('# TYPE docb_requests_total counter', text)
+        self.assertIn('docb_requests_total{%s} 1' % labels, text)
+        self.assertIn('docb_scanned_items_total{%s} 10' % labels, text)
+        self.assertIn('docb_request_latency_seconds_bucket{%s,le="0.025"} 1' % labels, text)
+        self.assertIn('docb_request_latency_seconds_bucket{%s,le="0.01"} 0' % labels, text)
+        self.assertIn('docb_request_latency_seconds_count{%s} 1' % labels, text)
+
+
+class HandlerMetricsTestCase(DocbTestCase):
+    doc_class = TestDocument
+
+    def test_metrics_hook(self):
+        events = []
+        hook = self.docb_handler.add_metrics_hook(events.append)
+        try:
+            TestDocument(name='Brian').save()
+            TestDocument(name='Brian J').save()
+            list(TestDocument.objects().filter({'name': 'Brian'}))
+        finally:
+            self.docb_handler.remove_metrics_hook(hook)
+        operations = [e.operation for e in events]
+        self.assertIn('put_item', operations)
+        put = events[operations.index('put_item')]
+        self.assertEqual(put.doc_class, 'TestDocument')
+        self.assertEqual(put.db_label, 'dynamodb')
+        query = events[-1]
+        self.assertEqual(query.operation, 'query')
+        self.assertEqual(query.page, 1)
+        self.assertEqual(query.count, 1)
+        self.assertGreaterEqual(query.scanned_count, query.count)
+        self.assertGreater(query.read_units, 0)
+        self.assertGreater(query.latency, 0)
+
+    def test_connection_error(self):
+        events = []
+        hook = self.docb_handler.add_metrics_hook(events.append)
+        client = self.docb_handler.get_client('dynamodb')
+        error = EndpointConnectionError(endpoint_url='http://dynamodb:8000')
+        try:
+            with mock.patch.object(client, 'get_item', side_effect=error):
+                with self.assertRaises(EndpointConnectionError):
+                    TestDocument.get('missing')
+        finally:
+            self.docb_handler.remove_metrics_hook(hook)
+        self.assertEqual([(e.operation, e.error) for e in events], [('get_item', 'EndpointConnectionError')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+import os
+import re
+import threading
+import time
+import unittest
+from unittest import mock
+
+from docb.exceptions import ImproperlyConfigured, QueryError
+from docb.loading import DocbHandler
+from docb.pagination import prefetch, encode_cursor, decode_cursor
+from docb.testcase import DocbTestCase, TestDocument
+
+
+class PrefetchTestCase(unittest.TestCase):
+
+    def test_order(self):
+        self.assertEqual(list(prefetch(iter(range(10)), 2)), list(range(10)))
+
+    def test_bounded(self):
+        produced = []
+
+        def pages():
+            for i in range(10):
+                produced.append(i)
+                yield i
+
+        values = prefetch(pages(), 2)
+        self.assertEqual(next(values), 0)
+        time.sleep(0.1)
+        # One page consumed, two waiting in the buffer and one blocked on put
+        self.assertLessEqual(len(produced), 4)
+        values.close()
+
+    def test_close(self):
+        closed = threading.Event()
+
+        def pages():
+            try:
+                i = 0
+                while True:
+                    yield i
+                    i += 1
+            finally:
+                closed.set()
+
+        values = prefetch(pages(), 3)
+        self.assertEqual([next(values) for i in range(5)], list(range(5)))
+        values.close()
+        self.assertTrue(closed.is_set())
+
+    def test_error(self):
+        def pages():
+            yield 1
+            raise ValueError('page failed')
+
+        values = prefetch(pages(), 2)
+        self.assertEqual(next(values), 1)
+        with self.assertRaises(ValueError):
+            next(values)
+
+    def test_base_exception(self):
+        def pages():
+            yield 1
+            raise SystemExit(1)
+
+        values = prefetch(pages(), 2)
+        self.assertEqual(next(values), 1)
+        with self.assertRaises(SystemExit):
+            next(values)
+
+
+class CursorTestCase(unittest.TestCase):
+    key = {'_doc_type': {'S': 'TestDocument'}, '_id': {'S': 'abc:id:dynamodb:TestDocument'}}
+
+    def test_round_trip(self):
+        cursor = encode_cursor(self.key, 'secret', 'scope')
+        self.assertTrue(re.match(r'^[A-Za-z0-9_.-]+$', cursor))
+        self.assertEqual(decode_cursor(cursor, 'secret', 'scope'), self.key)
+
+    def test_invalid(self):
+        cursor = encode_cursor(self.key, 'secret', 'scope')
+        payload, signature = cursor.split('.')
+        forged = encode_cursor(dict(self.key, _id={'S': 'other'}), 'secret', 'scope').split('.')[0]
+        for bad in ('{}.{}'.format(forged, signature), cursor + 'x', 'nonsense', '', None):
+            with self.subTest(cursor=bad), self.assertRaises(QueryError):
+                decode_cursor(bad, 'secret', 'scope')
+        with self.assertRaises(QueryError):
+            decode_cursor(cursor, 'other secret', 'scope')
+        with self.assertRaises(QueryError):
+            decode_cursor(cursor, 'secret', 'other scope')
+
+    def test_secret_required(self):
+        handler = DocbHandler({'dynamodb': {'connection': {'table': 'docbtest'}}})
+        with mock.patch.dict(os.environ, {'DOCB_CURSOR_SECRET': ''}):
+            with self.assertRaises(ImproperlyConfigured):
+                handler.get_cursor_secret('dynamodb')
+        with mock.patch.dict(os.environ, {'DOCB_CURSOR_SECRET': 'env secret'}):
+            self.assertEqual(handler.get_cursor_secret('dynamodb'), 'env secret')
+
+
+class IteratorTestCase(DocbTestCase):
+    doc_class = TestDocument
+
+    def setUp(self):
+        super(IteratorTestCase, self).setUp()
+        for name in ('Alpha', 'Bravo', 'Charlie', 'Delta', 'Echoes'):
+            TestDocument(name=name).save()
+
+    def test_iterator(self):
+        for prefetch_pages in (0, 2):
+            with self.subTest(prefetch=prefetch_pages):
+                docs = list(TestDocument.objects().all(paginate_by=2).iterator(prefetch=prefetch_pages))
+                self.assertEqual(sorted(d.name for d in docs), ['Alpha', 'Bravo', 'Charlie', 'Delta', 'Echoes'])
+
+    def test_iterator_limit(self):
+        docs = list(TestDocument.objects().all(paginate_by=2, limit=3).iterator(prefetch=1))
+        self.assertEqual(len(docs), 3)
+
+    def test_pages(self):
+        qs = TestDocument.objects().all()
+        pages = list(qs.pages(page_size=2))
+        self.assertEqual([len(p) for p in pages], [2, 2, 1])
+        self.assertEqual([p.has_next for p in pages], [True, True, False])
+        names = [d.name for p in pages for d in p]
+        self.assertEqual(sorted(names), ['Alpha', 'Bravo', 'Charlie', 'Delta', 'Echoes'])
+        resumed = next(qs.after(pages[0].cursor).pages(page_size=2))
+        self.assertEqual([d.name for d in resumed], [d.name for d in pages[1]])
+        with self.assertRaises(QueryError):
+            TestDocument.objects().filter({'is_active': True}).after(pages[0].cursor)
+
+    def test_pages_top_up(self):
+        for name in ('Foxtrot', 'Golfer', 'Hotel', 'Indigo'):
+            TestDocument(name=name, gpa=2.0).save()
+        pages = list(TestDocument.objects().filter({'gpa': 2.0}).pages(page_size=3))
+        self.assertEqual([len(p) for p in pages], [3, 1])
+        self.assertEqual(sorted(d.name for p in pages for d in p), ['Foxtrot', 'Golfer', 'Hotel', 'Indigo'])
+
+    def test_pages_limit(self):
+        pages = list(TestDocument.objects().all(limit=3).pages(page_size=2))
+        self.assertEqual([len(p) for p in pages], [2, 1])
+        self.assertFalse(pages[-1].has_next)
+
+    def test_iterator_abandoned(self):
+        threads = threading.active_count()
+        docs = TestDocument.objects().all(paginate_by=1).iterator(prefetch=2)
+        next(docs)
+        docs.close()
+        self.assertEqual(threading.active_count(), threads)
+
+
+if __name__ == '__main__':
+    unittest.main()
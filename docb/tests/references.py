@@ -0,0 +1,106 @@
+import unittest
+
+import docb.document
+import docb.properties
+from docb.exceptions import QueryError
+from docb.testcase import DocbTestCase
+from valley.exceptions import ValidationException
+
+
+class Author(docb.document.Document):
+    name = docb.properties.CharProperty(required=True)
+
+    class Meta:
+        use_db = 'dynamodb'
+
+
+class Book(docb.document.Document):
+    title = docb.properties.CharProperty(required=True)
+    author = docb.properties.ReferenceProperty(Author, required=True)
+    editor = docb.properties.ReferenceProperty('docb.tests.references.Author')
+
+    class Meta:
+        use_db = 'dynamodb'
+
+
+class ReferencePropertyTestCase(DocbTestCase):
+    doc_class = Book
+
+    @classmethod
+    def setUpClass(cls):
+        super(ReferencePropertyTestCase, cls).setUpClass()
+        Author.Meta.handler = cls.docb_handler
+
+    def setUp(self):
+        self.calls = []
+        self.hook = self.docb_handler.add_metrics_hook(lambda event: self.calls.append(event.operation))
+
+    def tearDown(self):
+        self.docb_handler.remove_metrics_hook(self.hook)
+        super(ReferencePropertyTestCase, self).tearDown()
+
+    def test_lazy_resolution(self):
+        author = Author(name='Octavia')
+        author.save()
+        Book(title='Kindred', author=author, editor=author.pk).save()
+        book = Book.objects().get({'title': 'Kindred'})
+        self.assertEqual(book.get_reference_id('author'), author._id)
+        self.assertEqual(book.get_reference_id('editor'), author._id)
+        self.calls.clear()
+        self.assertIsInstance(book.author, Author)
+        self.assertEqual(book.author.name, 'Octavia')
+        self.assertEqual(book.editor.name, 'Octavia')
+        self.assertEqual(self.calls.count('get_item'), 2)
+        self.calls.clear()
+        book.author
+        self.assertEqual(self.calls, [])
+        # Saving a loaded reference stores its _id
+        book.save()
+        self.assertEqual(Book.objects().get({'title': 'Kindred'}).get_reference_id('author'), author._id)
+
+    def test_validation(self):
+        with self.assertRaises(ValidationException):
+            Book(title='Unsaved', author=Author(name='Nobody')).save()
+        with self.assertRaises(ValidationException):
+            Book(title='Wrong', author=Book(title='Other')).save()
+        self.assertIsNone(Book(title='No editor', author='abc').editor)
+
+    def test_get_many(self):
+        authors = [Author(name='Author {}'.format(i)) for i in range(3)]
+        for author in authors:
+            author.save()
+        self.calls.clear()
+        docs = Author.get_many([authors[2].pk, 'missing', authors[0]._id, authors[2].pk])
+        self.assertEqual([d.name if d else None for d in docs], ['Author 2', None, 'Author 0', 'Author 2'])
+        self.assertEqual(self.calls, ['batch_get_item'])
+        self.assertEqual(Author.get_many([]), [])
+
+    def test_prefetch_related(self):
+        authors = [Author(name='Author {}'.format(i)) for i in range(3)]
+        for author in authors:
+            author.save()
+        Book().bulk_save([Book(title='Book {}'.format(i), author=authors[i % 3], editor=authors[0])
+                          for i in range(30)])
+        self.calls.clear()
+        books = list(Book.objects().all(paginate_by=10).prefetch_related('author', 'editor'))
+        self.assertEqual(len(books), 30)
+        for book in books:
+            self.assertEqual(book.author.name, 'Author {}'.format(int(book.title.split()[1]) % 3))
+            self.assertEqual(book.editor.name, 'Author 0')
+        self.assertEqual(self.calls.count('get_item'), 0)
+        self.assertEqual(self.calls.count('batch_get_item'), 2)
+
+        self.calls.clear()
+        docs = list(Book.objects().prefetch_related('author').all(paginate_by=10).iterator())
+        self.assertEqual(len({d.author.name for d in docs}), 3)
+        self.assertEqual(self.calls.count('batch_get_item'), 3)
+        self.assertEqual(self.calls.count('get_item'), 0)
+
+        page = next(Book.objects().all().prefetch_related('author').pages(page_size=5))
+        self.assertIsInstance(page.items[0]._data['author'], Author)
+        with self.assertRaises(QueryError):
+            list(Book.objects().all().prefetch_related('title'))
+
+
+if __name__ == '__main__':
+    unittest.main()
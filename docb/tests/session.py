@@ -0,0 +1,132 @@
+import asyncio
+import unittest
+
+from docb.exceptions import QueryError
+from docb.session import IdentityMap
+from docb.testcase import DocbTestCase, TestDocument
+
+
+class IdentityMapTestCase(unittest.TestCase):
+
+    def test_add(self):
+        identity_map = IdentityMap()
+        first = TestDocument(name='Alpha', _id=TestDocument.get_doc_id('abc'))
+        second = TestDocument(name='Alpha 2', _id=TestDocument.get_doc_id('abc'))
+        self.assertIs(identity_map.add(first), first)
+        self.assertIs(identity_map.add(second), first)
+        self.assertIs(identity_map.get(TestDocument, first._id), first)
+        identity_map.put(second)
+        self.assertIn(second, identity_map)
+        self.assertNotIn(first, identity_map)
+        identity_map.remove(TestDocument, first._id)
+        self.assertEqual(len(identity_map), 0)
+
+
+class SessionTestCase(DocbTestCase):
+
+    def setUp(self):
+        self.docs = [TestDocument(name='Session {}'.format(i)) for i in range(3)]
+        for doc in self.docs:
+            doc.save()
+        self.calls = []
+        self.hook = self.docb_handler.add_metrics_hook(lambda event: self.calls.append(event.operation))
+
+    def tearDown(self):
+        self.docb_handler.remove_metrics_hook(self.hook)
+        super(SessionTestCase, self).tearDown()
+
+    def test_get(self):
+        pk = self.docs[0].pk
+        with self.docb_handler.session() as identity_map:
+            doc = TestDocument.get(pk)
+            self.assertIs(TestDocument.get(pk), doc)
+            self.assertIs(TestDocument.get(doc._id), doc)
+            self.assertEqual(self.calls, ['get_item'])
+            self.assertIs(TestDocument.objects().get({'name': 'Session 0'}), doc)
+            with self.docb_handler.session() as inner:
+                self.assertIs(inner, identity_map)
+            self.assertEqual(len(identity_map), 1)
+        self.assertEqual(len(identity_map), 0)
+        self.assertIsNone(self.docb_handler.get_identity_map())
+        self.assertIsNot(TestDocument.get(pk), doc)
+
+    def test_get_many(self):
+        with self.docb_handler.session():
+            first = TestDocument.get(self.docs[0].pk)
+            self.calls.clear()
+            docs = TestDocument.get_many([d.pk for d in self.docs] + [self.docs[1].pk])
+            self.assertIs(docs[0], first)
+            self.assertIs(docs[1], docs[3])
+            self.assertEqual(self.calls, ['batch_get_item'])
+            self.calls.clear()
+            self.assertEqual(TestDocument.get_many([d.pk for d in self.docs]), docs[:3])
+            self.assertEqual(self.calls, [])
+            queried = {d.pk: d for d in TestDocument.objects().all()}
+            for doc in docs[:3]:
+                self.assertIs(queried[doc.pk], doc)
+
+    def test_writes(self):
+        with self.docb_handler.session() as identity_map:
+            doc = TestDocument.get(self.docs[0].pk)
+            updated = TestDocument.objects().update(doc.pk, no_subscriptions=5)
+            self.assertIs(updated, doc)
+            self.assertEqual(doc.no_subscriptions, 5)
+            new = TestDocument(name='Session new')
+            new.save()
+            self.calls.clear()
+            self.assertIs(TestDocument.get(new.pk), new)
+            self.assertEqual(self.calls, [])
+            new.delete()
+            with self.assertRaises(QueryError):
+                TestDocument.get(new.pk)
+            TestDocument.objects().all().update(no_subscriptions=6)
+            self.assertIsNone(identity_map.get(TestDocument, doc._id))
+            self.assertEqual(TestDocument.get(doc.pk).no_subscriptions, 6)
+
+    def test_bulk_save(self):
+        for workers in (None, 2):
+            with self.docb_handler.session() as identity_map:
+                docs = [TestDocument(name='Bulk {} {}'.format(workers, i)) for i in range(3)]
+                TestDocument().bulk_save(docs, workers=workers)
+                self.calls.clear()
+                self.assertEqual(TestDocument.get_many([d.pk for d in docs]), docs)
+                self.assertEqual(self.calls, [])
+                self.assertEqual(len(identity_map), 3)
+
+    def test_transaction(self):
+        with self.docb_handler.session() as identity_map:
+            first, second, third = [TestDocument.get(d.pk) for d in self.docs]
+            # transact_get shares the loaded instances
+            self.assertEqual(self.docb_handler.transact_get([(TestDocument, first.pk), second]), [first, second])
+            self.assertIs(self.docb_handler.transact_get([(TestDocument, first.pk)])[0], first)
+            new = TestDocument(name='Session new')
+            with self.docb_handler.transaction() as tx:
+                tx.save(new)
+                tx.delete(first)
+                tx.update(TestDocument, pk=second.pk, no_subscriptions=7)
+                tx.update(third, no_subscriptions=8)
+            self.calls.clear()
+            self.assertIs(TestDocument.get(new.pk), new)
+            self.assertEqual(self.calls, [])
+            with self.assertRaises(QueryError):
+                TestDocument.get(first.pk)
+            self.assertIsNone(identity_map.get(TestDocument, second._id))
+            updated = TestDocument.get(second.pk)
+            self.assertIsNot(updated, second)
+            self.assertEqual(updated.no_subscriptions, 7)
+            self.assertEqual(TestDocument.get(third.pk).no_subscriptions, 8)
+
+    def test_aget(self):
+        async def run():
+            with self.docb_handler.session():
+                first = await TestDocument.aget(self.docs[0].pk)
+                return first, await TestDocument.aget(self.docs[0].pk), TestDocument.get(self.docs[0].pk)
+
+        first, second, third = asyncio.run(run())
+        self.assertIs(first, second)
+        self.assertIs(first, third)
+        self.assertEqual(self.calls, ['batch_get_item'])
+
+
+if __name__ == '__main__':
+    unittest.main()
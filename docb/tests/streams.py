@@ -0,0 +1,118 @@
+import os
+import tempfile
+import unittest
+
+import docb.document
+import docb.properties
+from docb.loading import DocbHandler
+from docb.streams import StreamProcessor, MemoryCheckpointStore, FileCheckpointStore
+
+
+class StreamDocument(docb.document.Document):
+    name = docb.properties.CharProperty(required=True)
+
+    class Meta:
+        use_db = 'streams'
+
+
+class OtherStreamDocument(docb.document.Document):
+    name = docb.properties.CharProperty(required=True)
+
+    class Meta:
+        use_db = 'streams'
+
+
+def create_streams_handler():
+    return DocbHandler({
+        'streams': {
+            'connection': {
+                'table': 'docbstreams'
+            },
+            'config': {
+                'endpoint_url': 'http://dynamodb:8000'
+            },
+            'table_config': {
+                'write_capacity': 2,
+                'read_capacity': 2,
+                'stream_enabled': True
+            }
+        },
+    })
+
+
+class CheckpointStoreTestCase(unittest.TestCase):
+
+    def test_file_store(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, 'checkpoints.json')
+            store = FileCheckpointStore(path)
+            self.assertIsNone(store.get('arn', 'shard-1'))
+            store.set('arn', 'shard-1', '100')
+            store.set('arn', 'shard-2', '200')
+            self.assertEqual(FileCheckpointStore(path).get('arn', 'shard-1'), '100')
+            self.assertEqual(os.listdir(os.path.dirname(path)), ['checkpoints.json'])
+
+    def test_shard_levels(self):
+        shards = [{'ShardId': 'c', 'ParentShardId': 'b'}, {'ShardId': 'b', 'ParentShardId': 'a'},
+                  {'ShardId': 'a', 'ParentShardId': 'trimmed'}, {'ShardId': 'd', 'ParentShardId': 'a'}]
+        levels = StreamProcessor(None, 'streams').get_shard_levels(shards)
+        self.assertEqual([[s['ShardId'] for s in level] for level in levels], [['a'], ['b', 'd'], ['c']])
+
+
+class StreamProcessorTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.docb_handler = create_streams_handler()
+        StreamDocument.Meta.handler = cls.docb_handler
+        OtherStreamDocument.Meta.handler = cls.docb_handler
+        StreamDocument().create_table()
+
+    @classmethod
+    def tearDownClass(cls):
+        StreamDocument().delete_table()
+
+    def setUp(self):
+        self.store = MemoryCheckpointStore()
+        self.processor = StreamProcessor(self.docb_handler, 'streams', self.store)
+        self.events = []
+        self.processor.register(StreamDocument, self.events.append)
+
+    def test_events(self):
+        alpha = StreamDocument(name='Alpha')
+        alpha.save()
+        StreamDocument(name='Bravo').save()
+        OtherStreamDocument(name='Other').save()
+        alpha.name = 'Alpha 2'
+        alpha.save()
+        alpha.delete()
+        self.assertEqual(self.processor.run_once(), 5)
+        events = [event for batch in self.events for event in batch]
+        self.assertEqual([e.event_name for e in events], ['INSERT', 'INSERT', 'MODIFY', 'REMOVE'])
+        self.assertEqual((events[2].old.name, events[2].new.name), ('Alpha', 'Alpha 2'))
+        self.assertIsNone(events[3].new)
+        self.assertEqual(events[3].keys['_id'], alpha._id)
+        self.assertIsInstance(events[0].new, StreamDocument)
+
+        self.assertEqual(self.processor.run_once(), 0)
+        StreamDocument(name='Charlie').save()
+        self.assertEqual(self.processor.run_once(), 1)
+        self.assertEqual(self.events[-1][0].new.name, 'Charlie')
+        # A new processor with the same store continues from the checkpoints
+        self.assertEqual(StreamProcessor(self.docb_handler, 'streams', self.store).run_once(), 0)
+
+    def test_handler_error(self):
+        def fail(events):
+            raise ValueError('handler failed')
+
+        StreamDocument(name='Delta').save()
+        failing = StreamProcessor(self.docb_handler, 'streams', self.store)
+        failing.register(StreamDocument, fail)
+        with self.assertRaises(ValueError):
+            failing.run_once()
+        self.assertGreater(self.processor.run_once(), 0)
+        self.assertIn('Delta', [e.new.name for batch in self.events for e in batch if e.new])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+import threading
+import time
+import unittest
+
+from botocore.exceptions import ClientError
+
+from docb.throttle import TokenBucket, RateLimiter, INTERACTIVE, BACKGROUND
+from docb.testcase import DocbTestCase, DynamoTestDocumentSlug, TestDocument
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TokenBucketTestCase(unittest.TestCase):
+
+    def test_refill(self):
+        clock = FakeClock()
+        bucket = TokenBucket(10, clock=clock)
+        bucket.acquire(10)
+        self.assertEqual(bucket.tokens, 0)
+        clock.now = 0.5
+        bucket._refill()
+        self.assertEqual(bucket.tokens, 5)
+        clock.now = 10
+        bucket._refill()
+        self.assertEqual(bucket.tokens, 10)
+
+    def test_rate(self):
+        bucket = TokenBucket(50, capacity=1)
+        start = time.monotonic()
+        for i in range(11):
+            bucket.acquire(1)
+        self.assertGreaterEqual(time.monotonic() - start, 0.18)
+
+    def test_background_reserve(self):
+        clock = FakeClock()
+        bucket = TokenBucket(10, reserve=0.2, clock=clock)
+        bucket.acquire(7, BACKGROUND)
+        self.assertEqual(bucket._available(BACKGROUND), 1)
+        self.assertEqual(bucket._available(INTERACTIVE), 3)
+        bucket.waiting[INTERACTIVE] = 1
+        self.assertEqual(bucket._available(BACKGROUND), 0)
+
+    def test_interactive_first(self):
+        bucket = TokenBucket(20, capacity=1, reserve=0)
+        bucket.acquire(1)
+        order = []
+
+        def take(priority):
+            bucket.acquire(1, priority)
+            order.append(priority)
+
+        background = threading.Thread(target=take, args=(BACKGROUND,))
+        background.start()
+        time.sleep(0.01)
+        interactive = threading.Thread(target=take, args=(INTERACTIVE,))
+        interactive.start()
+        background.join()
+        interactive.join()
+        self.assertEqual(order, [INTERACTIVE, BACKGROUND])
+
+    def test_aimd(self):
+        bucket = TokenBucket(100, recovery=0.1)
+        bucket.throttled()
+        bucket.throttled()
+        self.assertEqual(bucket.rate, 25)
+        bucket.succeeded()
+        self.assertEqual(bucket.rate, 35)
+        for i in range(20):
+            bucket.succeeded()
+        self.assertEqual(bucket.rate, 100)
+
+
+class FakeClient(object):
+
+    def __init__(self, response=None, error=None):
+        self.response = response or {}
+        self.error = error
+        self.calls = []
+
+    def query(self, **params):
+        self.calls.append(params)
+        if self.error:
+            raise ClientError({'Error': {'Code': self.error}}, 'Query')
+        return self.response
+
+
+class RateLimiterTestCase(unittest.TestCase):
+
+    def test_from_config(self):
+        self.assertIsNone(RateLimiter.from_config(None))
+        limiter = RateLimiter.from_config(True, {'read_capacity': 5, 'write_capacity': 2,
+                                                 'secondary_read_capacity': 3})
+        self.assertEqual(limiter.get_bucket('read').max_rate, 5)
+        self.assertEqual(limiter.get_bucket('write').max_rate, 2)
+        self.assertEqual(limiter.get_bucket('read', 'city-index').max_rate, 3)
+        self.assertEqual(limiter.get_bucket('write', 'city-index').max_rate, 2)
+        self.assertIsNone(RateLimiter.from_config(True, {'billing_mode': 'PAY_PER_REQUEST'}))
+
+    def test_index_budgets(self):
+        limiter = RateLimiter.from_config({'read': 10, 'indexes': {'city-index': {'read': 4}}})
+        self.assertEqual(limiter.get_bucket('read', 'city-index').max_rate, 4)
+        self.assertEqual(limiter.get_bucket('read', 'name-index').max_rate, 10)
+        self.assertIsNone(limiter.get_bucket('write'))
+
+    def test_records_consumed_capacity(self):
+        limiter = RateLimiter(read=10, index_read=10)
+        client = FakeClient({'Items': [], 'ConsumedCapacity': {
+            'CapacityUnits': 4, 'Table': {'CapacityUnits': 0},
+            'GlobalSecondaryIndexes': {'city-index': {'CapacityUnits': 4}}}})
+        limiter.call(client.query, 'query', {'IndexName': 'city-index'})
+        self.assertEqual(client.calls[0]['ReturnConsumedCapacity'], 'INDEXES')
+        self.assertAlmostEqual(limiter.get_bucket('read', 'city-index').tokens, 6, places=1)
+        self.assertAlmostEqual(limiter.get_bucket('read').tokens, 10, places=1)
+
+    def test_throttled(self):
+        limiter = RateLimiter(read=10)
+        client = FakeClient(error='ProvisionedThroughputExceededException')
+        with self.assertRaises(ClientError):
+            limiter.call(client.query, 'query', {})
+        self.assertEqual(limiter.get_bucket('read').rate, 5)
+
+
+class HandlerRateLimitTestCase(DocbTestCase):
+    doc_class = TestDocument
+
+    def test_call(self):
+        handler = self.docb_handler
+        label = 'dynamodb'
+        settings = handler.get_settings(label)
+        settings['rate_limit'] = {'read': 1000, 'write': 1}
+        handler._limiters.pop(label, None)
+        try:
+            self.assertIsNotNone(handler.get_rate_limiter(label))
+            doc = TestDocument(name='Brian')
+            doc.save()
+            self.assertEqual(TestDocument.get(doc._id)._id, doc._id)
+            self.assertLess(handler.get_rate_limiter(label).get_bucket('write').tokens, 1)
+        finally:
+            settings.pop('rate_limit')
+            handler._limiters.pop(label, None)
+
+    def test_background(self):
+        self.assertEqual(self.docb_handler.get_priority(), INTERACTIVE)
+        with self.docb_handler.background():
+            self.assertEqual(self.docb_handler.get_priority(), BACKGROUND)
+        self.assertEqual(self.docb_handler.get_priority(), INTERACTIVE)
+
+
+class BackgroundThreadsTestCase(DocbTestCase):
+    doc_class = DynamoTestDocumentSlug
+
+    def test_background_threads(self):
+        handler = self.docb_handler
+        label = 'dynamodb'
+        settings = handler.get_settings(label)
+        settings['rate_limit'] = {'read': 1000, 'write': 1000}
+        handler._limiters.pop(label, None)
+        limiter = handler.get_rate_limiter(label)
+        priorities = []
+
+        def call(method, operation, params, priority=INTERACTIVE):
+            priorities.append((operation, priority))
+            return RateLimiter.call(limiter, method, operation, params, priority)
+
+        limiter.call = call
+        try:
+            for i in range(3):
+                DynamoTestDocumentSlug(name='Brian {}'.format(i), slug='brian-{}'.format(i), city='Durham',
+                                       email='brian{}@docb.com'.format(i)).save()
+            priorities.clear()
+            with handler.background():
+                # Prefetched pages and fan-out queries are read on other threads
+                self.assertEqual(len(list(DynamoTestDocumentSlug.objects().all().iterator(prefetch=2))), 3)
+                self.assertEqual(len(DynamoTestDocumentSlug.objects().gfilter({'city__in': ['Durham', 'Raleigh']})), 3)
+            self.assertEqual([operation for operation, priority in priorities], ['query'] * 3)
+            self.assertEqual({priority for operation, priority in priorities}, {BACKGROUND})
+            priorities.clear()
+            list(DynamoTestDocumentSlug.objects().all().iterator(prefetch=2))
+            self.assertEqual(priorities, [('query', INTERACTIVE)])
+        finally:
+            settings.pop('rate_limit')
+            handler._limiters.pop(label, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
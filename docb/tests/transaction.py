@@ -0,0 +1,124 @@
+import unittest
+from unittest import mock
+
+from boto3.dynamodb.conditions import Attr
+
+from docb.exceptions import DocSaveError, TransactionError
+from docb.testcase import DocbTestCase, TestDocument, Student
+
+
+class TransactionTestCase(DocbTestCase):
+    doc_class = TestDocument
+
+    def setUp(self):
+        super(TransactionTestCase, self).setUp()
+        Student.Meta.handler = self.docb_handler
+        self.events = []
+        self.docb_handler.add_metrics_hook(self.events.append)
+
+    def tearDown(self):
+        self.docb_handler.remove_metrics_hook(self.events.append)
+        super(TransactionTestCase, self).tearDown()
+
+    def operations(self, operation):
+        return [e for e in self.events if e.operation == operation]
+
+    def test_commit(self):
+        alpha = TestDocument(name='Alpha')
+        student = Student(first_name='Brian', last_name='Jones', slug='brian-jones', email='brian@example.com',
+                          hometown='Austin')
+        with self.docb_handler.transaction() as tx:
+            tx.save(alpha)
+            tx.save(student)
+            self.assertEqual(len(tx), 2)
+            self.assertEqual(len(self.operations('transact_write_items')), 0)
+        self.assertEqual(len(self.operations('transact_write_items')), 1)
+        self.assertEqual(TestDocument.get(alpha._id).name, 'Alpha')
+        self.assertEqual(Student.get(student._id).slug, 'brian-jones')
+
+    def test_exception_discards(self):
+        with self.assertRaises(ValueError):
+            with self.docb_handler.transaction() as tx:
+                tx.save(TestDocument(name='Alpha'))
+                raise ValueError('abort')
+        self.assertEqual(len(TestDocument.objects().all()), 0)
+        self.assertEqual(len(self.operations('transact_write_items')), 0)
+
+    def test_update_delete(self):
+        alpha = TestDocument(name='Alpha', gpa=3.0)
+        bravo = TestDocument(name='Bravo')
+        alpha.save()
+        bravo.save()
+        with self.docb_handler.transaction() as tx:
+            tx.update(TestDocument, pk=alpha._id.split(':')[0], gpa=3.5)
+            tx.delete(bravo)
+        self.assertEqual(TestDocument.get(alpha._id).gpa, 3.5)
+        self.assertEqual(TestDocument.get(alpha._id).name, 'Alpha')
+        self.assertEqual([d.name for d in TestDocument.objects().all()], ['Alpha'])
+
+    def test_condition_check(self):
+        alpha = TestDocument(name='Alpha', gpa=3.0)
+        alpha.save()
+        with self.assertRaises(TransactionError) as ctx:
+            with self.docb_handler.transaction() as tx:
+                tx.condition_check(alpha, Attr('gpa').gt(3.5))
+                tx.save(TestDocument(name='Bravo'))
+        self.assertIsInstance(ctx.exception.reasons, list)
+        self.assertEqual([d.name for d in TestDocument.objects().all()], ['Alpha'])
+        with self.docb_handler.transaction() as tx:
+            tx.condition_check(TestDocument, Attr('gpa').lt(3.5), pk=alpha._id)
+            tx.save(TestDocument(name='Bravo'))
+        self.assertEqual(len(TestDocument.objects().all()), 2)
+
+    def test_duplicate(self):
+        alpha = TestDocument(name='Alpha')
+        alpha.save()
+        with self.docb_handler.transaction() as tx:
+            tx.update(alpha, gpa=2.0)
+            with self.assertRaises(DocSaveError):
+                tx.delete(TestDocument, pk=alpha._id)
+
+    def test_chunks(self):
+        with mock.patch.object(self.docb_handler, 'invalidate_query_cache') as invalidate:
+            with self.docb_handler.transaction(max_items=2) as tx:
+                for name in ('Alpha', 'Bravo', 'Charlie', 'Delta', 'Echoes'):
+                    tx.save(TestDocument(name=name))
+        self.assertEqual(len(self.operations('transact_write_items')), 3)
+        self.assertEqual(len(TestDocument.objects().all()), 5)
+        invalidate.assert_called_with('dynamodb', 'TestDocument')
+
+    def test_chunk_callbacks(self):
+        alpha = TestDocument(name='Alpha')
+        with self.docb_handler.session() as identity_map:
+            with self.assertRaises(TransactionError):
+                with self.docb_handler.transaction(max_items=1) as tx:
+                    tx.save(alpha)
+                    tx.delete(TestDocument, pk='missing', condition=Attr('_id').exists())
+            # The first call was written even though the second was cancelled
+            self.assertIn(alpha, identity_map)
+            self.assertEqual(alpha._data['name'], 'Alpha')
+            self.assertIs(TestDocument.get(alpha.pk), alpha)
+
+    def test_other_label(self):
+        class OtherDocument(TestDocument):
+            class Meta:
+                use_db = 'other'
+                handler = self.docb_handler
+
+        with self.docb_handler.transaction() as tx:
+            tx.save(TestDocument(name='Alpha'))
+            with self.assertRaises(DocSaveError):
+                tx.delete(OtherDocument, pk='bravo')
+
+    def test_transact_get(self):
+        alpha = TestDocument(name='Alpha')
+        alpha.save()
+        docs = self.docb_handler.transact_get([(TestDocument, alpha._id), (TestDocument, 'missing'), alpha])
+        self.assertEqual(docs[0].name, 'Alpha')
+        self.assertIsNone(docs[1])
+        self.assertEqual(docs[2]._id, alpha._id)
+        self.assertEqual(len(self.operations('transact_get_items')), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,222 @@
+"""
+Capacity-aware rate limiting for a DocbHandler label. Reads and writes draw
+from token buckets (one for the table and one per index) refilled at the
+provisioned capacity. Background work (bulk saves, flush_db, backup, restore)
+runs at a lower priority than interactive calls sharing the handler.
+"""
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+THROTTLE_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded')
+
+READ_OPERATIONS = ('get_item', 'batch_get_item', 'query', 'scan', 'transact_get_items')
+
+CAPACITY_OPERATIONS = READ_OPERATIONS + ('put_item', 'update_item', 'delete_item', 'batch_write_item',
+                                         'transact_write_items')
+
+
+def is_throttle_error(error):
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in THROTTLE_ERRORS
+
+
+class TokenBucket(object):
+    """
+    Token bucket refilled at rate tokens per second up to capacity. Requests
+    larger than the bucket are allowed once it's full and leave it in debt.
+    Background requests wait while interactive ones are waiting and can't use
+    the reserve share of the bucket. The rate is halved when DynamoDB
+    throttles and recovers additively on success.
+    """
+
+    def __init__(self, rate, capacity=None, reserve=0.2, min_rate=None, recovery=0.05, clock=time.monotonic):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.reserve = reserve
+        self.min_rate = min_rate or self.max_rate * 0.05
+        self.recovery = recovery
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+        self.waiting = [0, 0]
+        self.condition = threading.Condition()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _available(self, priority):
+        if priority == INTERACTIVE:
+            return self.tokens
+        if self.waiting[INTERACTIVE]:
+            return 0.0
+        return self.tokens - self.capacity * self.reserve
+
+    def acquire(self, tokens=1, priority=INTERACTIVE):
+        """
+        Blocks until tokens can be taken from the bucket.
+        :param tokens: Number of capacity units
+        :param priority: INTERACTIVE or BACKGROUND
+        :return: None
+        """
+        needed = min(tokens, self.capacity * (1 - self.reserve) if priority == BACKGROUND else self.capacity)
+        with self.condition:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    self._refill()
+                    available = self._available(priority)
+                    if available >= needed:
+                        self.tokens -= tokens
+                        return
+                    self.condition.wait(max((needed - available) / self.rate, 0.001))
+            finally:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+
+    def consume(self, tokens):
+        """
+        Adjusts the bucket once the consumed capacity of a request is known.
+        Negative tokens give back an over-estimate.
+        """
+        with self.condition:
+            self.tokens = min(self.capacity, self.tokens - tokens)
+            self.condition.notify_all()
+
+    def throttled(self):
+        with self.condition:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            with self.condition:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * self.recovery)
+
+
+class RateLimiter(object):
+    """
+    Read and write token buckets for a table and its indexes.
+    """
+
+    def __init__(self, read=None, write=None, indexes=None, index_read=None, index_write=None, reserve=0.2):
+        self.reserve = reserve
+        self.index_config = indexes or {}
+        self.index_read = index_read or read
+        self.index_write = index_write or write
+        self.buckets = dict()
+        self.lock = threading.Lock()
+        self._add_bucket(('read', None), read)
+        self._add_bucket(('write', None), write)
+
+    @classmethod
+    def from_config(cls, rate_limit, table_config=None):
+        """
+        Builds a RateLimiter from a label's 'rate_limit' setting. If it is
+        True the budgets come from the label's table_config capacities.
+        :param rate_limit: True or dict with read, write, indexes and reserve keys
+        :param table_config: The label's table_config dict
+        :return: RateLimiter or None
+        """
+        if rate_limit is True:
+            table_config = table_config or {}
+            if table_config.get('billing_mode', 'PROVISIONED') != 'PROVISIONED':
+                return None
+            return cls(read=table_config.get('read_capacity'), write=table_config.get('write_capacity'),
+                       index_read=table_config.get('secondary_read_capacity'),
+                       index_write=table_config.get('secondary_write_capacity'))
+        if not rate_limit:
+            return None
+        return cls(read=rate_limit.get('read'), write=rate_limit.get('write'), indexes=rate_limit.get('indexes'),
+                   index_read=rate_limit.get('index_read'), index_write=rate_limit.get('index_write'),
+                   reserve=rate_limit.get('reserve', 0.2))
+
+    def _add_bucket(self, key, rate):
+        bucket = TokenBucket(rate, reserve=self.reserve) if rate else None
+        self.buckets[key] = bucket
+        return bucket
+
+    def get_bucket(self, kind, index_name=None):
+        """
+        :param kind: 'read' or 'write'
+        :param index_name: Name of a GSI or None for the table
+        :return: TokenBucket or None if there is no budget
+        """
+        key = (kind, index_name)
+        try:
+            return self.buckets[key]
+        except KeyError:
+            with self.lock:
+                if key not in self.buckets:
+                    rate = self.index_config.get(index_name, {}).get(
+                        kind, self.index_read if kind == 'read' else self.index_write)
+                    self._add_bucket(key, rate)
+                return self.buckets[key]
+
+    def estimate(self, operation, params):
+        """
+        Up-front estimate of the capacity units a request will consume. It is
+        corrected with the ConsumedCapacity of the response.
+        """
+        if operation == 'batch_write_item':
+            return float(sum(len(v) for v in params['RequestItems'].values()))
+        if operation == 'transact_write_items':
+            return 2.0 * len(params['TransactItems'])
+        if operation == 'batch_get_item':
+            return float(sum(len(v['Keys']) for v in params['RequestItems'].values()))
+        return 1.0
+
+    def call(self, method, operation, params, priority=INTERACTIVE):
+        """
+        Sends a request through the buckets.
+        :param method: Bound client method
+        :param operation: Name of the client method
+        :param params: Request parameters
+        :param priority: INTERACTIVE or BACKGROUND
+        :return: Response dict
+        """
+        kind = 'read' if operation in READ_OPERATIONS else 'write'
+        bucket = self.get_bucket(kind, params.get('IndexName'))
+        estimate = self.estimate(operation, params)
+        if bucket is not None:
+            bucket.acquire(estimate, priority)
+        if operation in CAPACITY_OPERATIONS:
+            params.setdefault('ReturnConsumedCapacity', 'INDEXES')
+        try:
+            response = method(**params)
+        except ClientError as e:
+            if bucket is not None and is_throttle_error(e):
+                bucket.throttled()
+            raise
+        if bucket is not None:
+            bucket.succeeded()
+            if response.get('UnprocessedItems') or response.get('UnprocessedKeys'):
+                bucket.throttled()
+        self.record(kind, response.get('ConsumedCapacity'), estimate, bucket)
+        return response
+
+    def record(self, kind, consumed_capacity, estimate, bucket):
+        """
+        Charges the buckets with the capacity a response consumed (minus what
+        was taken up-front from bucket).
+        """
+        if not consumed_capacity:
+            return
+        if isinstance(consumed_capacity, dict):
+            consumed_capacity = [consumed_capacity]
+        table_units = 0.0
+        for capacity in consumed_capacity:
+            table_units += capacity.get('Table', capacity).get('CapacityUnits', 0)
+            for index_name, index_capacity in capacity.get('GlobalSecondaryIndexes', {}).items():
+                index_bucket = self.get_bucket(kind, index_name)
+                if index_bucket is not None and index_bucket is not bucket:
+                    index_bucket.consume(index_capacity.get('CapacityUnits', 0))
+                elif index_bucket is bucket:
+                    table_units += index_capacity.get('CapacityUnits', 0)
+        if bucket is not None:
+            bucket.consume(table_units - estimate)
@@ -0,0 +1,230 @@
+"""
+Transactions that collect writes (and condition checks) across Document
+classes and send them with TransactWriteItems, plus TransactGetItems reads.
+"""
+import uuid
+
+from botocore.exceptions import ClientError
+
+import docb.utils
+from docb.exceptions import DocSaveError, QueryError, TransactionError
+from docb.expressions import and_conditions, condition_params, update_params
+
+MAX_TRANSACTION_ITEMS = 100
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _doc_key(data):
+    return {'_doc_type': data['_doc_type'], '_id': data['_id']}
+
+
+def _resolve(doc_or_class, pk):
+    """
+    :return: (Document class, key dict)
+    """
+    if isinstance(doc_or_class, type):
+        if pk is None:
+            raise DocSaveError('A pk is required when passing a Document class.')
+        return doc_or_class, doc_or_class.get_key(pk)
+    return doc_or_class.__class__, _doc_key(doc_or_class._data)
+
+
+def _forget(doc_class, key):
+    """
+    :return: Callback that drops the key from the handler.session() identity map
+    """
+    def forget():
+        identity_map = doc_class.Meta.handler.get_identity_map()
+        if identity_map is not None:
+            identity_map.remove(doc_class, key['_id'])
+    return forget
+
+
+class Transaction(object):
+    """
+    Collects writes and sends them when commit is called (DocbHandler.transaction
+    calls it at the end of the with block).
+
+    DynamoDB limits a transaction to 100 items. Bigger transactions are sent
+    as several TransactWriteItems calls of max_items each: every call is
+    atomic but they are not atomic together.
+    """
+
+    def __init__(self, handler, max_items=MAX_TRANSACTION_ITEMS):
+        self.handler = handler
+        self.max_items = max_items
+        self.db_label = None
+        self.items = list()
+        self.keys = set()
+        self.doc_types = set()
+        self.callbacks = list()
+
+    def __len__(self):
+        return len(self.items)
+
+    def _add(self, doc_class, key, action, params, callback=None):
+        if action != 'ConditionCheck' and doc_class.is_aggregated():
+            # TransactWriteItems can't return the replaced items the aggregate deltas are computed from
+            raise DocSaveError('{} has aggregates and can not be written in a transaction.'.format(
+                doc_class.__name__))
+        if self.db_label is None:
+            self.db_label = doc_class.Meta.use_db
+        elif doc_class.Meta.use_db != self.db_label:
+            # Every item is sent with the client of the first item's label
+            raise DocSaveError('{} uses the {} label but this transaction writes to {}.'.format(
+                doc_class.__name__, doc_class.Meta.use_db, self.db_label))
+        table_name = self.handler.get_table_name(doc_class.Meta.use_db)
+        if (table_name, key['_doc_type'], key['_id']) in self.keys:
+            raise DocSaveError('{} {} is already part of this transaction.'.format(doc_class.__name__, key['_id']))
+        self.keys.add((table_name, key['_doc_type'], key['_id']))
+        params['TableName'] = table_name
+        if action != 'Put':
+            params['Key'] = doc_class.get_codec().encode_key(key)
+        self.items.append({action: params})
+        if action != 'ConditionCheck':
+            self.doc_types.update({(doc_class.Meta.use_db, docb.utils.get_doc_type(doc_class)),
+                                   (doc_class.Meta.use_db, doc_class.__name__)})
+        self.callbacks.append(callback)
+
+    def save(self, doc, condition=None):
+        """
+        Puts a document. Versioned documents are checked and incremented like they are in save.
+        :param doc: Document
+        :param condition: boto3.dynamodb.conditions.ConditionBase the stored item has to meet
+        :return: None
+        """
+        data = doc.prep_doc()
+        if '_id' not in data:
+            doc.create_pk(data)
+            data['_id'] = doc._id
+        condition = and_conditions(doc.set_version(data), condition)
+
+        def saved():
+            doc._data = data
+            identity_map = doc.Meta.handler.get_identity_map()
+            if identity_map is not None:
+                identity_map.put(doc)
+
+        params = {'Item': doc.get_codec().encode(data)}
+        params.update(condition_params(condition))
+        self._add(doc.__class__, _doc_key(data), 'Put', params, saved)
+
+    def delete(self, doc, pk=None, condition=None):
+        """
+        Deletes a document. The _version of versioned Documents (not classes) is checked.
+        :param doc: Document or Document class (with pk)
+        :param pk: Short or long _id if doc is a class
+        :param condition: boto3.dynamodb.conditions.ConditionBase the stored item has to meet
+        :return: None
+        """
+        doc_class, key = _resolve(doc, pk)
+        if not isinstance(doc, type):
+            condition = and_conditions(doc.get_version_condition(), condition)
+        self._add(doc_class, key, 'Delete', condition_params(condition), _forget(doc_class, key))
+
+    def condition_check(self, doc, condition, pk=None):
+        """
+        Cancels the transaction unless the stored item meets condition.
+        :param doc: Document or Document class (with pk)
+        :param condition: boto3.dynamodb.conditions.ConditionBase
+        :param pk: Short or long _id if doc is a class
+        :return: None
+        """
+        doc_class, key = _resolve(doc, pk)
+        self._add(doc_class, key, 'ConditionCheck', condition_params(condition))
+
+    def update(self, doc, pk=None, condition=None, **values):
+        """
+        Sets attributes of a stored document without reading it. Empty values
+        remove the attribute like they do in save. The _version of versioned
+        classes is incremented (and checked when doc is a Document).
+        :param doc: Document or Document class (with pk)
+        :param pk: Short or long _id if doc is a class
+        :param condition: boto3.dynamodb.conditions.ConditionBase the stored item has to meet
+        :param values: Property values
+        :return: None
+        """
+        doc_class, key = _resolve(doc, pk)
+        if not values:
+            raise DocSaveError('update requires at least one value.')
+        # Loaded instances don't have the new values
+        callback = _forget(doc_class, key)
+        if doc_class.is_versioned() and not isinstance(doc, type):
+            condition = and_conditions(doc.get_version_condition(), condition)
+            forget = callback
+
+            def callback():
+                doc._data['_version'] = (doc._data.get('_version') or 0) + 1
+                forget()
+
+        params = update_params(doc_class, values, condition, increment_version=doc_class.is_versioned())
+        self._add(doc_class, key, 'Update', params, callback)
+
+    def commit(self):
+        """
+        Sends the collected items and clears the transaction. The documents
+        of each TransactWriteItems call are updated as soon as it succeeds, so
+        the calls sent before one that fails are reflected too.
+        :return: None
+        """
+        items, callbacks, doc_types = self.items, self.callbacks, self.doc_types
+        self.items, self.keys, self.callbacks, self.doc_types = list(), set(), list(), set()
+        try:
+            for chunk in _chunks(list(zip(items, callbacks)), self.max_items):
+                # The token makes retries of the same call idempotent
+                params = {'TransactItems': [item for item, callback in chunk],
+                          'ClientRequestToken': str(uuid.uuid4())}
+                try:
+                    self.handler.call(self.db_label, 'transact_write_items', params)
+                except ClientError as e:
+                    if e.response['Error']['Code'] == 'TransactionCanceledException':
+                        raise TransactionError(e.response['Error'].get('Message', 'Transaction cancelled.'),
+                                               e.response.get('CancellationReasons')) from e
+                    raise
+                for item, callback in chunk:
+                    if callback is not None:
+                        callback()
+        finally:
+            for db_label, doc_type in doc_types:
+                self.handler.invalidate_query_cache(db_label, doc_type)
+
+
+def transact_get(handler, refs, max_items=MAX_TRANSACTION_ITEMS):
+    """
+    Reads documents with TransactGetItems so they are read at the same point
+    in time (per call of max_items).
+    :param handler: DocbHandler
+    :param refs: List of Documents or (Document class, pk) tuples
+    :param max_items: Items per TransactGetItems call
+    :return: List of Documents (None where the document doesn't exist) in the order of refs
+    """
+    resolved = list()
+    for ref in refs:
+        if isinstance(ref, tuple):
+            resolved.append(_resolve(*ref))
+        else:
+            resolved.append(_resolve(ref, None))
+    if not resolved:
+        return list()
+    db_label = resolved[0][0].Meta.use_db
+    docs = list()
+    for chunk in _chunks(resolved, max_items):
+        items = [{'Get': {'TableName': handler.get_table_name(doc_class.Meta.use_db),
+                          'Key': doc_class.get_codec().encode_key(key)}}
+                 for doc_class, key in chunk]
+        try:
+            response = handler.call(db_label, 'transact_get_items', {'TransactItems': items})
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'TransactionCanceledException':
+                raise QueryError(e.response['Error'].get('Message', 'Transaction cancelled.')) from e
+            raise
+        for (doc_class, key), item in zip(chunk, response['Responses']):
+            if 'Item' in item:
+                docs.append(doc_class.from_item(doc_class.get_codec().decode(item['Item'])))
+            else:
+                docs.append(None)
+    return docs
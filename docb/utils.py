@@ -1,45 +1,6 @@
+import contextvars
 import sys
 import importlib
-import envs as e
-import sammy as sm
-import valley
-
-
-BILLING_MODE_CHOICES = {
-    'PROVISIONED':'PROVISIONED',
-    'PAY_PER_REQUEST':'PAY_PER_REQUEST'
-}
-
-STREAM_VIEW_TYPE = {
-    'KEYS_ONLY': 'KEYS_ONLY',
-    'NEW_IMAGE': 'NEW_IMAGE',
-    'OLD_IMAGE': 'OLD_IMAGE',
-    'NEW_AND_OLD_IMAGES': 'NEW_AND_OLD_IMAGES'
-}
-
-SSE_TYPE_CHOICES = {
-    'AES256': 'AES256',
-    'KMS': 'KMS'
-}
-
-
-class TableConfig(valley.contrib.Schema):
-    billing_mode = valley.CharProperty(required=True, default_value='PROVISIONED', choices=BILLING_MODE_CHOICES)
-    write_capacity = valley.IntegerProperty()
-    read_capacity = valley.IntegerProperty()
-    secondary_write_capacity = valley.IntegerProperty()
-    secondary_read_capacity = valley.IntegerProperty()
-    autoscaling = valley.BooleanProperty()
-    stream_enabled = valley.BooleanProperty()
-    stream_view_type = valley.CharProperty(default_value='NEW_AND_OLD_IMAGES', choices=STREAM_VIEW_TYPE)
-    sse_enabled = valley.BooleanProperty()
-    sse_type = valley.CharProperty(default_value='KMS', choices=SSE_TYPE_CHOICES)
-    kms_master_key_id = valley.CharProperty()
-
-
-class TableConnection(valley.contrib.Schema):
-    table = valley.CharProperty(required=True)
-    endpoint_url = valley.CharProperty()
 
 
 def import_mod(imp):
@@ -64,6 +25,22 @@ def import_util(imp):
     return getattr(mod, obj_name)
 
 
+def bind_context(func):
+    """
+    Wraps a function that runs in another thread so every call sees the
+    context variables of the caller (like DocbHandler.background() and
+    DocbHandler.session()) as they were when it was wrapped.
+    :param func: Callable
+    :return: Callable
+    """
+    context = contextvars.copy_context()
+
+    def call(*args, **kwargs):
+        # A context can only be entered by one thread at a time
+        return context.copy().run(func, *args, **kwargs)
+    return call
+
+
 def get_doc_type(klass):
     if hasattr(klass.Meta, 'doc_type'):
         if klass.Meta.doc_type is not None:
@@ -72,6 +49,8 @@ def get_doc_type(klass):
 
 
 def get_db_kwargs():
+    import envs as e
+
     kwargs = dict()
     endpoint_url  = e.env('DYNAMODB_ENDPOINT_URL')
     if endpoint_url:
@@ -134,12 +113,16 @@ def build_cf_args(table_name, table_config, global_indexes, resource_name=None):
 
 
 def build_cf_resource(resource_name, table_name, table_config, global_indexes):
+    import sammy as sm
+
     return sm.DynamoDBTable(
         **build_cf_args(table_name, table_config, global_indexes, resource_name)
     )
 
 
 def build_cf_template(db_resource):
+    import sammy as sm
+
     tmpl = sm.CFT(render_type='yaml')
     tmpl.add_resource(db_resource)
     return tmpl
@@ -34,8 +34,11 @@ setup(
     url='https://github.com/capless/docb',
     extras_require={
         'test': parse_requirements('test_requirements.txt'),
+        'numpy': ['numpy'],
+        'export': ['pyarrow'],
     },
     license='GPLv3',
+    python_requires='>=3.7',
     install_requires=parse_requirements('requirements.txt'),
     include_package_data=True,
     zip_safe=False,